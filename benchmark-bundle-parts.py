@@ -0,0 +1,176 @@
+#!/usr/bin/python -tt
+
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measure how fast the bundle part writer splits a bundle stream into part
+files, comparing the way it used to copy data with the way it does now.
+
+The baseline reads the stream in BUFSIZE (16 KiB) chunks and does not
+preallocate parts, as the part writer originally did.  It then opened
+parts in text mode, which on POSIX systems writes exactly the same
+bytes, so only the chunk size and preallocation need reproducing.  The
+current part writer reads LARGE_BUFSIZE (1 MiB) chunks and preallocates
+each part where posix_fallocate is available; it is also measured
+without preallocation to separate the two effects.
+
+Data are pushed through a pipe into the part writer the same way the
+bundling pipeline feeds it, and the fastest of several runs is reported
+along with its throughput.  After each run every part file is read back
+to make sure its size and SHA1 digest match what the part writer
+reported, so a short last part that was preallocated must also have
+been truncated back to its real size.
+
+Parts are written to a temporary directory under TMPDIR (or /var/tmp);
+use -d to measure a different file system.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import time
+
+import euca2ools
+import euca2ools.bundle.util
+import euca2ools.util
+from euca2ools.bundle.pipes import fittings
+
+
+# (name, bufsize, preallocate)
+MODES = (('baseline: BUFSIZE chunks', euca2ools.BUFSIZE, False),
+         ('LARGE_BUFSIZE chunks', euca2ools.LARGE_BUFSIZE, False),
+         ('LARGE_BUFSIZE chunks + fallocate', euca2ools.LARGE_BUFSIZE, True))
+
+
+def write_parts(directory, data, total_size, part_size, bufsize,
+                preallocate):
+    infile, outfile = euca2ools.bundle.util.open_pipe_fileobjs()
+    partinfo_mpconn = fittings.create_bundle_part_writer(
+        infile, os.path.join(directory, 'image'), part_size,
+        bufsize=bufsize, preallocate=preallocate)
+    partinfo_aggr_mpconn = fittings.create_mpconn_aggregator(partinfo_mpconn)
+    partinfo_mpconn.close()
+    bytes_left = total_size
+    while bytes_left > 0:
+        chunk = data[:min(bytes_left, len(data))]
+        outfile.write(chunk)
+        bytes_left -= len(chunk)
+    outfile.close()
+    parts = partinfo_aggr_mpconn.recv()
+    partinfo_aggr_mpconn.close()
+    return parts
+
+
+def check_parts(parts, total_size):
+    errors = []
+    if sum(part.size for part in parts) != total_size:
+        errors.append('parts hold {0} bytes instead of {1}'.format(
+            sum(part.size for part in parts), total_size))
+    for part in parts:
+        if os.path.getsize(part.filename) != part.size:
+            errors.append('{0} is {1} bytes instead of {2}'.format(
+                part.filename, os.path.getsize(part.filename), part.size))
+        digest = hashlib.sha1()
+        with open(part.filename, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(euca2ools.LARGE_BUFSIZE),
+                              ''):
+                digest.update(chunk)
+        if digest.hexdigest() != part.hexdigest:
+            errors.append('{0} has the wrong digest'.format(part.filename))
+    return errors
+
+
+def time_writer(args, data, bufsize, preallocate):
+    best = None
+    errors = []
+    for _ in range(args.repeat):
+        directory = euca2ools.util.mkdtemp_for_large_files(
+            prefix='benchmark-', dir=args.directory)
+        try:
+            start = time.time()
+            parts = write_parts(directory, data, args.size, args.part_size,
+                                bufsize, preallocate)
+            elapsed = time.time() - start
+            errors.extend(check_parts(parts, args.size))
+        finally:
+            shutil.rmtree(directory)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the speed of the bundle part writer')
+    parser.add_argument('-s', '--size', metavar='MiB', type=int, default=1024,
+                        help='''write MiB mebibytes of data per run
+                        (default: 1024)''')
+    parser.add_argument('--part-size', metavar='MiB', type=int, default=10,
+                        help='size of each part in MiB (default: 10)')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=3,
+                        help='''do N runs and keep the fastest of them
+                        (default: 3)''')
+    parser.add_argument('-d', '--directory',
+                        help='write parts in a temporary directory here')
+    args = parser.parse_args()
+    if args.size < 1:
+        parser.error('argument -s/--size must be at least 1')
+    if args.part_size < 1:
+        parser.error('argument --part-size must be at least 1')
+    if args.repeat < 1:
+        parser.error('argument -n/--repeat must be at least 1')
+    # Make the last part a short one, which is the usual case
+    args.size = args.size * 1024 * 1024 + 12345
+    args.part_size *= 1024 * 1024
+
+    # Bundle streams are encrypted, so random data are representative
+    data = os.urandom(euca2ools.LARGE_BUFSIZE)
+    results = []
+    status = 0
+    if fittings._get_posix_fallocate() is None:
+        print >> sys.stderr, ('warning: posix_fallocate is not available, '
+                              'so parts will not really be preallocated')
+    for name, bufsize, preallocate in MODES:
+        elapsed, errors = time_writer(args, data, bufsize, preallocate)
+        for error in errors:
+            print >> sys.stderr, 'error: {0}: {1}'.format(name, error)
+            status = 1
+        results.append((name, elapsed))
+
+    baseline = results[0][1]
+    print '{0:>10} {1:>10} {2:>10}  {3}'.format('total s', 'MB/s',
+                                                'speedup', 'part writer')
+    for name, elapsed in results:
+        print '{0:10.2f} {1:10.1f} {2:9.2f}x  {3}'.format(
+            elapsed, args.size / elapsed / 1000000, baseline / elapsed,
+            name)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python -tt
+
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compare how fast bundle manifests are written and read when their RSA
+work is done by running openssl and when it is done in process with the
+cryptography library.
+
+Writing a manifest (BundleManifest.dump_to_str) encrypts the bundle's
+key and IV for two certificates and signs the result, and reading one
+with a private key (BundleManifest.read_from_fileobj) decrypts the key
+and IV.  Each is repeated with a single crypto object, the way commands
+that handle many manifests reuse the process-wide one, and the fastest
+run is reported along with its throughput.
+
+A throwaway key and certificate are generated with openssl for the
+measurement.  Each manifest written with one implementation is also
+read back with the other to make sure they agree.
+"""
+
+import argparse
+import binascii
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import six
+
+import euca2ools.bundle
+import euca2ools.bundle.crypto
+from euca2ools.bundle.manifest import BundleManifest
+
+
+def make_keys(tempdir, key_size):
+    privkey_filename = os.path.join(tempdir, 'key.pem')
+    cert_filename = os.path.join(tempdir, 'cert.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ('openssl', 'req', '-x509', '-newkey',
+             'rsa:{0}'.format(key_size), '-nodes', '-days', '1',
+             '-subj', '/CN=benchmark', '-keyout', privkey_filename,
+             '-out', cert_filename), stdout=devnull, stderr=devnull)
+    return privkey_filename, cert_filename
+
+
+def make_manifest(crypto, part_count):
+    manifest = BundleManifest(crypto=crypto)
+    manifest.image_arch = 'x86_64'
+    manifest.image_name = 'benchmark.img'
+    manifest.account_id = '123456789012'
+    manifest.image_type = 'machine'
+    manifest.image_digest = '0' * 40
+    manifest.image_digest_algorithm = 'SHA1'
+    manifest.image_size = part_count * 10 * 2 ** 20
+    manifest.bundled_image_size = manifest.image_size
+    manifest.enc_key = binascii.hexlify(os.urandom(16))
+    manifest.enc_iv = binascii.hexlify(os.urandom(16))
+    manifest.enc_algorithm = 'AES-128-CBC'
+    for index in range(part_count):
+        manifest.image_parts.append(euca2ools.bundle.BundlePart(
+            'benchmark.img.part.{0:02}'.format(index), '0' * 40, 'SHA1'))
+    return manifest
+
+
+def time_operation(func, count, repeat):
+    """
+    Call func count times in a row, repeat times, and return the fastest
+    time per call in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(count):
+            func()
+        elapsed = (time.time() - start) / count
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Compare the speed of the openssl and in-process '
+                     'implementations of manifest RSA operations'))
+    parser.add_argument('-c', '--count', metavar='N', type=int, default=20,
+                        help='''process N manifests per run
+                        (default: 20)''')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=3,
+                        help='''do N runs and keep the fastest of them
+                        (default: 3)''')
+    parser.add_argument('--parts', metavar='N', type=int, default=10,
+                        help='number of parts in each manifest (default: 10)')
+    parser.add_argument('--key-size', metavar='BITS', type=int,
+                        default=2048, help='RSA key size (default: 2048)')
+    args = parser.parse_args()
+    if args.count < 1:
+        parser.error('argument -c/--count must be at least 1')
+    if args.repeat < 1:
+        parser.error('argument -n/--repeat must be at least 1')
+
+    implementations = [('openssl',
+                        euca2ools.bundle.crypto.OpenSSLManifestCrypto())]
+    if euca2ools.bundle.crypto.have_native_cipher():
+        implementations.append(
+            ('native', euca2ools.bundle.crypto.NativeManifestCrypto()))
+    else:
+        print >> sys.stderr, ('warning: the cryptography library is not '
+                              'available; measuring only openssl')
+
+    tempdir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        privkey_filename, cert_filename = make_keys(tempdir, args.key_size)
+        results = {}
+        manifest_strs = {}
+        for name, crypto in implementations:
+            manifest = make_manifest(crypto, args.parts)
+            manifest_str = manifest.dump_to_str(privkey_filename,
+                                                cert_filename, cert_filename)
+            manifest_strs[name] = (manifest, manifest_str)
+
+            def dump():
+                manifest.dump_to_str(privkey_filename, cert_filename,
+                                     cert_filename)
+
+            def read():
+                BundleManifest.read_from_fileobj(
+                    six.BytesIO(manifest_str), privkey_filename,
+                    crypto=crypto)
+
+            results[name] = (time_operation(dump, args.count, args.repeat),
+                             time_operation(read, args.count, args.repeat))
+
+        # Each implementation must be able to read the other's manifests
+        status = 0
+        for name, (manifest, manifest_str) in sorted(manifest_strs.items()):
+            for other_name, other_crypto in implementations:
+                read_manifest = BundleManifest.read_from_fileobj(
+                    six.BytesIO(manifest_str), privkey_filename,
+                    crypto=other_crypto)
+                if (read_manifest.enc_key != manifest.enc_key or
+                        read_manifest.enc_iv != manifest.enc_iv):
+                    print >> sys.stderr, (
+                        'error: {0} could not read a manifest written by '
+                        '{1}'.format(other_name, name))
+                    status = 1
+    finally:
+        shutil.rmtree(tempdir)
+
+    print '{0:>10} {1:>10} {2:>10} {3:>10}  {4}'.format(
+        'write ms', 'writes/s', 'read ms', 'reads/s', 'implementation')
+    for name, _ in implementations:
+        dump_time, read_time = results[name]
+        print '{0:10.2f} {1:10.1f} {2:10.2f} {3:10.1f}  {4}'.format(
+            dump_time * 1000, 1 / dump_time, read_time * 1000,
+            1 / read_time, name)
+    if 'native' in results:
+        print '{0:9.1f}x {1:>10} {2:9.1f}x {3:>10}  {4}'.format(
+            results['openssl'][0] / results['native'][0], '',
+            results['openssl'][1] / results['native'][1], '', 'speedup')
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
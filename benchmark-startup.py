@@ -0,0 +1,294 @@
+#!/usr/bin/python -tt
+
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measure how long each command in bin/ takes to start.
+
+Each command is measured in a new Python interpreter, which imports the
+command's module while timing every import beneath it, and then
+constructs the command the way it would be constructed for a request to
+a local endpoint, without sending anything.  The results are the time
+spent importing, the time spent constructing the command, and the total
+time the interpreter ran.
+
+Results can be saved as a baseline and compared with a later run, which
+fails when any command becomes slower than the baseline by more than a
+given threshold:
+
+    ./benchmark-startup.py --save before.json
+    (make changes)
+    ./benchmark-startup.py --compare before.json --threshold 20
+
+Use --tree to see which imports a command's import time goes to.
+"""
+
+# Only the standard library modules the measurement itself needs are
+# imported at module level, since anything imported before a command's
+# module is imported would not show up in its measurement.
+import os
+import sys
+import time
+
+
+STUB_URL = 'http://127.0.0.1:1/'
+
+
+class _ImportTimer(object):
+    """
+    Replace __import__ with a version that records a tree of the
+    imports that loaded new modules and how long each of them took,
+    including the imports they did in turn.
+    """
+
+    def __init__(self):
+        self.root = ['', 0.0, []]
+        self.__stack = [self.root]
+        self.__orig_import = None
+
+    def __enter__(self):
+        import __builtin__
+        self.__orig_import = __builtin__.__import__
+        __builtin__.__import__ = self.__import
+        return self
+
+    def __exit__(self, *_):
+        import __builtin__
+        __builtin__.__import__ = self.__orig_import
+
+    def __import(self, name, *args, **kwargs):
+        node = [name, 0.0, []]
+        modules_before = len(sys.modules)
+        self.__stack.append(node)
+        start = time.time()
+        try:
+            module = self.__orig_import(name, *args, **kwargs)
+            if not name:
+                # "from . import spam" imports spam from this package
+                node[0] = getattr(module, '__name__', name)
+            return module
+        finally:
+            node[1] = time.time() - start
+            self.__stack.pop()
+            if len(sys.modules) > modules_before:
+                self.__stack[-1][2].append(node)
+            else:
+                # Nothing new was loaded, but anything this imported
+                # still counts toward the importer's time.
+                self.__stack[-1][2].extend(node[2])
+
+
+def measure_command(module_name, class_name):
+    """
+    Import and construct a command in this process and print the results
+    as JSON.  This runs in a fresh interpreter for every command.
+    """
+    with _ImportTimer() as timer:
+        start = time.time()
+        __import__(module_name)
+        import_time = time.time() - start
+    cmdclass = getattr(sys.modules[module_name], class_name)
+
+    # Point services at a local endpoint that nothing listens on and
+    # keep any config files on this system from affecting the results.
+    os.environ['EUCA_CONFIG_PATH'] = os.devnull
+    os.environ['AWS_ACCESS_KEY_ID'] = 'AKIDSTARTUPBENCHMARK'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'startup-benchmark'
+    service_class = getattr(cmdclass, 'SERVICE_CLASS', None)
+    if getattr(service_class, 'URL_ENVVAR', None):
+        os.environ[service_class.URL_ENVVAR] = STUB_URL
+    error = None
+    start = time.time()
+    # Commands run from the command line set this up first, and some of
+    # them log things at levels that only it defines.
+    import requestbuilder.logging
+    requestbuilder.logging.configure_root_logger()
+    try:
+        cmdclass()
+    except Exception as err:
+        # Most commands need arguments that are not supplied here, and
+        # they usually fail while checking them at the end of
+        # construction, so the time spent up to that point still counts.
+        error = '{0}: {1}'.format(type(err).__name__, err)
+    construct_time = time.time() - start
+
+    import json
+    json.dump({'import': import_time, 'construct': construct_time,
+               'error': error, 'tree': timer.root[2]}, sys.stdout)
+
+
+def find_commands(bin_dir, patterns=None):
+    """
+    Return a sorted list of (script, module, class) tuples for the
+    scripts in bin_dir whose names match any of the given glob patterns.
+    """
+    import fnmatch
+    import re
+
+    run_re = re.compile(r'^\s*(euca2ools\.[\w.]+)\.(\w+)\.run\(\)',
+                        re.MULTILINE)
+    commands = []
+    for script in sorted(os.listdir(bin_dir)):
+        if patterns and not any(fnmatch.fnmatch(script, pattern)
+                                for pattern in patterns):
+            continue
+        path = os.path.join(bin_dir, script)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path) as script_file:
+            match = run_re.search(script_file.read())
+        if match:
+            commands.append((script,) + match.groups())
+    return commands
+
+
+def run_measurement(module_name, class_name):
+    import json
+    import subprocess
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--measure',
+         module_name, class_name], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    total_time = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError('measuring {0}.{1} failed:\n{2}'.format(
+            module_name, class_name, stderr))
+    result = json.loads(stdout)
+    result['total'] = total_time
+    return result
+
+
+def print_tree(nodes, min_time, depth=1):
+    for name, elapsed, children in sorted(nodes, key=lambda node: -node[1]):
+        if elapsed < min_time:
+            continue
+        self_time = elapsed - sum(child[1] for child in children)
+        print '{0:9.1f} {1:9.1f}  {2}{3}'.format(
+            elapsed * 1000, self_time * 1000, '  ' * depth, name)
+        print_tree(children, min_time, depth + 1)
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description='Measure how long euca2ools commands take to start',
+        epilog='Times are in milliseconds.')
+    parser.add_argument('patterns', metavar='PATTERN', nargs='*',
+                        help='''only measure commands whose names match
+                        these glob patterns (default: all of them)''')
+    parser.add_argument('--bin-dir', metavar='DIR', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'bin'),
+        help='directory containing the commands (default: bin)')
+    parser.add_argument('-n', '--repeat', metavar='N', type=int, default=3,
+                        help='''measure each command N times and keep the
+                        fastest of them (default: 3)''')
+    parser.add_argument('--tree', action='store_true',
+                        help='''show each command's imports as a tree, with the
+                        time each import took including and excluding the
+                        imports it did in turn''')
+    parser.add_argument('--min-time', metavar='MS', type=float, default=1.0,
+                        help='''leave imports that take less than this long
+                        out of the tree (default: 1)''')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results to a file')
+    parser.add_argument('--compare', metavar='FILE', help='''compare the
+                        results with those saved in a file and exit with
+                        status 1 if any command regressed''')
+    parser.add_argument('--threshold', metavar='PERCENT', type=float,
+                        default=20.0, help='''how much slower than the
+                        saved results a command may become before it
+                        counts as a regression (default: 20)''')
+    parser.add_argument('--slack', metavar='MS', type=float, default=5.0,
+                        help='''ignore regressions smaller than this, which
+                        are usually just noise (default: 5)''')
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('argument -n/--repeat must be at least 1')
+
+    commands = find_commands(args.bin_dir, args.patterns)
+    if not commands:
+        parser.error('no commands to measure')
+    results = {}
+    print '{0:>9} {1:>9} {2:>9}  {3}'.format('import', 'construct',
+                                              'total', 'command')
+    for script, module_name, class_name in commands:
+        runs = [run_measurement(module_name, class_name)
+                for _ in range(args.repeat)]
+        fastest = min(runs, key=lambda run: run['total'])
+        results[script] = dict((key, min(run[key] for run in runs))
+                               for key in ('import', 'construct', 'total'))
+        print '{0:9.1f} {1:9.1f} {2:9.1f}  {3}'.format(
+            results[script]['import'] * 1000,
+            results[script]['construct'] * 1000,
+            results[script]['total'] * 1000, script)
+        if args.tree:
+            print_tree(fastest['tree'], args.min_time / 1000.0)
+            print
+        sys.stdout.flush()
+    for key in ('import', 'construct', 'total'):
+        times = sorted(result[key] for result in results.values())
+        print '{0:>9}: mean {1:.1f}, median {2:.1f}, max {3:.1f}'.format(
+            key, sum(times) * 1000 / len(times),
+            times[len(times) // 2] * 1000, times[-1] * 1000)
+
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = []
+        for script in sorted(results):
+            if script not in baseline:
+                continue
+            old = baseline[script]['total']
+            new = results[script]['total']
+            if (new - old > args.slack / 1000.0 and
+                    new > old * (1 + args.threshold / 100.0)):
+                regressions.append((script, old, new))
+        for script, old, new in regressions:
+            print >> sys.stderr, (
+                'regression: {0} took {1:.1f} ms, up from {2:.1f} ms '
+                '({3:+.0f}%)'.format(script, new * 1000, old * 1000,
+                                     (new / old - 1) * 100))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure_command(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -24,31 +24,55 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os.path
-import subprocess
 
 
 __version__ = '3.4-devel'
 
 BUFSIZE = 16 * 1024
+LARGE_BUFSIZE = 1024 * 1024
 
 
-if '__file__' in globals():
-    # Check if this is a git repo; maybe we can get more precise version info
+_VERSION = None
+
+
+def get_version():
+    """
+    Return the version of euca2ools.  In a git checkout that comes from
+    "git describe", which runs only the first time this is called, and
+    everywhere else it is __version__, which setup.py fills in when
+    building packages.
+    """
+    global _VERSION  # pylint: disable=global-statement
+    if _VERSION is None:
+        _VERSION = __version__
+        if '__file__' in globals():
+            # Check if this is a git repo; maybe we can get more precise
+            # version info
+            repo_path = os.path.join(os.path.dirname(__file__), '..')
+            if os.path.exists(os.path.join(repo_path, '.git')):
+                _VERSION = _get_git_version(repo_path) or __version__
+    return _VERSION
+
+
+def _get_git_version(repo_path):
+    # Importing subprocess takes a noticeable fraction of the time it
+    # takes to import this module, and almost nothing needs it.
+    import subprocess
     try:
-        REPO_PATH = os.path.join(os.path.dirname(__file__), '..')
         # noinspection PyUnresolvedReferences
-        GIT = subprocess.Popen(
+        git = subprocess.Popen(
             ['git', 'describe'], stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            env={'GIT_DIR': os.path.join(REPO_PATH, '.git')})
-        GIT.wait()
-        GIT.stderr.read()
-        if GIT.returncode == 0:
-            __version__ = GIT.stdout.read().strip().lstrip('v')
-            if type(__version__).__name__ == 'bytes':
-                __version__ = __version__.decode()
+            env={'GIT_DIR': os.path.join(repo_path, '.git')})
+        stdout = git.communicate()[0]
+        if git.returncode == 0:
+            version = stdout.strip().lstrip('v')
+            if type(version).__name__ == 'bytes':
+                version = version.decode()
+            return version
     # pylint: disable=bare-except
     except:
         # Not really a bad thing; we'll just use what we had
         pass
     # pylint: enable=bare-except
+    return None
@@ -0,0 +1,288 @@
+# Copyright (c) 2013-2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import fcntl
+import hashlib
+import heapq
+import logging
+import os
+import tempfile
+import time
+
+import euca2ools
+
+
+class BundlePartCache(object):
+    """
+    An on-disk cache of bundle parts, keyed by their SHA1 digests.
+
+    Entries are filled by writing to a temporary file in the cache
+    directory and renaming it into place, so other processes never see
+    a partially-written part.  Readers need no locks:  if a part gets
+    evicted while something is reading it the reader keeps its open
+    file.  Eviction removes the least recently used parts until the
+    cache fits within max_size bytes, and is serialized across
+    processes with a lock file.
+
+    So adding a part does not mean looking at every file in the cache,
+    the cache keeps a running total of its parts' sizes in a file next
+    to the lock file.  The whole cache is scanned only when that total
+    goes over max_size, when the total is missing or unreadable, and
+    the first time each BundlePartCache adds a part, which also catches
+    anything that removed parts without updating the total.
+    """
+
+    # Temporary files older than this are left over from dead processes
+    STALE_TEMPFILE_AGE = 86400
+    # Eviction frees space down to this fraction of max_size so a full
+    # cache is not scanned again for every part added to it
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, path, max_size, loglevel=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        if loglevel is not None:
+            self.log.level = loglevel
+        self.path = path
+        self.max_size = max_size
+        self.__scanned = False
+
+    def get_part_path(self, hexdigest):
+        hexdigest = hexdigest.lower()
+        return os.path.join(self.path, hexdigest[:2], hexdigest)
+
+    def copy_part(self, hexdigest, outfile):
+        """
+        If the part with the given SHA1 digest is in the cache, write it
+        to outfile and return the number of bytes written.  Otherwise
+        return None.
+
+        Cached parts are checked against their digests as they are
+        read.  If one turns out to be corrupt it is removed from the
+        cache, outfile is truncated to its original position, and this
+        method returns None.
+        """
+        part_path = self.get_part_path(hexdigest)
+        try:
+            part = open(part_path)
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        # Mark the part as recently used
+        try:
+            os.utime(part_path, None)
+        except OSError:
+            # It was evicted after we opened it, but we can still read it
+            pass
+        start_pos = outfile.tell()
+        digest = hashlib.sha1()
+        bytes_written = 0
+        with part:
+            while True:
+                chunk = part.read(euca2ools.BUFSIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                outfile.write(chunk)
+                bytes_written += len(chunk)
+        if digest.hexdigest() != hexdigest.lower():
+            self.log.warn('removing corrupt part %s from the cache '
+                          '(actual SHA1: %s)', hexdigest, digest.hexdigest())
+            self.__remove(part_path)
+            outfile.seek(start_pos)
+            outfile.truncate()
+            return None
+        outfile.flush()
+        self.log.debug('read %i bytes of part %s from the cache',
+                       bytes_written, hexdigest)
+        return bytes_written
+
+    def open_part_writer(self, hexdigest, outfile):
+        """
+        Return a file-like object that writes everything written to it
+        to outfile and also to a new cache entry for the part with the
+        given SHA1 digest.  Call its commit method once the part is known
+        to be correct to add it to the cache, or its abort method to
+        throw it away.
+        """
+        return _CachingPartWriter(self, hexdigest, outfile)
+
+    def evict(self):
+        """
+        If the cache does not fit within max_size bytes, remove the least
+        recently used parts from it until it fits within EVICTION_TARGET
+        of that.
+        """
+        if not os.path.isdir(self.path):
+            return
+        with open(os.path.join(self.path, '.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                self.__evict_locked()
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def _add_part(self, hexdigest, temp_path):
+        # Called by _CachingPartWriter.commit
+        part_path = self.get_part_path(hexdigest)
+        _makedirs(os.path.dirname(part_path))
+        with open(os.path.join(self.path, '.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    # Another process may have added the same part
+                    replaced_size = os.path.getsize(part_path)
+                except OSError:
+                    replaced_size = 0
+                os.rename(temp_path, part_path)
+                self.log.debug('added part %s to the cache', hexdigest)
+                total_size = self.__read_total_size()
+                if total_size is None or not self.__scanned:
+                    self.__evict_locked()
+                    return
+                total_size += os.path.getsize(part_path) - replaced_size
+                if total_size > self.max_size:
+                    self.__evict_locked()
+                else:
+                    self.__write_total_size(total_size)
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def _create_tempfile(self):
+        _makedirs(self.path)
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        return os.fdopen(fd, 'w'), temp_path
+
+    def __evict_locked(self):
+        entries = []
+        total_size = 0
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith('.tmp-'):
+                    if now - stat.st_mtime > self.STALE_TEMPFILE_AGE:
+                        self.__remove(path)
+                elif not filename.startswith('.'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total_size += stat.st_size
+        heapq.heapify(entries)
+        if total_size > self.max_size:
+            target_size = int(self.max_size * self.EVICTION_TARGET)
+        else:
+            target_size = total_size
+        while total_size > target_size and entries:
+            _, size, path = heapq.heappop(entries)
+            self.log.debug('evicting %s from the cache', path)
+            self.__remove(path)
+            total_size -= size
+        self.__write_total_size(total_size)
+        self.__scanned = True
+
+    def __read_total_size(self):
+        try:
+            with open(os.path.join(self.path, '.size')) as size_file:
+                return int(size_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def __write_total_size(self, total_size):
+        with open(os.path.join(self.path, '.size'), 'w') as size_file:
+            size_file.write(str(total_size))
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+class _CachingPartWriter(object):
+    def __init__(self, cache, hexdigest, outfile):
+        self.cache = cache
+        self.hexdigest = hexdigest
+        self.outfile = outfile
+        try:
+            self.__tempfile, self.__temp_path = cache._create_tempfile()
+        except (IOError, OSError):
+            cache.log.warn('failed to create a cache entry for part %s',
+                           hexdigest, exc_info=True)
+            self.__tempfile = None
+            self.__temp_path = None
+
+    def write(self, data):
+        self.outfile.write(data)
+        if self.__tempfile is not None:
+            try:
+                self.__tempfile.write(data)
+            except IOError:
+                # A full cache disk should not break the download
+                self.cache.log.warn('failed to write part %s to the cache',
+                                    self.hexdigest, exc_info=True)
+                self.abort()
+
+    def flush(self):
+        self.outfile.flush()
+
+    def tell(self):
+        return self.outfile.tell()
+
+    def commit(self):
+        if self.__tempfile is None:
+            return
+        try:
+            self.__tempfile.close()
+            self.__tempfile = None
+            self.cache._add_part(self.hexdigest, self.__temp_path)
+            self.__temp_path = None
+        except (IOError, OSError):
+            self.cache.log.warn('failed to add part %s to the cache',
+                                self.hexdigest, exc_info=True)
+            self.abort()
+
+    def abort(self):
+        if self.__tempfile is not None:
+            self.__tempfile.close()
+            self.__tempfile = None
+        if self.__temp_path is not None:
+            try:
+                os.remove(self.__temp_path)
+            except OSError:
+                pass
+            self.__temp_path = None
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,352 @@
+# Copyright (c) 2013-2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Cryptography for bundles and their manifests
+
+Bundles are encrypted with AES-128-CBC and PKCS#7 padding, which is what
+``openssl enc -aes-128-cbc`` produces.  When the cryptography library is
+available the ciphers in this module produce exactly the same output in
+process, which saves a process and a trip through a pipe for each bundle
+and keeps the key off of openssl's command line.  When it is not,
+have_native_cipher returns False and callers should run openssl instead.
+
+Manifests carry the bundle's key and IV encrypted with RSA certificates
+and are signed with the bundler's RSA key.  get_manifest_crypto returns
+an object that does that work in process when the cryptography library
+is available, and by running openssl otherwise.
+"""
+
+import binascii
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+import warnings
+
+import euca2ools.bundle.util
+
+
+AES_BLOCK_SIZE = 16
+
+_HAVE_NATIVE_CIPHER = None
+
+
+def have_native_cipher():
+    # Importing cryptography is not free, so only do it when something
+    # actually needs a cipher.
+    global _HAVE_NATIVE_CIPHER
+    if _HAVE_NATIVE_CIPHER is None:
+        try:
+            with warnings.catch_warnings():
+                # Newer versions warn about python 2 when imported
+                warnings.simplefilter('ignore')
+                import cryptography.hazmat.backends
+                import cryptography.hazmat.primitives.ciphers
+            _HAVE_NATIVE_CIPHER = True
+        except ImportError:
+            _HAVE_NATIVE_CIPHER = False
+    return _HAVE_NATIVE_CIPHER
+
+
+class _AESCBCCipher(object):
+    def __init__(self, enc_key, enc_iv):
+        """
+        :param enc_key: hex string of the key
+        :param enc_iv: hex string of the IV
+        """
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import (algorithms,
+                                                            Cipher, modes)
+
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.bytes_in = 0
+        self.time_spent = 0.0
+        cipher = Cipher(algorithms.AES(binascii.unhexlify(enc_key)),
+                        modes.CBC(binascii.unhexlify(enc_iv)),
+                        backend=default_backend())
+        self._context = self._get_context(cipher)
+
+    def _get_context(self, cipher):
+        raise NotImplementedError()
+
+    def _log_throughput(self, verb):
+        if self.time_spent > 0:
+            self.log.debug('%s %i bytes in %.3f seconds (%.1f MiB/s)', verb,
+                           self.bytes_in, self.time_spent,
+                           self.bytes_in / self.time_spent / 2 ** 20)
+
+
+class AESCBCEncryptor(_AESCBCCipher):
+    """
+    Encrypt a stream of data with AES-128-CBC.  Pass it to update in
+    chunks of any size, then call finalize to pad and encrypt whatever is
+    left.  Chunks that are multiples of AES_BLOCK_SIZE go straight through
+    without any buffering.
+    """
+
+    def _get_context(self, cipher):
+        return cipher.encryptor()
+
+    def update(self, data):
+        start_time = time.time()
+        self.bytes_in += len(data)
+        ciphertext = self._context.update(data)
+        self.time_spent += time.time() - start_time
+        return ciphertext
+
+    def finalize(self):
+        # PKCS#7 padding always adds between 1 and AES_BLOCK_SIZE bytes
+        pad_len = AES_BLOCK_SIZE - self.bytes_in % AES_BLOCK_SIZE
+        ciphertext = (self._context.update(chr(pad_len) * pad_len) +
+                      self._context.finalize())
+        self._log_throughput('encrypted')
+        return ciphertext
+
+
+class AESCBCDecryptor(_AESCBCCipher):
+    """
+    Decrypt a stream of data that was encrypted with AES-128-CBC.  Pass
+    it to update in chunks of any size, then call finalize to obtain the
+    rest of the data with its padding removed.  The last block that
+    update decrypts is held back until more data arrive or finalize
+    is called, since it might contain padding.
+    """
+
+    def __init__(self, enc_key, enc_iv):
+        _AESCBCCipher.__init__(self, enc_key, enc_iv)
+        self.__last_block = ''
+
+    def _get_context(self, cipher):
+        return cipher.decryptor()
+
+    def update(self, data):
+        start_time = time.time()
+        self.bytes_in += len(data)
+        plaintext = self._context.update(data)
+        self.time_spent += time.time() - start_time
+        if not plaintext:
+            return ''
+        plaintext, self.__last_block = (
+            self.__last_block + plaintext[:-AES_BLOCK_SIZE],
+            plaintext[-AES_BLOCK_SIZE:])
+        return plaintext
+
+    def finalize(self):
+        try:
+            self._context.finalize()
+        except ValueError:
+            raise ValueError('bad decrypt: ciphertext is not a whole number '
+                             'of blocks')
+        last_block = self.__last_block
+        pad_len = ord(last_block[-1]) if last_block else 0
+        if (not 1 <= pad_len <= AES_BLOCK_SIZE or
+                last_block[-pad_len:] != chr(pad_len) * pad_len):
+            raise ValueError('bad decrypt: invalid padding')
+        self._log_throughput('decrypted')
+        return last_block[:-pad_len]
+
+
+def get_manifest_crypto():
+    """
+    Return the process-wide object to use for manifests' RSA operations.
+    It caches the keys and certificates it loads, so reusing it for many
+    manifests avoids reading and parsing the same files over and over.
+    """
+    global _MANIFEST_CRYPTO
+    with _MANIFEST_CRYPTO_LOCK:
+        if _MANIFEST_CRYPTO is None:
+            if have_native_cipher():
+                _MANIFEST_CRYPTO = NativeManifestCrypto()
+            else:
+                _MANIFEST_CRYPTO = OpenSSLManifestCrypto()
+        return _MANIFEST_CRYPTO
+
+
+class OpenSSLManifestCrypto(object):
+    """
+    RSA operations for manifests that run openssl for each operation.
+    Certificate fingerprints are cached.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+
+    def get_cert_fingerprint(self, cert_filename):
+        """
+        Return the hex-encoded SHA1 fingerprint of a certificate file
+        """
+        cache_key = _get_file_cache_key(cert_filename)
+        with self._lock:
+            if cache_key in self._fingerprints:
+                return self._fingerprints[cache_key]
+        fingerprint = self._get_cert_fingerprint(cert_filename)
+        with self._lock:
+            self._fingerprints[cache_key] = fingerprint
+        return fingerprint
+
+    def public_encrypt(self, content, cert_filename):
+        """
+        Encrypt content with the public key in a certificate file using
+        PKCS#1 v1.5 padding and return the hex-encoded result
+        """
+        popen = subprocess.Popen(['openssl', 'rsautl', '-encrypt', '-pkcs',
+                                  '-inkey', cert_filename, '-certin'],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (stdout, _) = popen.communicate(content)
+        return binascii.hexlify(stdout)
+
+    def private_decrypt_hex(self, hex_content, privkey_filename):
+        """
+        Decrypt hex-encoded content with the RSA private key in a file,
+        returning None if that fails
+        """
+        popen = subprocess.Popen(['openssl', 'rsautl', '-decrypt', '-pkcs',
+                                  '-inkey', privkey_filename],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (stdout, _) = popen.communicate(binascii.unhexlify(hex_content))
+        if popen.returncode != 0:
+            return None
+        return stdout
+
+    def sign_sha1(self, content, privkey_filename):
+        """
+        Sign the SHA1 digest of content with the RSA private key in a file
+        using PKCS#1 v1.5 padding and return the hex-encoded signature
+        """
+        digest = hashlib.sha1()
+        digest.update(content)
+        popen = subprocess.Popen(['openssl', 'pkeyutl', '-sign', '-inkey',
+                                  privkey_filename, '-pkeyopt', 'digest:sha1'],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (stdout, _) = popen.communicate(digest.digest())
+        return binascii.hexlify(stdout)
+
+    def _get_cert_fingerprint(self, cert_filename):
+        return euca2ools.bundle.util.get_cert_fingerprint(cert_filename)
+
+
+class NativeManifestCrypto(OpenSSLManifestCrypto):
+    """
+    RSA operations for manifests that use the cryptography library.
+    Each key and certificate file is read only once.  Anything the
+    library cannot load, such as a passphrase-protected key, is handed
+    to openssl instead.
+    """
+
+    def __init__(self):
+        OpenSSLManifestCrypto.__init__(self)
+        self._certs = {}
+        self._privkeys = {}
+
+    def public_encrypt(self, content, cert_filename):
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        cert = self.__load(self._certs, cert_filename, _load_cert)
+        if cert is None:
+            return OpenSSLManifestCrypto.public_encrypt(self, content,
+                                                        cert_filename)
+        return binascii.hexlify(
+            cert.public_key().encrypt(content, padding.PKCS1v15()))
+
+    def private_decrypt_hex(self, hex_content, privkey_filename):
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        privkey = self.__load(self._privkeys, privkey_filename,
+                              _load_privkey)
+        if privkey is None:
+            return OpenSSLManifestCrypto.private_decrypt_hex(
+                self, hex_content, privkey_filename)
+        try:
+            return privkey.decrypt(binascii.unhexlify(hex_content),
+                                   padding.PKCS1v15())
+        except ValueError:
+            return None
+
+    def sign_sha1(self, content, privkey_filename):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        privkey = self.__load(self._privkeys, privkey_filename,
+                              _load_privkey)
+        if privkey is None:
+            return OpenSSLManifestCrypto.sign_sha1(self, content,
+                                                   privkey_filename)
+        return binascii.hexlify(
+            privkey.sign(content, padding.PKCS1v15(), hashes.SHA1()))
+
+    def _get_cert_fingerprint(self, cert_filename):
+        from cryptography.hazmat.primitives import hashes
+
+        cert = self.__load(self._certs, cert_filename, _load_cert)
+        if cert is None:
+            return OpenSSLManifestCrypto._get_cert_fingerprint(
+                self, cert_filename)
+        return binascii.hexlify(cert.fingerprint(hashes.SHA1()))
+
+    def __load(self, cache, filename, loader):
+        cache_key = _get_file_cache_key(filename)
+        with self._lock:
+            if cache_key not in cache:
+                try:
+                    cache[cache_key] = loader(filename)
+                except (TypeError, ValueError) as err:
+                    # TypeError means it needs a passphrase
+                    self.log.debug('failed to load %s (%s); using openssl',
+                                   filename, err)
+                    cache[cache_key] = None
+            return cache[cache_key]
+
+
+_MANIFEST_CRYPTO = None
+_MANIFEST_CRYPTO_LOCK = threading.Lock()
+
+
+def _get_file_cache_key(filename):
+    # Notice when a file is replaced by something else with the same name
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+
+
+def _load_cert(cert_filename):
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+
+    with open(cert_filename) as cert_file:
+        return x509.load_pem_x509_certificate(cert_file.read(),
+                                              default_backend())
+
+
+def _load_privkey(privkey_filename):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+
+    with open(privkey_filename) as privkey_file:
+        return serialization.load_pem_private_key(
+            privkey_file.read(), password=None, backend=default_backend())
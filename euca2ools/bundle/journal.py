@@ -0,0 +1,128 @@
+# Copyright (c) 2013-2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import os
+import tempfile
+
+
+class BundleUploadJournal(object):
+    """
+    A record of a bundle upload's progress that lets an interrupted upload
+    pick up where it left off.
+
+    The journal holds the bundle's encryption key and IV, how it was
+    compressed, and the key and SHA1 digest of each part that has been
+    uploaded so far.  Bundling the same image again with the same key,
+    IV, and compressor produces the same parts, so parts whose digests
+    match the journal do not need to be uploaded again as long as they
+    are still on the server.  The journal is rewritten atomically every
+    time a part finishes uploading or is forgotten.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename, enc_key, enc_iv, image_size, part_size,
+                 key_prefix, bundle_engine=None, compress_threads=None,
+                 compressor=None):
+        self.filename = filename
+        self.enc_key = enc_key
+        self.enc_iv = enc_iv
+        self.image_size = image_size
+        self.part_size = part_size
+        self.key_prefix = key_prefix
+        self.bundle_engine = bundle_engine
+        self.compress_threads = compress_threads
+        self.compressor = compressor
+        self.uploaded_parts = {}  # key -> (hexdigest, size)
+
+    @classmethod
+    def read_from_file(cls, filename):
+        with open(filename) as journal_file:
+            try:
+                data = json.load(journal_file)
+            except ValueError:
+                raise ValueError("bundle journal '{0}' is corrupt"
+                                 .format(filename))
+        if data.get('version') != cls.VERSION:
+            raise ValueError("bundle journal '{0}' has unsupported version "
+                             "{1}".format(filename, data.get('version')))
+        journal = cls(filename, data['enc_key'], data['enc_iv'],
+                      data['image_size'], data['part_size'],
+                      data['key_prefix'],
+                      bundle_engine=data.get('bundle_engine'),
+                      compress_threads=data.get('compress_threads'),
+                      compressor=data.get('compressor'))
+        journal.uploaded_parts = dict(
+            (part['key'], (part['sha1'], part['size']))
+            for part in data['parts'])
+        return journal
+
+    @property
+    def bytes_uploaded(self):
+        return sum(size for _, size in self.uploaded_parts.values())
+
+    def has_uploaded_part(self, part, key):
+        return key in self.uploaded_parts and \
+            self.uploaded_parts[key][0] == part.hexdigest
+
+    def record_uploaded_part(self, part, key):
+        self.uploaded_parts[key] = (part.hexdigest, part.size)
+        self.save()
+
+    def forget_uploaded_parts(self, keys):
+        for key in keys:
+            self.uploaded_parts.pop(key, None)
+        self.save()
+
+    def save(self):
+        data = {'version': self.VERSION,
+                'enc_key': self.enc_key,
+                'enc_iv': self.enc_iv,
+                'image_size': self.image_size,
+                'part_size': self.part_size,
+                'key_prefix': self.key_prefix,
+                'bundle_engine': self.bundle_engine,
+                'compress_threads': self.compress_threads,
+                'compressor': self.compressor,
+                'bytes_uploaded': self.bytes_uploaded,
+                'parts': [{'key': key, 'sha1': hexdigest, 'size': size}
+                          for key, (hexdigest, size)
+                          in sorted(self.uploaded_parts.items())]}
+        fd, temp_filename = tempfile.mkstemp(
+            prefix='.journal-', dir=os.path.dirname(self.filename) or '.')
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump(data, temp_file, indent=2, sort_keys=True)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.rename(temp_filename, self.filename)
+        except:
+            os.remove(temp_filename)
+            raise
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
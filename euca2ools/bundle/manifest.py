@@ -23,23 +23,23 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import binascii
-import hashlib
 import logging
 import os.path
-import subprocess
 
 import lxml.etree
 import lxml.objectify
 
 import euca2ools.bundle
+import euca2ools.bundle.crypto
 
 
 class BundleManifest(object):
-    def __init__(self, loglevel=None):
+    def __init__(self, loglevel=None, crypto=None):
         self.log = logging.getLogger(self.__class__.__name__)
         if loglevel is not None:
             self.log.level = loglevel
+        # Does the RSA work; see euca2ools.bundle.crypto
+        self.crypto = crypto or euca2ools.bundle.crypto.get_manifest_crypto()
         self.image_arch = None
         self.kernel_id = None
         self.ramdisk_id = None
@@ -58,29 +58,40 @@ class BundleManifest(object):
         self.image_parts = []
 
     @classmethod
-    def read_from_file(cls, manifest_filename, privkey_filename=None):
+    def read_from_file(cls, manifest_filename, privkey_filename=None,
+                       crypto=None):
         with open(manifest_filename) as manifest_fileobj:
-            return cls.read_from_fileobj(manifest_fileobj, privkey_filename)
+            return cls.read_from_fileobj(manifest_fileobj, privkey_filename,
+                                         crypto=crypto)
 
     @classmethod
-    def read_from_fileobj(cls, manifest_fileobj, privkey_filename=None):
+    def read_from_fileobj(cls, manifest_fileobj, privkey_filename=None,
+                          crypto=None):
         xml = lxml.objectify.parse(manifest_fileobj).getroot()
-        manifest = cls()
+        manifest = cls(crypto=crypto)
         mconfig = xml.machine_configuration
         manifest.image_arch = mconfig.architecture.text.strip()
         if hasattr(mconfig, 'kernel_id'):
             manifest.kernel_id = mconfig.kernel_id.text.strip()
         if hasattr(mconfig, 'ramdisk_id'):
             manifest.ramdisk_id = mconfig.ramdisk_id.text.strip()
-        if hasattr(mconfig, 'block_device_mappings'):
-            for xml_mapping in mconfig.block_device_mappings.iter(
-                    tag='block_device_mapping'):
-                device = xml_mapping.device.text.strip()
-                virtual = xml_mapping.virtual.text.strip()
-                manifest.block_device_mappings[virtual] = device
-        if hasattr(mconfig, 'productcodes'):
-            for xml_pcode in mconfig.productcodes.iter(tag='product_code'):
-                manifest.product_codes.append(xml_pcode.text.strip())
+        # dump_to_str writes block_device_mapping/mapping and
+        # product_codes/product_code, as EC2 does.  Also accept the
+        # element names that older versions of this method looked for.
+        for bdm_tag, mapping_tag in (
+                ('block_device_mapping', 'mapping'),
+                ('block_device_mappings', 'block_device_mapping')):
+            if hasattr(mconfig, bdm_tag):
+                for xml_mapping in getattr(mconfig, bdm_tag).iter(
+                        tag=mapping_tag):
+                    device = xml_mapping.device.text.strip()
+                    virtual = xml_mapping.virtual.text.strip()
+                    manifest.block_device_mappings[virtual] = device
+        for pcodes_tag in ('product_codes', 'productcodes'):
+            if hasattr(mconfig, pcodes_tag):
+                for xml_pcode in getattr(mconfig, pcodes_tag).iter(
+                        tag='product_code'):
+                    manifest.product_codes.append(xml_pcode.text.strip())
         manifest.image_name = xml.image.name.text.strip()
         manifest.account_id = xml.image.user.text.strip()
         manifest.image_type = xml.image.type.text.strip()
@@ -92,18 +103,21 @@ class BundleManifest(object):
             try:
                 manifest.enc_key = _decrypt_hex(
                     xml.image.user_encrypted_key.text.strip(),
-                    privkey_filename)
+                    privkey_filename, manifest.crypto)
             except (AttributeError, ValueError):
                 manifest.enc_key = _decrypt_hex(
-                    xml.image.ec2_encrypted_key.text.strip(), privkey_filename)
+                    xml.image.ec2_encrypted_key.text.strip(),
+                    privkey_filename, manifest.crypto)
             manifest.enc_algorithm = xml.image.user_encrypted_key.get(
                 'algorithm')
             try:
                 manifest.enc_iv = _decrypt_hex(
-                    xml.image.user_encrypted_iv.text.strip(), privkey_filename)
+                    xml.image.user_encrypted_iv.text.strip(),
+                    privkey_filename, manifest.crypto)
             except (AttributeError, ValueError):
                 manifest.enc_iv = _decrypt_hex(
-                    xml.image.ec2_encrypted_iv.text.strip(), privkey_filename)
+                    xml.image.ec2_encrypted_iv.text.strip(),
+                    privkey_filename, manifest.crypto)
 
         manifest.image_parts = [None] * int(xml.image.parts.get('count'))
         for xml_part in xml.image.parts.iter(tag='part'):
@@ -122,7 +136,7 @@ class BundleManifest(object):
             raise ValueError('enc_key must not be None')
         if self.enc_iv is None:
             raise ValueError('enc_iv must not be None')
-        ec2_fp = euca2ools.bundle.util.get_cert_fingerprint(ec2_cert_filename)
+        ec2_fp = self.crypto.get_cert_fingerprint(ec2_cert_filename)
         self.log.info('creating manifest for EC2 service with fingerprint %s',
                       ec2_fp)
         self.log.debug('EC2 certificate:  %s', ec2_cert_filename)
@@ -137,7 +151,7 @@ class BundleManifest(object):
         # Our version
         xml.bundler = None
         xml.bundler.name = 'euca2ools'
-        xml.bundler.version = euca2ools.__version__
+        xml.bundler.version = euca2ools.get_version()
         xml.bundler.release = 0
 
         # Target hardware
@@ -197,21 +211,21 @@ class BundleManifest(object):
         assert self.enc_key is not None
         assert self.enc_iv is not None
         assert self.enc_algorithm is not None
-        xml.image.ec2_encrypted_key = _public_encrypt(self.enc_key,
-                                                      ec2_cert_filename)
+        xml.image.ec2_encrypted_key = self.crypto.public_encrypt(
+            self.enc_key, ec2_cert_filename)
         xml.image.ec2_encrypted_key.set('algorithm', self.enc_algorithm)
         if user_cert_filename:
-            xml.image.user_encrypted_key = _public_encrypt(self.enc_key,
-                                                           user_cert_filename)
+            xml.image.user_encrypted_key = self.crypto.public_encrypt(
+                self.enc_key, user_cert_filename)
         else:
             # Absence results in 400 (InvalidManifest)
             xml.image.user_encrypted_key = None
         xml.image.user_encrypted_key.set('algorithm', self.enc_algorithm)
-        xml.image.ec2_encrypted_iv = _public_encrypt(self.enc_iv,
-                                                     ec2_cert_filename)
+        xml.image.ec2_encrypted_iv = self.crypto.public_encrypt(
+            self.enc_iv, ec2_cert_filename)
         if user_cert_filename:
-            xml.image.user_encrypted_iv = _public_encrypt(self.enc_iv,
-                                                          user_cert_filename)
+            xml.image.user_encrypted_iv = self.crypto.public_encrypt(
+                self.enc_iv, user_cert_filename)
         else:
             # Absence results in 400 (InvalidManifest)
             xml.image.user_encrypted_iv = None
@@ -237,7 +251,7 @@ class BundleManifest(object):
         if privkey_filename:
             to_sign = (lxml.etree.tostring(xml.machine_configuration) +
                        lxml.etree.tostring(xml.image))
-            signature = _rsa_sha1_sign(to_sign, privkey_filename)
+            signature = self.crypto.sign_sha1(to_sign, privkey_filename)
         else:
             # Absence yields 400 (InvalidManifest)
             # Empty contents yield 500 (InternalError)
@@ -261,37 +275,16 @@ class BundleManifest(object):
             pretty_print=pretty_print))
 
 
-def _decrypt_hex(hex_encrypted_key, privkey_filename):
-    popen = subprocess.Popen(['openssl', 'rsautl', '-decrypt', '-pkcs',
-                              '-inkey', privkey_filename],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    binary_encrypted_key = binascii.unhexlify(hex_encrypted_key)
-    (decrypted_key, _) = popen.communicate(binary_encrypted_key)
+def _decrypt_hex(hex_encrypted_key, privkey_filename, crypto):
+    decrypted_key = crypto.private_decrypt_hex(hex_encrypted_key,
+                                               privkey_filename)
     try:
         # Make sure it might actually be an encryption key.
         # This isn't perfect, but it's still better than nothing.
         int(decrypted_key, 16)
         return decrypted_key
-    except ValueError:
+    except (TypeError, ValueError):
         pass
     raise ValueError("Failed to decrypt the bundle's encryption key.  "
                      "Ensure the key supplied matches the one used for "
                      "bundling.")
-
-
-def _public_encrypt(content, cert_filename):
-    popen = subprocess.Popen(['openssl', 'rsautl', '-encrypt', '-pkcs',
-                              '-inkey', cert_filename, '-certin'],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    (stdout, _) = popen.communicate(content)
-    return binascii.hexlify(stdout)
-
-
-def _rsa_sha1_sign(content, privkey_filename):
-    digest = hashlib.sha1()
-    digest.update(content)
-    popen = subprocess.Popen(['openssl', 'pkeyutl', '-sign', '-inkey',
-                              privkey_filename, '-pkeyopt', 'digest:sha1'],
-                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    (stdout, _) = popen.communicate(digest.digest())
-    return binascii.hexlify(stdout)
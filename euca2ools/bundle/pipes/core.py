@@ -23,18 +23,48 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
+import distutils.spawn
 import hashlib
 import multiprocessing
+import multiprocessing.pool
 import shutil
 import subprocess
 import tarfile
+import zlib
 
+import euca2ools.bundle.crypto
 import euca2ools.bundle.util
 from euca2ools.bundle.util import close_all_fds
 
 
+# Amount of uncompressed data each thread of a parallel gzip compressor
+# compresses into a gzip member of its own
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+
+def get_bundle_compressor(bundle_engine='pipeline', compress_threads=None):
+    """
+    Return the name of the compressor that bundling with a given engine
+    and number of threads uses:  "pigz", "gzip", "zlib", or
+    "zlib-parallel".  These all write different compressed bytes for
+    the same input, so bundles they create differ even when they are
+    encrypted with the same key and IV.
+    """
+    if compress_threads is None:
+        compress_threads = multiprocessing.cpu_count()
+    if (bundle_engine != 'inprocess' and
+            distutils.spawn.find_executable('pigz')):
+        return 'pigz'
+    if compress_threads > 1:
+        return 'zlib-parallel'
+    if bundle_engine != 'inprocess':
+        return 'gzip'
+    return 'zlib'
+
+
 def create_bundle_pipeline(infile, outfile, enc_key, enc_iv, tarinfo,
-                           debug=False):
+                           compress_threads=None, debug=False):
     pids = []
 
     # infile -> tar
@@ -60,24 +90,54 @@ def create_bundle_pipeline(infile, outfile, enc_key, enc_iv, tarinfo,
     digest_result_w.close()
 
     # sha1sum -> gzip
+    # -n keeps the name and mtime of the input pipe out of the gzip
+    # header so bundling the same image again yields the same bundle.
+    pigz_args = ['pigz', '-c', '-n']
+    if compress_threads:
+        pigz_args.extend(('-p', str(compress_threads)))
     try:
-        gzip = subprocess.Popen(['pigz', '-c'], stdin=digest_out_r,
+        gzip = subprocess.Popen(pigz_args, stdin=digest_out_r,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
+        gzip_out_r = gzip.stdout
+        pids.append(gzip.pid)
     except OSError:
-        gzip = subprocess.Popen(['gzip', '-c'], stdin=digest_out_r,
-                                stdout=subprocess.PIPE, close_fds=True,
-                                bufsize=-1)
+        if compress_threads is None:
+            compress_threads = multiprocessing.cpu_count()
+        if (compress_threads > 1 and
+                euca2ools.bundle.crypto.have_native_cipher()):
+            # Compress and encrypt in the same process
+            gzip_out_r = None
+            gzip_p = multiprocessing.Process(
+                target=_compress_pipe_in_parallel,
+                args=(digest_out_r, outfile, compress_threads),
+                kwargs={'enc_key': enc_key, 'enc_iv': enc_iv,
+                        'debug': debug})
+            gzip_p.start()
+            pids.append(gzip_p.pid)
+        elif compress_threads > 1:
+            gzip_out_r, gzip_out_w = \
+                euca2ools.bundle.util.open_pipe_fileobjs()
+            gzip_p = multiprocessing.Process(
+                target=_compress_pipe_in_parallel,
+                args=(digest_out_r, gzip_out_w, compress_threads),
+                kwargs={'debug': debug})
+            gzip_p.start()
+            pids.append(gzip_p.pid)
+            gzip_out_w.close()
+        else:
+            gzip = subprocess.Popen(['gzip', '-c', '-n'], stdin=digest_out_r,
+                                    stdout=subprocess.PIPE, close_fds=True,
+                                    bufsize=-1)
+            gzip_out_r = gzip.stdout
+            pids.append(gzip.pid)
     digest_out_r.close()
-    pids.append(gzip.pid)
 
     # gzip -> openssl
-    openssl = subprocess.Popen(['openssl', 'enc', '-e', '-aes-128-cbc',
-                                '-K', enc_key, '-iv', enc_iv],
-                               stdin=gzip.stdout, stdout=outfile,
-                               close_fds=True, bufsize=-1)
-    gzip.stdout.close()
-    pids.append(openssl.pid)
+    if gzip_out_r is not None:
+        pids.append(_start_cipher(gzip_out_r, outfile, enc_key, enc_iv,
+                                  debug=debug))
+        gzip_out_r.close()
 
     # Make sure something calls wait() on every child process
     for pid in pids:
@@ -87,6 +147,48 @@ def create_bundle_pipeline(infile, outfile, enc_key, enc_iv, tarinfo,
     return digest_result_r
 
 
+def create_inprocess_bundle_pipeline(infile, outfile, enc_key, enc_iv,
+                                     tarinfo, compress_threads=None,
+                                     debug=False):
+    """
+    Like create_bundle_pipeline, but instead of chaining separate tar,
+    digest, and gzip processes together with pipes, do all of that work
+    in a single child process that reads infile in large chunks.  The
+    encryption step happens in that process as well when the
+    cryptography library is available, and in a separate openssl
+    process otherwise.
+
+    The tar stream this creates, and thus the digest that goes into the
+    bundle's manifest, is identical to the one create_bundle_pipeline
+    creates.  The compressed bytes come from zlib rather than gzip or
+    pigz, so they can differ the same way gzip's and pigz's do.
+
+    :param infile: file obj to read the image from
+    :param outfile: file obj to write the bundled image to
+    :param enc_key: hex string of the key to encrypt the bundle with
+    :param enc_iv: hex string of the IV to encrypt the bundle with
+    :param tarinfo: TarInfo object describing the image
+    :param compress_threads: number of threads to compress with (default:
+        one per CPU)
+    :param debug: boolean used in exception handling
+    :returns multiprocess pipe to read the tar stream's sha1 digest from
+    """
+    digest_result_r, digest_result_w = multiprocessing.Pipe(duplex=False)
+    bundle_p = multiprocessing.Process(
+        target=_create_bundle_in_process,
+        args=(infile, outfile, enc_key, enc_iv, tarinfo, digest_result_w),
+        kwargs={'compress_threads': compress_threads, 'debug': debug})
+    bundle_p.start()
+    infile.close()
+    digest_result_w.close()
+
+    # Make sure something calls wait() on the child process
+    euca2ools.bundle.util.waitpid_in_thread(bundle_p.pid)
+
+    # Return the connection the caller can use to obtain the final digest
+    return digest_result_r
+
+
 def create_unbundle_pipeline(infile, outfile, enc_key, enc_iv, debug=False):
     """
     Create a pipeline to perform the unbundle operation on infile input.
@@ -100,24 +202,23 @@ def create_unbundle_pipeline(infile, outfile, enc_key, enc_iv, debug=False):
     pids = []
 
     # infile -> openssl
-    openssl = subprocess.Popen(['openssl', 'enc', '-d', '-aes-128-cbc',
-                                '-K', enc_key, '-iv', enc_iv],
-                               stdin=infile, stdout=subprocess.PIPE,
-                               close_fds=True, bufsize=-1)
-    pids.append(openssl.pid)
+    openssl_out_r, openssl_out_w = euca2ools.bundle.util.open_pipe_fileobjs()
+    pids.append(_start_cipher(infile, openssl_out_w, enc_key, enc_iv,
+                              decrypt=True, debug=debug))
     infile.close()
+    openssl_out_w.close()
 
     # openssl -> gzip
     try:
-        gzip = subprocess.Popen(['pigz', '-c', '-d'], stdin=openssl.stdout,
+        gzip = subprocess.Popen(['pigz', '-c', '-d'], stdin=openssl_out_r,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
     except OSError:
-        gzip = subprocess.Popen(['gzip', '-c', '-d'], stdin=openssl.stdout,
+        gzip = subprocess.Popen(['gzip', '-c', '-d'], stdin=openssl_out_r,
                                 stdout=subprocess.PIPE, close_fds=True,
                                 bufsize=-1)
     pids.append(gzip.pid)
-    openssl.stdout.close()
+    openssl_out_r.close()
 
     # gzip -> sha1sum
     digest_out_r, digest_out_w = euca2ools.bundle.util.open_pipe_fileobjs()
@@ -232,6 +333,289 @@ def _create_tarball_from_stream(infile, outfile, tarinfo, debug=False):
         outfile.close()
 
 
+def _create_bundle_in_process(infile, outfile, enc_key, enc_iv, tarinfo,
+                              digest_out_pipe_w, compress_threads=None,
+                              debug=False):
+    """
+    Write a tarball containing tarinfo.size bytes of infile to a gzip
+    compressor and then to openssl for encryption, calculating the tar
+    stream's SHA1 digest along the way.  When that is done, send the
+    digest in hex form to digest_out_pipe_w and exit.
+
+    This produces the same tar stream that tarfile does in
+    _create_tarball_from_stream.
+    """
+    close_all_fds(except_fds=[infile, outfile, digest_out_pipe_w])
+    digest = hashlib.sha1()
+    if euca2ools.bundle.crypto.have_native_cipher():
+        openssl = None
+        compressed_out = _CipherWriter(
+            outfile, euca2ools.bundle.crypto.AESCBCEncryptor(enc_key, enc_iv))
+    else:
+        openssl = subprocess.Popen(['openssl', 'enc', '-e', '-aes-128-cbc',
+                                    '-K', enc_key, '-iv', enc_iv],
+                                   stdin=subprocess.PIPE, stdout=outfile,
+                                   close_fds=True, bufsize=-1)
+        outfile.close()
+        compressed_out = openssl.stdin
+    if compress_threads is None:
+        compress_threads = multiprocessing.cpu_count()
+    if compress_threads > 1:
+        compressor = _ParallelGzipWriter(compressed_out, compress_threads)
+    else:
+        compressor = _GzipWriter(compressed_out)
+
+    def write_to_tarball(data):
+        digest.update(data)
+        compressor.write(data)
+
+    try:
+        header = tarinfo.tobuf()
+        write_to_tarball(header)
+        bytes_left = tarinfo.size
+        while bytes_left > 0:
+            chunk = infile.read(min(bytes_left, euca2ools.LARGE_BUFSIZE))
+            if not chunk:
+                raise IOError('end of file reached')
+            write_to_tarball(chunk)
+            bytes_left -= len(chunk)
+        infile.close()
+        # Pad the member's data to a whole number of blocks, then add the
+        # end-of-archive marker and pad that to a whole record, just like
+        # TarFile.addfile and TarFile.close do.
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            write_to_tarball(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        write_to_tarball(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        offset = len(header) + (blocks + 2) * tarfile.BLOCKSIZE
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder > 0:
+            write_to_tarball(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        compressor.close()
+        compressed_out.close()
+        if openssl is not None:
+            openssl.wait()
+        digest_out_pipe_w.send(digest.hexdigest())
+    except IOError:
+        # HACK
+        if not debug:
+            return
+        raise
+    finally:
+        infile.close()
+        compressor.terminate()
+        if openssl is not None and not openssl.stdin.closed:
+            openssl.stdin.close()
+        outfile.close()
+        digest_out_pipe_w.close()
+
+
+def _start_cipher(infile, outfile, enc_key, enc_iv, decrypt=False,
+                  debug=False):
+    """
+    Start a process that encrypts (or decrypts) infile with AES-128-CBC
+    and writes the result to outfile, and return its PID.  This runs the
+    cipher in process when the cryptography library is available, and
+    runs openssl otherwise.
+    """
+    if euca2ools.bundle.crypto.have_native_cipher():
+        crypt_p = multiprocessing.Process(
+            target=_crypt_pipe, args=(infile, outfile, enc_key, enc_iv),
+            kwargs={'decrypt': decrypt, 'debug': debug})
+        crypt_p.start()
+        return crypt_p.pid
+    openssl = subprocess.Popen(['openssl', 'enc',
+                                ('-d' if decrypt else '-e'), '-aes-128-cbc',
+                                '-K', enc_key, '-iv', enc_iv],
+                               stdin=infile, stdout=outfile,
+                               close_fds=True, bufsize=-1)
+    return openssl.pid
+
+
+def _crypt_pipe(infile, outfile, enc_key, enc_iv, decrypt=False,
+                debug=False):
+    """
+    Read data from infile, encrypt or decrypt it with AES-128-CBC, and
+    write the result to outfile.
+
+    :param infile: file obj providing input
+    :param outfile: file obj destination for output
+    :param enc_key: hex string of the key
+    :param enc_iv: hex string of the IV
+    :param decrypt: decrypt instead of encrypting
+    :param debug: boolean used in exception handling
+    """
+    close_all_fds([infile, outfile])
+    if decrypt:
+        cipher = euca2ools.bundle.crypto.AESCBCDecryptor(enc_key, enc_iv)
+    else:
+        cipher = euca2ools.bundle.crypto.AESCBCEncryptor(enc_key, enc_iv)
+    try:
+        while True:
+            chunk = infile.read(euca2ools.LARGE_BUFSIZE)
+            if chunk:
+                outfile.write(cipher.update(chunk))
+            else:
+                break
+        outfile.write(cipher.finalize())
+    except IOError:
+        # HACK
+        if not debug:
+            return
+        raise
+    finally:
+        infile.close()
+        outfile.close()
+
+
+def _compress_pipe_in_parallel(infile, outfile, threads, enc_key=None,
+                               enc_iv=None, debug=False):
+    """
+    Read data from infile and write it to outfile as a gzip stream,
+    compressing it with a pool of threads.  If a key and IV are given,
+    also encrypt the gzip stream with AES-128-CBC on its way out.
+
+    :param infile: file obj providing input to compress
+    :param outfile: file obj destination for compressed output
+    :param threads: number of threads to compress with
+    :param enc_key: hex string of the key to encrypt with, if any
+    :param enc_iv: hex string of the IV to encrypt with, if any
+    :param debug: boolean used in exception handling
+    """
+    close_all_fds([infile, outfile])
+    if enc_key is not None:
+        compressed_out = _CipherWriter(
+            outfile, euca2ools.bundle.crypto.AESCBCEncryptor(enc_key, enc_iv))
+    else:
+        compressed_out = outfile
+    compressor = _ParallelGzipWriter(compressed_out, threads)
+    try:
+        while True:
+            chunk = infile.read(euca2ools.LARGE_BUFSIZE)
+            if chunk:
+                compressor.write(chunk)
+            else:
+                break
+        compressor.close()
+        compressed_out.close()
+    except IOError:
+        # HACK
+        if not debug:
+            return
+        raise
+    finally:
+        compressor.terminate()
+        infile.close()
+        outfile.close()
+
+
+def _compress_gzip_member(data):
+    # wbits > 15 makes zlib add a gzip header and trailer
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _CipherWriter(object):
+    """
+    File-like object that runs everything written to it through a cipher
+    from euca2ools.bundle.crypto and writes the result to outfile.
+    Calling close() finalizes the cipher and closes outfile.
+    """
+
+    def __init__(self, outfile, cipher):
+        self.outfile = outfile
+        self.cipher = cipher
+        self.closed = False
+
+    def write(self, data):
+        self.outfile.write(self.cipher.update(data))
+
+    def close(self):
+        if not self.closed:
+            self.outfile.write(self.cipher.finalize())
+            self.outfile.close()
+            self.closed = True
+
+
+class _GzipWriter(object):
+    """
+    File-like object that gzip-compresses everything written to it and
+    writes the result to outfile.  Calling close() finishes the gzip
+    stream, but leaves outfile open.
+    """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        # wbits > 15 makes zlib add a gzip header and trailer
+        self.__compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self.outfile.write(self.__compressor.compress(data))
+
+    def close(self):
+        self.outfile.write(self.__compressor.flush())
+
+    def terminate(self):
+        pass
+
+
+class _ParallelGzipWriter(object):
+    """
+    File-like object that splits everything written to it into blocks of
+    COMPRESSION_BLOCK_SIZE bytes, compresses each block into a separate
+    gzip member using a pool of threads, and writes the members to outfile
+    in order.  The concatenated members form a single gzip stream that
+    gzip -d and pigz -d decompress as a whole.
+
+    Since zlib releases the GIL while it compresses, this scales with the
+    number of threads.  Only a couple of blocks per thread are in flight at
+    a time, so memory use does not depend on the size of the input.
+    """
+
+    def __init__(self, outfile, threads):
+        self.outfile = outfile
+        self.__pool = multiprocessing.pool.ThreadPool(threads)
+        self.__max_pending = threads * 2
+        self.__pending = collections.deque()
+        self.__buf = []
+        self.__buflen = 0
+
+    def write(self, data):
+        self.__buf.append(data)
+        self.__buflen += len(data)
+        if self.__buflen >= COMPRESSION_BLOCK_SIZE:
+            data = ''.join(self.__buf)
+            offset = 0
+            while len(data) - offset >= COMPRESSION_BLOCK_SIZE:
+                self.__submit(
+                    data[offset:offset + COMPRESSION_BLOCK_SIZE])
+                offset += COMPRESSION_BLOCK_SIZE
+            self.__buf = [data[offset:]]
+            self.__buflen = len(data) - offset
+
+    def close(self):
+        if self.__buflen > 0:
+            self.__submit(''.join(self.__buf))
+            self.__buf = []
+            self.__buflen = 0
+        while self.__pending:
+            self.outfile.write(self.__pending.popleft().get())
+        self.__pool.close()
+        self.__pool.join()
+
+    def terminate(self):
+        self.__pool.terminate()
+
+    def __submit(self, block):
+        if len(self.__pending) >= self.__max_pending:
+            self.outfile.write(self.__pending.popleft().get())
+        self.__pending.append(
+            self.__pool.apply_async(_compress_gzip_member, (block,)))
+
+
 def _extract_from_tarball_stream(infile, outfile, debug=False):
     """
     Perform tar extract on infile and write to outfile
@@ -23,6 +23,8 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import ctypes
+import ctypes.util
 import hashlib
 import itertools
 import multiprocessing
@@ -42,13 +44,16 @@ def create_bundle_part_deleter(in_mpconn, out_mpconn=None):
 
 
 def create_bundle_part_writer(infile, part_prefix, part_size,
-                              part_write_sem=None, debug=False):
+                              part_write_sem=None, debug=False,
+                              bufsize=euca2ools.LARGE_BUFSIZE,
+                              preallocate=True):
     partinfo_result_r, partinfo_result_w = multiprocessing.Pipe(duplex=False)
 
     writer_p = multiprocessing.Process(
         target=_write_parts,
         args=(infile, part_prefix, part_size, partinfo_result_w),
-        kwargs={'part_write_sem': part_write_sem, 'debug': debug})
+        kwargs={'part_write_sem': part_write_sem, 'debug': debug,
+                'bufsize': bufsize, 'preallocate': preallocate})
     writer_p.start()
     partinfo_result_w.close()
     infile.close()
@@ -115,7 +120,8 @@ def _aggregate_mpconn_items(in_mpconn, result_mpconn, out_mpconn=None,
 
 
 def _write_parts(infile, part_prefix, part_size, partinfo_mpconn,
-                 part_write_sem=None, debug=False):
+                 part_write_sem=None, debug=False,
+                 bufsize=euca2ools.LARGE_BUFSIZE, preallocate=True):
     except_fds = [infile, partinfo_mpconn]
     if part_write_sem is not None and sys.platform == 'darwin':
         # When I ran close_all_fds on OS X and excluded only the FDs
@@ -138,12 +144,13 @@ def _write_parts(infile, part_prefix, part_size, partinfo_mpconn,
             part_write_sem.acquire()
         part_fname = '{0}.part.{1:02}'.format(part_prefix, part_no)
         part_digest = hashlib.sha1()
-        with open(part_fname, 'w') as part:
+        with open(part_fname, 'wb') as part:
+            preallocated = preallocate and _preallocate(part, part_size)
             bytes_written = 0
             bytes_to_write = part_size
             while bytes_to_write > 0:
                 try:
-                    chunk = infile.read(min(bytes_to_write, euca2ools.BUFSIZE))
+                    chunk = infile.read(min(bytes_to_write, bufsize))
                 except ValueError:  # I/O error on closed file
                     # HACK
                     if not debug:
@@ -157,11 +164,62 @@ def _write_parts(infile, part_prefix, part_size, partinfo_mpconn,
                     bytes_written += len(chunk)
                 else:
                     break
-            partinfo = euca2ools.bundle.BundlePart(
-                part_fname, part_digest.hexdigest(), 'SHA1', bytes_written)
-            partinfo_mpconn.send(partinfo)
+            if preallocated and bytes_written < part_size:
+                # Give back the space the last part did not need
+                part.truncate(bytes_written)
+        # Only announce the part once it is closed so whatever reads it
+        # does not see a partially-flushed file.
+        partinfo = euca2ools.bundle.BundlePart(
+            part_fname, part_digest.hexdigest(), 'SHA1', bytes_written)
+        partinfo_mpconn.send(partinfo)
         if bytes_written < part_size:
             # That's the last part
             infile.close()
             partinfo_mpconn.close()
             return
+
+
+def _preallocate(fileobj, size):
+    # Reserving each part's space up front keeps large parts from being
+    # fragmented as they are written.  This is only an optimization, so
+    # quietly do without it where it is unavailable or unsupported.
+    posix_fallocate = _get_posix_fallocate()
+    if posix_fallocate is None:
+        return False
+    try:
+        posix_fallocate(fileobj.fileno(), 0, size)
+    except OSError:
+        return False
+    return True
+
+
+def _get_posix_fallocate():
+    if not hasattr(_get_posix_fallocate, 'func'):
+        _get_posix_fallocate.func = (getattr(os, 'posix_fallocate', None) or
+                                     _find_libc_posix_fallocate())
+    return _get_posix_fallocate.func
+
+
+def _find_libc_posix_fallocate():
+    # Python 2's os module lacks posix_fallocate, so call libc's directly.
+    # The 64-bit variant takes 64-bit offsets even on 32-bit systems.
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+    except OSError:
+        return None
+    c_func = getattr(libc, 'posix_fallocate64', None)
+    if c_func is None:
+        return None
+    c_func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    c_func.restype = ctypes.c_int
+
+    def posix_fallocate(fd, offset, length):
+        # Unlike most libc functions this returns the error number
+        # instead of setting errno.
+        err = c_func(fd, offset, length)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return posix_fallocate
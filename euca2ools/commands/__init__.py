@@ -23,21 +23,30 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import atexit
 import glob
 import os.path
 import platform
 import sys
+import threading
 
 import requestbuilder
 import requests
+import requests.adapters
+import six
 
-from euca2ools import __version__
+from euca2ools import get_version
 
 
 DATADIR = '/usr/share/euca2ools'
 SYSCONFDIR = '/etc/euca2ools'
 USERCONFDIR = '~/.euca'
 
+# Commands that run many requests at once, such as multipart uploads
+# started by euca-s3-sync, can use more connections than requests' default
+# of 10 per host.
+DEFAULT_CONNECTION_POOL_SIZE = 32
+
 
 class Euca2ools(object):
     """
@@ -48,13 +57,18 @@ class Euca2ools(object):
                     os.path.join(SYSCONFDIR, 'conf.d', '*.ini'),
                     os.path.join(USERCONFDIR, '*.ini'))
 
+    # Services that talk to the same endpoint share a session, and with it
+    # a pool of connections, for as long as the process runs.
+    __sessions = {}
+    __sessions_lock = threading.Lock()
+
     def __init__(self):
         self.__user_agent = None
 
     # noinspection PyBroadException
     @staticmethod
     def format_version():
-        version_lines = ['euca2ools {0} (Newton)'.format(__version__)]
+        version_lines = ['euca2ools {0} (Newton)'.format(get_version())]
         try:
             if os.path.isfile('/etc/eucalyptus/eucalyptus-version'):
                 with open('/etc/eucalyptus/eucalyptus-version') as ver_file:
@@ -80,7 +94,7 @@ class Euca2ools(object):
 
     def get_user_agent(self):
         if self.__user_agent is None:
-            user_agent_bits = ['euca2ools/{0}'.format(__version__)]
+            user_agent_bits = ['euca2ools/{0}'.format(get_version())]
 
             tokens = []
             impl = platform.python_implementation()
@@ -115,3 +129,84 @@ class Euca2ools(object):
             user_agent_bits.append('requests/{0}'.format(requests.__version__))
             self.__user_agent = ' '.join(user_agent_bits)
         return self.__user_agent
+
+    @classmethod
+    def get_session(cls, service):
+        """
+        Return the requests session that a service should send requests
+        with.  Every service that uses the same endpoint with the same
+        session settings gets the same session, so requests created with
+        from_other and services created for other services' endpoints
+        re-use open connections instead of making new ones.
+        """
+        parsed_url = six.moves.urllib.parse.urlparse(service.endpoint)
+        key = (parsed_url.scheme, parsed_url.netloc,
+               tuple(sorted(service.session_args.items())))
+        with cls.__sessions_lock:
+            if key not in cls.__sessions:
+                if not cls.__sessions:
+                    atexit.register(cls.__log_connection_stats)
+                service.log.debug('creating session for %s://%s',
+                                  parsed_url.scheme, parsed_url.netloc)
+                cls.__sessions[key] = (cls.__create_session(service),
+                                       service.log)
+            return cls.__sessions[key][0]
+
+    @staticmethod
+    def __create_session(service):
+        pool_size = service.config.get_global_option('connection-pool-size')
+        if pool_size:
+            pool_size = int(pool_size)
+        else:
+            pool_size = DEFAULT_CONNECTION_POOL_SIZE
+        keep_alive = service.config.convert_to_bool(
+            service.config.get_global_option('keep-alive'), default=True)
+        session = requests.session()
+        for key, val in six.iteritems(service.session_args):
+            setattr(session, key, val)
+        # send_request handles retries to allow for re-signing
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size,
+                                                max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @classmethod
+    def __log_connection_stats(cls):
+        with cls.__sessions_lock:
+            sessions = list(cls.__sessions.values())
+        for session, log in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools[pool_key]
+                    log.debug('connection pool for %s:%s: %i requests over '
+                              '%i connections', pool.host, pool.port,
+                              pool.num_requests, pool.num_connections)
+
+
+class SharedSessionServiceMixin(object):
+    """
+    A service mixin that sends requests with the session that the suite
+    shares among all services that use the same endpoint.
+    """
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = Euca2ools.get_session(self)
+        return self._session
+
+    def send_request(self, method='GET', path=None, params=None, headers=None,
+                     data=None, files=None, auth=None):
+        response = super(SharedSessionServiceMixin, self).send_request(
+            method=method, path=path, params=params, headers=headers,
+            data=data, files=files, auth=auth)
+        if method in ('DELETE', 'HEAD', 'PUT'):
+            # Responses are streamed, so a connection goes back to the pool
+            # only after its response is read.  Nothing reads the (empty or
+            # small) responses to these, so read them now.
+            response.content  # pylint: disable=pointless-statement
+        return response
@@ -31,12 +31,13 @@ import requestbuilder.auth.aws
 import requestbuilder.service
 import requestbuilder.request
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class AutoScaling(requestbuilder.service.BaseService):
+class AutoScaling(SharedSessionServiceMixin,
+                  requestbuilder.service.BaseService):
     NAME = 'autoscaling'
     DESCRIPTION = 'Auto-scaling service'
     API_VERSION = '2011-01-01'
@@ -28,12 +28,12 @@ import requestbuilder.auth.aws
 import requestbuilder.request
 import requestbuilder.service
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import add_fake_region_name
 
 
-class Bootstrap(requestbuilder.service.BaseService):
+class Bootstrap(SharedSessionServiceMixin, requestbuilder.service.BaseService):
     # Also known as Empyrean
     NAME = 'bootstrap'
     DESCRIPTION = '[Eucalyptus only] Bootstrap service'
@@ -24,14 +24,17 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import multiprocessing
+import multiprocessing.pool
 import os.path
 import tarfile
 
 from requestbuilder import Arg
-from requestbuilder.exceptions import ClientError
+from requestbuilder.exceptions import ArgumentError, ClientError
 from requestbuilder.mixins import FileTransferProgressBarMixin
+import six
 
-from euca2ools.bundle.pipes.core import create_bundle_pipeline
+from euca2ools.bundle.journal import BundleUploadJournal
+from euca2ools.bundle.pipes.core import get_bundle_compressor
 from euca2ools.bundle.pipes.fittings import (create_bundle_part_deleter,
                                              create_bundle_part_writer,
                                              create_mpconn_aggregator)
@@ -41,6 +44,9 @@ from euca2ools.commands.bundle.mixins import (BundleCreatingMixin,
                                               BundleUploadingMixin)
 from euca2ools.commands.bootstrap import BootstrapRequest
 from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.headobject import HeadObject
+from euca2ools.commands.s3.listbucket import ListBucket
+from euca2ools.exceptions import AWSError
 from euca2ools.util import mkdtemp_for_large_files
 
 
@@ -52,7 +58,12 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
                 help='do not delete the bundle as it is being uploaded'),
             Arg('--max-pending-parts', type=int, default=2,
                 help='''pause the bundling process when more than this number
-                of parts are waiting to be uploaded (default: 2)''')]
+                of parts are waiting to be uploaded (default: 2)'''),
+            Arg('--resume', action='store_true', help='''resume an
+                interrupted upload of the same image to the same location,
+                skipping parts that were already uploaded and are still on
+                the server.  This requires -d/--destination to name the same
+                directory as the original attempt.''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -77,25 +88,46 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
         self.configure_bundle_creds()
         self.configure_bundle_properties()
         self.configure_bundle_output()
+        if self.args.get('resume'):
+            self.__load_journal()
         self.generate_encryption_keys()
 
     def main(self):
+        key_prefix = self.get_bundle_key_prefix()
         if self.args.get('destination'):
             path_prefix = os.path.join(self.args['destination'],
                                        self.args['prefix'])
             if not os.path.exists(self.args['destination']):
                 os.mkdir(self.args['destination'])
+            journal = self.args.get('journal')
+            if journal is None:
+                journal = BundleUploadJournal(
+                    self.__get_journal_filename(), self.args['enc_key'],
+                    self.args['enc_iv'], self.args['image_size'],
+                    self.args['part_size'], key_prefix,
+                    bundle_engine=self.args.get('bundle_engine'),
+                    compress_threads=self.args.get('compress_threads'),
+                    compressor=self.__get_compressor())
+                journal.save()
+            elif journal.key_prefix != key_prefix:
+                raise ArgumentError(
+                    'cannot resume uploading to {0}; the original upload '
+                    'went to {1}'.format(key_prefix, journal.key_prefix))
+            else:
+                self.__check_journaled_parts(journal)
+                self.log.info('resuming upload with %i bytes already '
+                              'uploaded', journal.bytes_uploaded)
         else:
             tempdir = mkdtemp_for_large_files(prefix='bundle-')
             path_prefix = os.path.join(tempdir, self.args['prefix'])
+            journal = None
         self.log.debug('bundle path prefix: %s', path_prefix)
 
-        key_prefix = self.get_bundle_key_prefix()
         self.ensure_dest_bucket_exists()
 
         # First create the bundle and upload it to the server
-        digest, partinfo = self.create_and_upload_bundle(path_prefix,
-                                                         key_prefix)
+        digest, partinfo = self.create_and_upload_bundle(
+            path_prefix, key_prefix, journal=journal)
 
         # All done; now build the manifest, write it to disk, and upload it.
         manifest = self.build_manifest(digest, partinfo)
@@ -108,6 +140,9 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
                                 show_progress=self.args.get('show_progress'))
         if not self.args.get('preserve_bundle', False):
             os.remove(manifest_filename)
+        if journal is not None:
+            # The upload is complete, so there is nothing left to resume
+            journal.remove()
 
         # Then we just inform the caller of all the files we wrote.
         # Manifests are returned in a tuple for future expansion, where we
@@ -126,9 +161,133 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
         if result['manifests'][0]['key'] is not None:
             print 'Uploaded', result['manifests'][0]['key']
 
-    def create_and_upload_bundle(self, path_prefix, key_prefix):
+    def __get_journal_filename(self):
+        return os.path.join(self.args['destination'],
+                            '{0}.upload-journal'.format(self.args['prefix']))
+
+    def __get_compressor(self):
+        return get_bundle_compressor(
+            bundle_engine=self.args.get('bundle_engine'),
+            compress_threads=self.args.get('compress_threads'))
+
+    def __load_journal(self):
+        if not self.args.get('destination'):
+            raise ArgumentError('argument --resume requires -d/--destination')
+        if self.args.get('enc_key') or self.args.get('enc_iv'):
+            raise ArgumentError('argument --resume may not be used with an '
+                                'explicit encryption key or IV')
+        journal_filename = self.__get_journal_filename()
+        if not os.path.isfile(journal_filename):
+            raise ArgumentError(
+                "argument --resume: no journal to resume from found at "
+                "'{0}'".format(journal_filename))
+        journal = BundleUploadJournal.read_from_file(journal_filename)
+        if journal.image_size != self.args['image_size']:
+            raise ArgumentError(
+                'argument --resume: image size ({0}) does not match that of '
+                'the interrupted upload ({1})'.format(
+                    self.args['image_size'], journal.image_size))
+        if journal.part_size != self.args['part_size']:
+            raise ArgumentError(
+                'argument --resume: part size ({0}) does not match that of '
+                'the interrupted upload ({1})'.format(
+                    self.args['part_size'], journal.part_size))
+        if self.args.get('compress_threads') is None:
+            self.args['compress_threads'] = journal.compress_threads
+        if journal.compressor is None:
+            self.log.warn('journal %s does not say how the interrupted '
+                          'upload was compressed; if this upload is '
+                          'compressed differently every part will be '
+                          'uploaded again', journal_filename)
+        elif journal.compressor != self.__get_compressor():
+            # Different compressors write different bytes, and CBC
+            # carries that difference into every part of the bundle.
+            raise ArgumentError(
+                'argument --resume: the interrupted upload was compressed '
+                'with {0} (--bundle-engine {1}, --compress-threads {2}), '
+                'but this one would be compressed with {3}, so none of its '
+                'parts would match.  Use the same options and compressor '
+                "as before, or remove '{4}' to start over.".format(
+                    journal.compressor, journal.bundle_engine,
+                    journal.compress_threads or 'default',
+                    self.__get_compressor(), journal_filename))
+        self.log.info('resuming from journal %s', journal_filename)
+        # Bundling again with the same key, IV, and compressor yields the
+        # same parts
+        self.args['enc_key'] = int(journal.enc_key, 16)
+        self.args['enc_iv'] = int(journal.enc_iv, 16)
+        self.args['journal'] = journal
+
+    def __check_journaled_parts(self, journal):
+        """
+        Make the journal forget parts that are no longer on the server
+        or do not have the size it recorded for them, such as when the
+        bucket was cleaned up after the interrupted upload, so they get
+        uploaded again.  This uses a listing of the bundle's prefix,
+        falling back to a HEAD request for each part if listing the
+        bucket is not allowed.
+        """
+        if not journal.uploaded_parts:
+            return
+        if self.args.get('upload_policy'):
+            # We won't have creds to sign our own requests
+            self.log.warn('using an upload policy; assuming the parts '
+                          'journal %s lists are still on the server',
+                          journal.filename)
+            return
+        list_req = ListBucket.from_other(self, paths=[journal.key_prefix])
+        bucket = journal.key_prefix.split('/', 1)[0]
+        try:
+            sizes = dict(('/'.join((bucket, obj['Key'])), int(obj['Size']))
+                         for obj in list_req.main().get('Contents', []))
+        except AWSError as err:
+            if err.code == 'NoSuchBucket':
+                sizes = {}
+            else:
+                self.log.info('failed to list uploaded parts (%s); '
+                              'checking each part instead', err.code)
+                sizes = self.__get_part_sizes_with_head(
+                    journal.uploaded_parts.keys())
+        missing_keys = [key for key, (_, size)
+                        in six.iteritems(journal.uploaded_parts)
+                        if sizes.get(key) != size]
+        if missing_keys:
+            self.log.warn('%i of %i parts in journal %s are missing from '
+                          'the server or have the wrong size; uploading '
+                          'them again', len(missing_keys),
+                          len(journal.uploaded_parts), journal.filename)
+            journal.forget_uploaded_parts(missing_keys)
+
+    def __get_part_sizes_with_head(self, keys):
+        pool = multiprocessing.pool.ThreadPool(self.get_upload_thread_count())
+        try:
+            results = [(key, pool.apply_async(self.__get_part_size, (key,)))
+                       for key in keys]
+            pool.close()
+            sizes = dict((key, result.get()) for key, result in results)
+            pool.join()
+            return sizes
+        except:
+            pool.terminate()
+            raise
+
+    def __get_part_size(self, key):
+        head_req = HeadObject.from_other(self, path=key)
+        try:
+            response = head_req.main()
+        except AWSError as err:
+            if err.status_code == 404:
+                return None
+            raise
+        return int(response.headers.get('Content-Length', -1))
+
+    def create_and_upload_bundle(self, path_prefix, key_prefix,
+                                 journal=None):
+        # Parts that are being uploaded are not waiting to be uploaded, so
+        # leave room for every upload thread to have one on top of those.
         part_write_sem = multiprocessing.Semaphore(
-            max(1, self.args['max_pending_parts']))
+            max(1, self.args['max_pending_parts']) +
+            self.get_upload_thread_count() - 1)
 
         # Fill out all the relevant info needed for a tarball
         tarinfo = tarfile.TarInfo(self.args['prefix'])
@@ -137,9 +296,8 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
         # disk --(bytes)-> bundler
         partwriter_in_r, partwriter_in_w = \
             euca2ools.bundle.util.open_pipe_fileobjs()
-        digest_result_mpconn = create_bundle_pipeline(
-            self.args['image'], partwriter_in_w, self.args['enc_key'],
-            self.args['enc_iv'], tarinfo, debug=self.debug)
+        digest_result_mpconn = self.open_bundle_pipeline(
+            self.args['image'], partwriter_in_w, tarinfo)
         partwriter_in_w.close()
 
         # bundler --(bytes)-> part writer
@@ -179,7 +337,8 @@ class BundleAndUploadImage(S3Request, BundleCreatingMixin,
                 bundle_partinfo_mpconn, key_prefix,
                 partinfo_out_mpconn=uploaded_partinfo_mpconn_w,
                 part_write_sem=part_write_sem,
-                show_progress=self.args.get('show_progress'))
+                show_progress=self.args.get('show_progress'),
+                journal=journal)
         finally:
             # Make sure the writer gets a chance to exit
             part_write_sem.release()
@@ -32,8 +32,7 @@ from requestbuilder.mixins import (FileTransferProgressBarMixin,
                                    RegionConfigurableMixin)
 
 import euca2ools.bundle.manifest
-from euca2ools.bundle.pipes.core import (create_bundle_pipeline,
-                                         copy_with_progressbar)
+from euca2ools.bundle.pipes.core import copy_with_progressbar
 from euca2ools.bundle.pipes.fittings import (create_bundle_part_writer,
                                              create_mpconn_aggregator)
 import euca2ools.bundle.util
@@ -136,9 +135,8 @@ class BundleImage(BaseCommand, BundleCreatingMixin,
         bundle_in_r, bundle_in_w = euca2ools.bundle.util.open_pipe_fileobjs()
         partwriter_in_r, partwriter_in_w = \
             euca2ools.bundle.util.open_pipe_fileobjs()
-        digest_result_mpconn = create_bundle_pipeline(
-            bundle_in_r, partwriter_in_w, self.args['enc_key'],
-            self.args['enc_iv'], tarinfo, debug=self.debug)
+        digest_result_mpconn = self.open_bundle_pipeline(
+            bundle_in_r, partwriter_in_w, tarinfo)
         bundle_in_r.close()
         partwriter_in_w.close()
 
@@ -30,6 +30,7 @@ from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
 from euca2ools.commands.s3 import S3Request
 from euca2ools.commands.s3.deletebucket import DeleteBucket
 from euca2ools.commands.s3.deleteobject import DeleteObject
+from euca2ools.commands.s3.deleteobjects import DeleteObjects
 
 
 class DeleteBundle(S3Request, BundleDownloadingMixin):
@@ -60,9 +61,9 @@ class DeleteBundle(S3Request, BundleDownloadingMixin):
                         exc_info=True)
             raise
 
-        for _, part_s3path in self.map_bundle_parts_to_s3paths(manifest):
-            req = DeleteObject.from_other(self, path=part_s3path)
-            req.main()
+        self.__delete_parts(manifest)
+        # Delete the manifest last so that if deleting the parts fails
+        # this command can still find them the next time it runs.
         manifest_s3path = self.get_manifest_s3path()
         if manifest_s3path:
             req = DeleteObject.from_other(self, path=manifest_s3path)
@@ -71,6 +72,21 @@ class DeleteBundle(S3Request, BundleDownloadingMixin):
         if self.args.get('clear'):
             self.__delete_bucket()
 
+    def __delete_parts(self, manifest):
+        part_keys = {}
+        for _, part_s3path in self.map_bundle_parts_to_s3paths(manifest):
+            bucket, _, key = part_s3path.partition('/')
+            part_keys.setdefault(bucket, []).append(key)
+        for bucket, keys in sorted(part_keys.items()):
+            req = DeleteObjects.from_other(self, bucket=bucket, keys=keys)
+            result = req.main()
+            if result['failed']:
+                key, err = result['failed'][0]
+                raise RuntimeError('failed to delete {0} of {1} bundle parts '
+                                   '(first error: {2}: {3})'.format(
+                                       len(result['failed']), len(keys),
+                                       key, err))
+
     def __delete_bucket(self):
         req = DeleteBucket.from_other(self,
                                       bucket=self.args['bucket'].split('/')[0])
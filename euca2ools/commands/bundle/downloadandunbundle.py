@@ -34,6 +34,7 @@ import six
 
 from euca2ools.bundle.util import open_pipe_fileobjs
 from euca2ools.bundle.util import waitpid_in_thread
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.bundle.downloadbundle import DownloadBundle
 from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
 from euca2ools.commands.bundle.unbundlestream import UnbundleStream
@@ -51,11 +52,22 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
             Arg('-k', '--privatekey',
                 help='''file containing the private key to decrypt the bundle
                 with.  This must match a certificate used when bundling the
-                image.''')]
+                image.'''),
+            Arg('--download-threads', metavar='N', type=int,
+                help='''number of bundle parts to download concurrently
+                (default: 4)'''),
+            Arg('--max-download-memory', metavar='BYTES', type=filesize,
+                help='''amount of memory to use to hold parts that are
+                waiting to be unbundled in order.  Parts that do not fit are
+                buffered in temporary files.  (default: 64M)''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
         S3Request.configure(self)
+        if (self.args.get('download_threads') is not None and
+                self.args['download_threads'] < 1):
+            raise ArgumentError(
+                'argument --download-threads must be at least 1')
 
         # The private key could be the user's or the cloud's.  In the config
         # this is a user-level option.
@@ -116,6 +128,8 @@ class DownloadAndUnbundle(S3Request, FileTransferProgressBarMixin,
             self, dest=outfile, bucket=self.args['bucket'],
             manifest=self.args.get('manifest'),
             local_manifest=self.args.get('local_manifest'),
+            download_threads=self.args.get('download_threads'),
+            max_download_memory=self.args.get('max_download_memory'),
             show_progress=False)
         downloadbundle_p = multiprocessing.Process(target=downloadbundle.main)
         downloadbundle_p.start()
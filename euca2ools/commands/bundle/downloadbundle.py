@@ -32,6 +32,7 @@ from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.bundle.mixins import BundleDownloadingMixin
 from euca2ools.commands.s3 import S3Request
 
@@ -43,11 +44,23 @@ class DownloadBundle(S3Request, FileTransferProgressBarMixin,
                    'the original image.')
     ARGS = [Arg('-d', '--directory', dest='dest', metavar='DIR', default=".",
                 help='''the directory to download the bundle parts to, or "-"
-                to write the bundled image to stdout''')]
+                to write the bundled image to stdout'''),
+            Arg('--download-threads', metavar='N', type=int,
+                help='''number of bundle parts to download concurrently
+                (default: 4)'''),
+            Arg('--max-download-memory', metavar='BYTES', type=filesize,
+                help='''when writing to stdout, the amount of memory to use
+                to hold parts that are waiting to be written out in order.
+                Parts that do not fit are buffered in temporary files.
+                (default: 64M)''')]
 
     # noinspection PyExceptionInherit
     def configure(self):
         S3Request.configure(self)
+        if (self.args.get('download_threads') is not None and
+                self.args['download_threads'] < 1):
+            raise ArgumentError(
+                'argument --download-threads must be at least 1')
         if self.args['dest'] == '-':
             self.args['dest'] = sys.stdout
             self.args['show_progress'] = False
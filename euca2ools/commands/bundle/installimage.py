@@ -112,6 +112,9 @@ class InstallImage(S3Request, BundleCreatingMixin, BundleUploadingMixin,
             enc_iv=self.args.get("enc_iv"), enc_key=self.args.get("enc_key"),
             max_pending_parts=self.args.get("max_pending_parts"),
             part_size=self.args.get("part_size"), batch=self.args.get("batch"),
+            bundle_engine=self.args.get("bundle_engine"),
+            compress_threads=self.args.get("compress_threads"),
+            upload_threads=self.args.get("upload_threads"),
             show_progress=self.args.get("show_progress"))
         result_bundle = req.main()
         image_location = result_bundle['manifests'][0]["key"]
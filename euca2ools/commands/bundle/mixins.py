@@ -26,17 +26,24 @@
 import argparse
 import atexit
 import base64
+import collections
+import multiprocessing.pool
 import os.path
 import random
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 
 from requestbuilder import Arg, MutuallyExclusiveArgList
 from requestbuilder.exceptions import ArgumentError
 import six
 
+from euca2ools.bundle.cache import BundlePartCache
 import euca2ools.bundle.manifest
+from euca2ools.bundle.pipes.core import (create_bundle_pipeline,
+                                         create_inprocess_bundle_pipeline)
 import euca2ools.bundle.util
 from euca2ools.commands.argtypes import (b64encoded_file_contents,
                                          delimited_list, filesize,
@@ -48,10 +55,15 @@ from euca2ools.commands.s3.createbucket import CreateBucket
 from euca2ools.commands.s3.getobject import GetObject
 from euca2ools.commands.s3.postobject import PostObject
 from euca2ools.commands.s3.putobject import PutObject
+import euca2ools.diskimage
 from euca2ools.exceptions import AWSError
 
 
 EC2_BUNDLE_SIZE_LIMIT = 10 * 2 ** 30  # 10 GiB
+DEFAULT_UPLOAD_THREADS = 4
+DEFAULT_DOWNLOAD_THREADS = 4
+DEFAULT_MAX_DOWNLOAD_MEMORY = 64 * 2 ** 20  # 64 MiB
+DEFAULT_BUNDLE_CACHE_SIZE = 10 * 2 ** 30  # 10 GiB
 
 
 class BundleCreatingMixin(object):
@@ -113,6 +125,16 @@ class BundleCreatingMixin(object):
             Arg('--image-size', type=filesize, help='''the image's size
                 (required when bundling stdin)'''),
 
+            # How to build the bundle
+            Arg('--bundle-engine', choices=('pipeline', 'inprocess'),
+                default='pipeline', help='''how to create the bundle:
+                "pipeline" runs tar, digest, compression, and encryption
+                steps as separate processes, while "inprocess" does all
+                but encryption in a single process (default: pipeline)'''),
+            Arg('--compress-threads', metavar='N', type=int,
+                help='''number of threads to use to compress the bundle
+                (default: one per CPU)'''),
+
             # Overrides for debugging and other entertaining uses
             Arg('--part-size', type=filesize, default=10485760,  # 10M
                 help=argparse.SUPPRESS),
@@ -244,6 +266,12 @@ class BundleCreatingMixin(object):
             if not self.args.get('image_size'):
                 self.args['image_size'] = euca2ools.util.get_filesize(
                     self.args['image'])
+            image_format = euca2ools.diskimage.detect_format(
+                self.args['image'])
+            if image_format != 'raw':
+                self.log.warn('%s appears to be a %s image; bundles are '
+                              'expected to contain raw disk images',
+                              self.args['image'], image_format.upper())
             self.args['image'] = open(self.args['image'])
         else:
             # Assume it is already a file object
@@ -257,6 +285,10 @@ class BundleCreatingMixin(object):
             self.log.warn(
                 'image is incompatible with EC2 due to its size (%i > %i)',
                 self.args['image_size'], EC2_BUNDLE_SIZE_LIMIT)
+        if (self.args.get('compress_threads') is not None and
+                self.args['compress_threads'] < 1):
+            raise ArgumentError(
+                'argument --compress-threads must be at least 1')
 
     def configure_bundle_properties(self):
         if self.args.get('kernel') == 'true':
@@ -317,6 +349,20 @@ class BundleCreatingMixin(object):
                 atexit.register(os.remove, cert_file.name)
                 return cert_file.name
 
+    # BUNDLE CREATION METHODS #
+
+    def open_bundle_pipeline(self, infile, outfile, tarinfo):
+        if self.args.get('bundle_engine') == 'inprocess':
+            self.log.debug('using in-process bundle engine')
+            pipeline_func = create_inprocess_bundle_pipeline
+        else:
+            pipeline_func = create_bundle_pipeline
+        return pipeline_func(infile, outfile, self.args['enc_key'],
+                             self.args['enc_iv'], tarinfo,
+                             compress_threads=self.args.get(
+                                 'compress_threads'),
+                             debug=self.debug)
+
     # MANIFEST GENERATION METHODS #
 
     def build_manifest(self, digest, partinfo):
@@ -376,7 +422,11 @@ class BundleUploadingMixin(object):
                 bucket (default: inferred from s3-location-constraint in
                 configuration, or otherwise none)'''),
             Arg('--retry', dest='retries', action='store_const', const=5,
-                default=0, help='retry failed uploads up to 5 times')]
+                default=0, help='retry failed uploads up to 5 times'),
+            Arg('--upload-threads', metavar='N', type=int,
+                default=DEFAULT_UPLOAD_THREADS, help='''number of bundle
+                parts to upload concurrently (default: {0})'''.format(
+                    DEFAULT_UPLOAD_THREADS))]
 
     def configure_bundle_upload_auth(self):
         if self.args.get('upload_policy'):
@@ -388,6 +438,12 @@ class BundleUploadingMixin(object):
                                     'when using an upload policy')
             self.auth = None
             self.AUTH_CLASS = None
+        if (self.args.get('upload_threads') is not None and
+                self.args['upload_threads'] < 1):
+            raise ArgumentError('argument --upload-threads must be at least 1')
+
+    def get_upload_thread_count(self):
+        return self.args.get('upload_threads') or DEFAULT_UPLOAD_THREADS
 
     def get_bundle_key_prefix(self):
         (bucket, _, prefix) = self.args['bucket'].partition('/')
@@ -422,6 +478,127 @@ class BundleUploadingMixin(object):
 
     def upload_bundle_file(self, source, dest, show_progress=False,
                            **putobj_kwargs):
+        req = self.__get_upload_request(source, dest, show_progress,
+                                        **putobj_kwargs)
+        req.main()
+
+    def upload_bundle_parts(self, partinfo_in_mpconn, key_prefix,
+                            partinfo_out_mpconn=None, part_write_sem=None,
+                            show_progress=False, total_size=None,
+                            journal=None, **putobj_kwargs):
+        """
+        Upload each part that arrives on partinfo_in_mpconn using a pool
+        of get_upload_thread_count() threads, releasing part_write_sem
+        once per part as soon as it is uploaded.  Uploaded parts are sent
+        to partinfo_out_mpconn in the order they arrived, regardless of
+        the order in which their uploads finish.
+
+        Progress for all parts is shown on a single progress bar; pass
+        total_size if the combined size of all parts is known ahead of
+        time.
+
+        If a BundleUploadJournal is supplied, parts it says were already
+        uploaded are skipped, and every other part is recorded in it once
+        its upload finishes.
+        """
+        pool = multiprocessing.pool.ThreadPool(self.get_upload_thread_count())
+        # part number -> (part, AsyncResult)
+        pending_parts = {}
+        # part number -> upload request (only while uploading)
+        active_reqs = {}
+        active_reqs_lock = threading.Lock()
+        next_part_no = 0
+        next_part_no_to_send = 0
+        finished_parts = {}
+        bytes_uploaded = 0
+        more_parts_coming = True
+        if show_progress:
+            pbar = self.get_progressbar(label='Uploading bundle',
+                                        maxval=total_size)
+            pbar.start()
+        else:
+            pbar = None
+        try:
+            while more_parts_coming or pending_parts:
+                if more_parts_coming and partinfo_in_mpconn.poll(0.05):
+                    try:
+                        part = partinfo_in_mpconn.recv()
+                    except EOFError:
+                        more_parts_coming = False
+                    else:
+                        dest = key_prefix + os.path.basename(part.filename)
+                        if (journal is not None and
+                                journal.has_uploaded_part(part, dest)):
+                            self.log.info('skipping part %s, which was '
+                                          'already uploaded', dest)
+                            result = None
+                        else:
+                            result = pool.apply_async(
+                                self.__upload_bundle_part,
+                                (next_part_no, part, dest, active_reqs,
+                                 active_reqs_lock), putobj_kwargs)
+                        pending_parts[next_part_no] = (part, result)
+                        next_part_no += 1
+                elif not more_parts_coming:
+                    # Nothing left to do but wait for uploads to finish
+                    _, result = pending_parts[min(pending_parts)]
+                    if result is not None:
+                        result.wait(0.05)
+                for part_no, (part, result) in list(pending_parts.items()):
+                    if result is None or result.ready():
+                        if result is not None:
+                            # This raises the upload's exception, if any
+                            result.get()
+                            if journal is not None:
+                                journal.record_uploaded_part(
+                                    part, key_prefix +
+                                    os.path.basename(part.filename))
+                        del pending_parts[part_no]
+                        finished_parts[part_no] = part
+                        bytes_uploaded += part.size or 0
+                        if part_write_sem is not None:
+                            # Allow something that's waiting for an upload
+                            # to finish to continue
+                            part_write_sem.release()
+                while next_part_no_to_send in finished_parts:
+                    part = finished_parts.pop(next_part_no_to_send)
+                    if partinfo_out_mpconn is not None:
+                        partinfo_out_mpconn.send(part)
+                    next_part_no_to_send += 1
+                if pbar is not None:
+                    in_flight = 0
+                    with active_reqs_lock:
+                        for req in active_reqs.values():
+                            source = req.args.get('source')
+                            if hasattr(source, 'tell'):
+                                in_flight += source.tell()
+                    pbar.update(bytes_uploaded + in_flight)
+            if pbar is not None:
+                pbar.finish()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            partinfo_in_mpconn.close()
+            if partinfo_out_mpconn is not None:
+                partinfo_out_mpconn.close()
+
+    def __upload_bundle_part(self, part_no, part, dest, active_reqs,
+                             active_reqs_lock, **putobj_kwargs):
+        req = self.__get_upload_request(part.filename, dest, False,
+                                        **putobj_kwargs)
+        with active_reqs_lock:
+            active_reqs[part_no] = req
+        try:
+            req.main()
+        finally:
+            with active_reqs_lock:
+                del active_reqs[part_no]
+
+    def __get_upload_request(self, source, dest, show_progress,
+                             **putobj_kwargs):
         if self.args.get('upload_policy'):
             if show_progress:
                 # PostObject does not yet support show_progress
@@ -432,40 +609,18 @@ class BundleUploadingMixin(object):
             else:
                 postobj_kwargs = {}
             postobj_kwargs.update(putobj_kwargs)
-            req = PostObject.from_other(
+            return PostObject.from_other(
                 self, source=source, dest=dest,
                 acl=self.args.get('acl') or 'aws-exec-read',
                 Policy=self.args['upload_policy'],
                 Signature=self.args['upload_policy_signature'],
                 AWSAccessKeyId=self.args['key_id'], **postobj_kwargs)
         else:
-            req = PutObject.from_other(
+            return PutObject.from_other(
                 self, source=source, dest=dest,
                 acl=self.args.get('acl') or 'aws-exec-read',
                 retries=self.args.get('retries') or 0,
                 show_progress=show_progress, **putobj_kwargs)
-        req.main()
-
-    def upload_bundle_parts(self, partinfo_in_mpconn, key_prefix,
-                            partinfo_out_mpconn=None, part_write_sem=None,
-                            **putobj_kwargs):
-        try:
-            while True:
-                part = partinfo_in_mpconn.recv()
-                dest = key_prefix + os.path.basename(part.filename)
-                self.upload_bundle_file(part.filename, dest, **putobj_kwargs)
-                if part_write_sem is not None:
-                    # Allow something that's waiting for the upload to finish
-                    # to continue
-                    part_write_sem.release()
-                if partinfo_out_mpconn is not None:
-                    partinfo_out_mpconn.send(part)
-        except EOFError:
-            return
-        finally:
-            partinfo_in_mpconn.close()
-            if partinfo_out_mpconn is not None:
-                partinfo_out_mpconn.close()
 
 
 class BundleDownloadingMixin(object):
@@ -532,14 +687,10 @@ class BundleDownloadingMixin(object):
         for part, part_s3path in parts:
             part.filename = os.path.join(dest_dir,
                                          os.path.basename(part_s3path))
-            self.log.info('downloading part %s to %s',
-                          part_s3path, part.filename)
-            req = GetObject.from_other(
-                self, service=s3_service, source=part_s3path,
-                dest=part.filename,
-                show_progress=self.args.get('show_progress', False))
-            response = req.main()
-            self.__check_part_sha1(part, part_s3path, response)
+        for _, part_file in self.__download_bundle_parts(
+                parts, s3_service, lambda part: open(part.filename, 'w'),
+                maxval=manifest.bundled_image_size):
+            part_file.close()
 
         manifest_s3path = self.get_manifest_s3path()
         if manifest_s3path:
@@ -560,14 +711,122 @@ class BundleDownloadingMixin(object):
         # We can skip downloading the manifest since we're just writing all
         # parts to a file object.
         parts = self.map_bundle_parts_to_s3paths(manifest)
-        for part, part_s3path in parts:
-            self.log.info('downloading part %s', part_s3path)
-            req = GetObject.from_other(
-                self, service=s3_service, source=part_s3path,
-                dest=fileobj,
-                show_progress=self.args.get('show_progress', False))
+        # Every part in the download window gets an equal share of the
+        # memory limit before it spills over to disk.
+        max_buffer_size = (
+            (self.args.get('max_download_memory') or
+             DEFAULT_MAX_DOWNLOAD_MEMORY) // self.get_download_thread_count())
+        for _, part_buffer in self.__download_bundle_parts(
+                parts, s3_service, lambda part: tempfile.SpooledTemporaryFile(
+                    max_size=max_buffer_size)):
+            part_buffer.seek(0)
+            shutil.copyfileobj(part_buffer, fileobj, euca2ools.BUFSIZE)
+            part_buffer.close()
+        fileobj.flush()
+
+    def get_download_thread_count(self):
+        return self.args.get('download_threads') or DEFAULT_DOWNLOAD_THREADS
+
+    def get_bundle_part_cache(self):
+        cache_dir = self.config.get_global_option('bundle-cache-dir')
+        if not cache_dir:
+            return None
+        cache_dir = os.path.expanduser(os.path.expandvars(cache_dir))
+        cache_size = self.config.get_global_option('bundle-cache-size')
+        if cache_size:
+            try:
+                cache_size = filesize(cache_size)
+            except ValueError:
+                raise ValueError('bundle-cache-size must be a size, such as '
+                                 '10G (found {0})'.format(repr(cache_size)))
+        else:
+            cache_size = DEFAULT_BUNDLE_CACHE_SIZE
+        self.log.debug('using bundle part cache %s (max size: %i)',
+                       cache_dir, cache_size)
+        return BundlePartCache(cache_dir, cache_size, loglevel=self.log.level)
+
+    def __download_bundle_parts(self, parts, s3_service, open_part_dest,
+                                maxval=None):
+        """
+        Download (part, s3path) pairs using a pool of
+        get_download_thread_count() threads, writing each to the file
+        object open_part_dest(part) returns.  Generate a (part, fileobj)
+        pair for each part in the order given as soon as its download
+        finishes and its SHA1 digest checks out.
+
+        At most get_download_thread_count() parts are downloading or
+        waiting to be consumed at once, so the caller can bound how much
+        space they take up.
+        """
+        threads = self.get_download_thread_count()
+        part_cache = self.get_bundle_part_cache()
+        pool = multiprocessing.pool.ThreadPool(threads)
+        # (part, fileobj, AsyncResult) for each part in the window
+        window = collections.deque()
+        parts = iter(parts)
+        more_parts_coming = True
+        bytes_downloaded = 0
+        pbar = self.get_progressbar(label='Downloading bundle', maxval=maxval)
+        pbar.start()
+        try:
+            while True:
+                while more_parts_coming and len(window) < threads:
+                    try:
+                        part, part_s3path = next(parts)
+                    except StopIteration:
+                        more_parts_coming = False
+                        break
+                    part_dest = open_part_dest(part)
+                    result = pool.apply_async(
+                        self.__download_bundle_part,
+                        (part, part_s3path, part_dest, s3_service,
+                         part_cache))
+                    window.append((part, part_dest, result))
+                if not window:
+                    break
+                part, part_dest, result = window[0]
+                while not result.ready():
+                    result.wait(0.05)
+                    in_flight = sum(dest.tell() for _, dest, _ in window)
+                    pbar.update(bytes_downloaded + in_flight)
+                # This raises the download's exception, if any
+                size = result.get()
+                window.popleft()
+                bytes_downloaded += size
+                pbar.update(bytes_downloaded)
+                yield part, part_dest
+            pbar.finish()
+            pool.close()
+        except:
+            pool.terminate()
+            for _, part_dest, _ in window:
+                part_dest.close()
+            raise
+        finally:
+            pool.join()
+
+    def __download_bundle_part(self, part, part_s3path, part_dest,
+                               s3_service, part_cache=None):
+        if part_cache is not None:
+            size = part_cache.copy_part(part.hexdigest, part_dest)
+            if size is not None:
+                self.log.info('using cached copy of part %s', part_s3path)
+                return size
+            part_dest = part_cache.open_part_writer(part.hexdigest, part_dest)
+        self.log.info('downloading part %s', part_s3path)
+        req = GetObject.from_other(self, service=s3_service,
+                                   source=part_s3path, dest=part_dest,
+                                   show_progress=False)
+        try:
             response = req.main()
             self.__check_part_sha1(part, part_s3path, response)
+        except:
+            if part_cache is not None:
+                part_dest.abort()
+            raise
+        if part_cache is not None:
+            part_dest.commit()
+        return response[part_s3path]['size']
 
     def map_bundle_parts_to_s3paths(self, manifest):
         parts = []
@@ -0,0 +1,185 @@
+# Copyright 2009-2013 Eucalyptus Systems, Inc.
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import multiprocessing.pool
+import os
+import sys
+import tempfile
+import threading
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+import six
+
+from euca2ools.bundle.manifest import BundleManifest
+from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.getobject import GetObject
+from euca2ools.commands.s3.listbucket import ListBucket
+from euca2ools.commands.s3.putobject import PutObject
+
+
+DEFAULT_REENCRYPT_THREADS = 8
+
+
+class ReencryptBundles(S3Request):
+    DESCRIPTION = ('Re-encrypt the manifests of previously-uploaded bundles '
+                   'for a new cloud certificate\n\nEach bundle\'s encryption '
+                   'key is decrypted with your private key and encrypted '
+                   'again with the new cloud certificate and your '
+                   'certificate.  Only the manifests are rewritten, so '
+                   'bundles do not need to be created and uploaded again '
+                   'after the cloud\'s bundling certificate changes.')
+    ARGS = [Arg('-b', '--bucket', metavar='BUCKET[/PREFIX]', required=True,
+                help='''bucket that contains the bundles, with an optional
+                path prefix.  Every manifest under it is rewritten.
+                (required)'''),
+            Arg('-k', '--privatekey', metavar='FILE', help='''file
+                containing the private key the bundles were created with.
+                It is used to decrypt the bundles' keys and to sign the new
+                manifests.'''),
+            Arg('-c', '--cert', metavar='FILE', help='''file containing
+                your X.509 certificate, for which the bundles' keys are
+                encrypted again'''),
+            Arg('--ec2cert', metavar='FILE', required=True,
+                help='file containing the new cloud certificate (required)'),
+            Arg('--acl', default='aws-exec-read',
+                choices=('public-read', 'aws-exec-read', 'ec2-bundle-read'),
+                help='''canned ACL policy to apply to the new manifests
+                (default: aws-exec-read)'''),
+            Arg('--threads', metavar='N', type=int,
+                default=DEFAULT_REENCRYPT_THREADS, help='''number of
+                manifests to rewrite concurrently (default: {0})'''.format(
+                    DEFAULT_REENCRYPT_THREADS)),
+            Arg('--retry', dest='retries', action='store_const', const=5,
+                default=0, help='retry failed uploads up to 5 times')]
+
+    def configure(self):
+        S3Request.configure(self)
+        if not self.args.get('privatekey'):
+            config_val = self.config.get_user_option('private-key')
+            if 'EC2_PRIVATE_KEY' in os.environ:
+                self.log.debug('using private key from environment')
+                self.args['privatekey'] = os.getenv('EC2_PRIVATE_KEY')
+            elif config_val:
+                self.log.debug('using private key from configuration')
+                self.args['privatekey'] = config_val
+        if not self.args.get('cert'):
+            config_val = self.config.get_user_option('certificate')
+            if 'EC2_CERT' in os.environ:
+                self.log.debug('using certificate from environment')
+                self.args['cert'] = os.getenv('EC2_CERT')
+            elif config_val:
+                self.log.debug('using certificate from configuration')
+                self.args['cert'] = config_val
+        for arg, option, filetype in (('privatekey', '-k', 'private key'),
+                                      ('cert', '-c', 'user certificate'),
+                                      ('ec2cert', '--ec2cert',
+                                       'cloud certificate')):
+            if not self.args.get(arg):
+                raise ArgumentError('missing {0}; please supply one with {1}'
+                                    .format(filetype, option))
+            self.args[arg] = os.path.expanduser(os.path.expandvars(
+                self.args[arg]))
+            if not os.path.isfile(self.args[arg]):
+                raise ArgumentError("{0} file '{1}' does not exist"
+                                    .format(filetype, self.args[arg]))
+        if (self.args.get('threads') is not None and
+                self.args['threads'] < 1):
+            raise ArgumentError('argument --threads must be at least 1')
+
+    def main(self):
+        manifest_s3paths = self.__list_manifests()
+        self.log.info('found %i manifests to re-encrypt',
+                      len(manifest_s3paths))
+        results = {'reencrypted': [], 'failed': []}
+        results_lock = threading.Lock()
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('threads') or DEFAULT_REENCRYPT_THREADS)
+        try:
+            for manifest_s3path in manifest_s3paths:
+                pool.apply_async(self.__reencrypt_manifest_safely,
+                                 (manifest_s3path, results, results_lock))
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        results['reencrypted'].sort()
+        results['failed'].sort()
+        return results
+
+    def print_result(self, result):
+        for manifest_s3path in result['reencrypted']:
+            print manifest_s3path
+        for manifest_s3path, err in result['failed']:
+            print >> sys.stderr, 'failed: {0}: {1}'.format(manifest_s3path,
+                                                           err)
+        if result['failed']:
+            raise RuntimeError('failed to re-encrypt {0} of {1} manifests'
+                               .format(len(result['failed']),
+                                       len(result['failed']) +
+                                       len(result['reencrypted'])))
+
+    def __list_manifests(self):
+        bucket, _, prefix = self.args['bucket'].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        req = ListBucket.from_other(self, paths=[bucket + '/' + prefix])
+        return ['/'.join((bucket, obj['Key']))
+                for obj in req.main().get('Contents', [])
+                if obj['Key'].endswith('.manifest.xml')]
+
+    def __reencrypt_manifest_safely(self, manifest_s3path, results,
+                                    results_lock):
+        # This runs in a thread pool, where nobody would see an exception
+        try:
+            self.__reencrypt_manifest(manifest_s3path)
+        except Exception as err:
+            self.log.error('failed to re-encrypt %s', manifest_s3path,
+                           exc_info=True)
+            with results_lock:
+                results['failed'].append((manifest_s3path,
+                                          six.text_type(err)))
+        else:
+            with results_lock:
+                results['reencrypted'].append(manifest_s3path)
+
+    def __reencrypt_manifest(self, manifest_s3path):
+        with tempfile.TemporaryFile() as manifest_tempfile:
+            self.log.info('reading manifest from %s', manifest_s3path)
+            req = GetObject.from_other(self, source=manifest_s3path,
+                                       dest=manifest_tempfile)
+            req.main()
+            manifest_tempfile.seek(0)
+            manifest = BundleManifest.read_from_fileobj(
+                manifest_tempfile, privkey_filename=self.args['privatekey'])
+        new_manifest = manifest.dump_to_str(
+            self.args['privatekey'], self.args['cert'], self.args['ec2cert'])
+        self.log.info('writing re-encrypted manifest to %s', manifest_s3path)
+        req = PutObject.from_other(
+            self, source=six.BytesIO(new_manifest), size=len(new_manifest),
+            dest=manifest_s3path, acl=self.args.get('acl') or 'aws-exec-read',
+            retries=self.args.get('retries') or 0)
+        req.main()
@@ -64,10 +64,13 @@ class UploadBundle(S3Request, BundleUploadingMixin,
         manifest = BundleManifest.read_from_file(self.args['manifest'])
         part_dir = (self.args.get('directory') or
                     os.path.dirname(self.args['manifest']))
+        total_size = 0
         for part in manifest.image_parts:
             part.filename = os.path.join(part_dir, part.filename)
             if not os.path.isfile(part.filename):
                 raise ValueError("no such part: '{0}'".format(part.filename))
+            part.size = os.path.getsize(part.filename)
+            total_size += part.size
 
         # manifest -> upload
         part_out_r, part_out_w = multiprocessing.Pipe(duplex=False)
@@ -78,7 +81,8 @@ class UploadBundle(S3Request, BundleUploadingMixin,
 
         # Drive the upload process by feeding in part info
         self.upload_bundle_parts(part_out_r, key_prefix,
-                                 show_progress=self.args.get('show_progress'))
+                                 show_progress=self.args.get('show_progress'),
+                                 total_size=total_size)
         part_gen.join()
 
         # (conditionally) upload the manifest
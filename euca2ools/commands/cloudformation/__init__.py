@@ -29,12 +29,13 @@ from requestbuilder.mixins import TabifyingMixin
 from requestbuilder.request import AWSQueryRequest
 import requestbuilder.service
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class CloudFormation(requestbuilder.service.BaseService):
+class CloudFormation(SharedSessionServiceMixin,
+                     requestbuilder.service.BaseService):
     NAME = 'cloudformation'
     DESCRIPTION = 'Deployment templating service'
     API_VERSION = '2010-05-15'
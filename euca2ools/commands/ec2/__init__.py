@@ -41,12 +41,12 @@ from requestbuilder.service import BaseService
 import requests.exceptions
 import six
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import add_fake_region_name
 
 
-class EC2(BaseService):
+class EC2(SharedSessionServiceMixin, BaseService):
     NAME = 'ec2'
     DESCRIPTION = 'Elastic compute cloud service'
     API_VERSION = '2015-10-01'
@@ -37,8 +37,10 @@ from requestbuilder.mixins import FileTransferProgressBarMixin
 from euca2ools.commands.argtypes import b64encoded_file_contents, filesize
 from euca2ools.commands.ec2 import EC2Request
 from euca2ools.commands.ec2.mixins import S3AccessMixin
-from euca2ools.commands.ec2.resumeimport import ResumeImport
+from euca2ools.commands.ec2.resumeimport import DEFAULT_USER_THREADS, \
+    ResumeImport
 from euca2ools.commands.s3.getobject import GetObject
+import euca2ools.diskimage
 import euca2ools.util
 
 
@@ -74,6 +76,15 @@ class ImportInstance(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
             Arg('--no-upload', action='store_true', route_to=None,
                 help='''start the import process, but do not actually upload
                 the volume (see euca-resume-import)'''),
+            Arg('--user-threads', metavar='N', type=int, route_to=None,
+                help='''upload at most N parts of the volume at once
+                (default: {0})'''.format(DEFAULT_USER_THREADS)),
+            Arg('--share-zero-parts', action='store_true', route_to=None,
+                help='''upload only one copy of each size of part that
+                contains nothing but zeros and point all such parts at it.
+                This speeds up importing sparse images, but only works with
+                servers that do not delete any part of an image until they
+                have downloaded all of them.'''),
             Arg('-d', '--description', dest='Description',
                 help='a description for the import task (not the volume)'),
             Arg('-g', '--group', metavar='GROUP',
@@ -140,6 +151,10 @@ class ImportInstance(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
                 image_size = euca2ools.util.get_vmdk_image_size(
                     self.args['source'])
                 self.params['DiskImage.1.Image.Bytes'] = image_size
+            elif self.params['DiskImage.1.Image.Format'] == 'VHD':
+                image = euca2ools.diskimage.open_disk_image(
+                    self.args['source'], 'vhd')
+                self.params['DiskImage.1.Image.Bytes'] = image.virtual_size
             else:
                 raise ArgumentError(
                     'argument --image-size is required for {0} files'
@@ -185,6 +200,8 @@ class ImportInstance(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
                 task=result['conversionTask']['conversionTaskId'],
                 s3_service=self.args['s3_service'],
                 s3_auth=self.args['s3_auth'], expires=self.args['expires'],
+                user_threads=self.args.get('user_threads'),
+                share_zero_parts=self.args.get('share_zero_parts'),
                 show_progress=self.args.get('show_progress', False))
             resume.main()
 
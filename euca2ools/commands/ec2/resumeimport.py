@@ -24,8 +24,11 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import multiprocessing.pool
 import os.path
 import tempfile
+import threading
+import time
 
 from requestbuilder import Arg
 from requestbuilder.exceptions import ArgumentError, ServerError
@@ -40,11 +43,16 @@ from euca2ools.commands.ec2.structures import ImportManifest, ImportImagePart
 from euca2ools.commands.s3.deleteobject import DeleteObject
 from euca2ools.commands.s3.headobject import HeadObject
 from euca2ools.commands.s3.getobject import GetObject
+from euca2ools.commands.s3.listbucket import ListBucket
 from euca2ools.commands.s3.putobject import PutObject
+import euca2ools.diskimage
 from euca2ools.exceptions import AWSError
 import euca2ools.util
 
 
+DEFAULT_USER_THREADS = 8
+
+
 class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
     DESCRIPTION = 'Perform the upload step of an import task'
     ARGS = [Arg('source', metavar='FILE',
@@ -57,13 +65,28 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
             # This is documented, but not implemented in ec2-resume-import
             Arg('--part-size', metavar='MiB', type=int, default=10,
                 help=argparse.SUPPRESS),
-            # These are not implemented
-            Arg('--user-threads', type=int, help=argparse.SUPPRESS),
+            Arg('--user-threads', metavar='N', type=int,
+                help='''upload at most N parts of the image at once
+                (default: {0})'''.format(DEFAULT_USER_THREADS)),
+            Arg('--share-zero-parts', action='store_true', help='''upload
+                only one copy of each size of part that contains nothing
+                but zeros and point all such parts at it.  This speeds up
+                importing sparse images, but only works with servers that
+                do not delete any part of an image until they have
+                downloaded all of them.  This has no effect on imports
+                whose manifest already exists.'''),
+            # This is not implemented
             Arg('--dont-verify-format', action='store_true',
                 help=argparse.SUPPRESS),
             # This does no validation, but it does prevent taking action
             Arg('--dry-run', action='store_true', help=argparse.SUPPRESS)]
 
+    def __init__(self, **kwargs):
+        EC2Request.__init__(self, **kwargs)
+        self._lock = threading.Lock()
+        self.__active_parts = {}
+        self.__part_bytes_uploaded = 0
+
     def configure(self):
         EC2Request.configure(self)
         self.configure_s3_access()
@@ -72,6 +95,9 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         if self.args['expires'] < 1:
             raise ArgumentError(
                 'argument -x/--expires: value must be positive')
+        if (self.args.get('user_threads') is not None and
+                self.args['user_threads'] < 1):
+            raise ArgumentError('argument --user-threads must be at least 1')
 
     def main(self):
         if self.args.get('dry_run'):
@@ -103,21 +129,18 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         # Now we have a manifest; check to see what parts are already uploaded
         _, bucket, _ = self.args['s3_service'].resolve_url_to_location(
             vol_container['image']['importManifestUrl'])
-        pbar_label_template = euca2ools.util.build_progressbar_label_template(
-            [os.path.basename(part.key) for part in manifest.image_parts])
-        for part in manifest.image_parts:
-            part_s3path = '/'.join((bucket, part.key))
-            head_req = HeadObject.from_other(
-                self, service=self.args['s3_service'],
-                auth=self.args['s3_auth'], path=part_s3path)
-            try:
-                head_req.main()
-            except AWSError as err:
-                if err.status_code == 404:
-                    self.__upload_part(part, part_s3path, pbar_label_template)
-                else:
-                    raise
-            # If it is already there we skip it
+        missing_parts = self.__find_missing_parts(manifest.image_parts,
+                                                  bucket)
+        # Parts that contain only zeros share a key, and one upload of
+        # it is enough for all of them.
+        parts_to_upload = []
+        keys_to_upload = set()
+        for part in missing_parts:
+            if part.key not in keys_to_upload:
+                parts_to_upload.append(part)
+                keys_to_upload.add(part.key)
+        if parts_to_upload:
+            self.__upload_parts(parts_to_upload, bucket)
 
     def __get_or_create_manifest(self, vol_container, file_size):
         _, bucket, key = self.args['s3_service'].resolve_url_to_location(
@@ -162,42 +185,199 @@ class ResumeImport(EC2Request, S3AccessMixin, FileTransferProgressBarMixin):
         key_prefix = key.rsplit('/', 1)[0]
         manifest = ImportManifest(loglevel=self.log.level)
         manifest.file_format = vol_container['image']['format']
-        delete_req = DeleteObject.from_other(
-            self, service=self.args['s3_service'], auth=self.args['s3_auth'],
-            path='/'.join((bucket, key)))
-        manifest.self_destruct_url = delete_req.get_presigned_url2(timeout)
         manifest.image_size = int(vol_container['image']['size'])
         manifest.volume_size = int(vol_container['volume']['size'])
         part_size = (self.args.get('part_size') or 10) * 2 ** 20  # MiB
-        for index, part_start in enumerate(six.moves.range(0, file_size,
-                                                           part_size)):
-            part = ImportImagePart()
-            part.index = index
-            part.start = part_start
-            part.end = min(part_start + part_size, file_size) - 1
-            part.key = '{0}/{1}.part.{2}'.format(
-                key_prefix, os.path.basename(self.args['source']), index)
-            part_path = '/'.join((bucket, part.key))
-            head_req = HeadObject.from_other(delete_req, path=part_path)
-            get_req = GetObject.from_other(delete_req, source=part_path)
-            delete_req = DeleteObject.from_other(delete_req, path=part_path)
-            part.head_url = head_req.get_presigned_url2(timeout)
-            part.get_url = get_req.get_presigned_url2(timeout)
-            part.delete_url = delete_req.get_presigned_url2(timeout)
-            manifest.image_parts.append(part)
+        requests_to_sign = [('DELETE', '/'.join((bucket, key)))]
+        zero_part_count = 0
+        source_fd = os.open(self.args['source'], os.O_RDONLY)
+        try:
+            for index, part_start in enumerate(
+                    six.moves.range(0, file_size, part_size)):
+                part = ImportImagePart()
+                part.index = index
+                part.start = part_start
+                part.end = min(part_start + part_size, file_size) - 1
+                if (self.args.get('share_zero_parts') and
+                        euca2ools.diskimage.is_all_zeros(
+                            source_fd, part.start, part.end - part.start + 1)):
+                    # Unallocated parts of sparse images all look alike,
+                    # so point all parts of the same size that contain
+                    # nothing but zeros at a single object.
+                    part.key = '{0}/{1}.part.zeros-{2}'.format(
+                        key_prefix, os.path.basename(self.args['source']),
+                        part.end - part.start + 1)
+                    zero_part_count += 1
+                else:
+                    part.key = '{0}/{1}.part.{2}'.format(
+                        key_prefix, os.path.basename(self.args['source']),
+                        index)
+                part_path = '/'.join((bucket, part.key))
+                requests_to_sign.extend((('HEAD', part_path),
+                                         ('GET', part_path),
+                                         ('DELETE', part_path)))
+                manifest.image_parts.append(part)
+        finally:
+            os.close(source_fd)
+        if self.args.get('share_zero_parts'):
+            self.log.info('%i of %i parts contain only zeros',
+                          zero_part_count, len(manifest.image_parts))
+        # Large images have tens of thousands of URLs to sign, so sign
+        # them all at once.
+        delete_req = DeleteObject.from_other(
+            self, service=self.args['s3_service'], auth=self.args['s3_auth'],
+            path='/'.join((bucket, key)))
+        urls = iter(delete_req.get_presigned_urls(timeout, requests_to_sign))
+        manifest.self_destruct_url = next(urls)
+        for part in manifest.image_parts:
+            part.head_url = next(urls)
+            part.get_url = next(urls)
+            part.delete_url = next(urls)
         return manifest
 
-    def __upload_part(self, part, part_s3path, pbar_label_template):
+    def __find_missing_parts(self, parts, bucket):
+        """
+        Return the parts that are not yet uploaded, or were uploaded only
+        partially, using a listing of all of them.  If listing the bucket
+        is not allowed fall back to checking each one with a HEAD
+        request.
+        """
+        prefix = os.path.commonprefix([part.key for part in parts])
+        list_req = ListBucket.from_other(
+            self, service=self.args['s3_service'], auth=self.args['s3_auth'],
+            paths=['/'.join((bucket, prefix))])
+        try:
+            sizes = dict((obj['Key'], int(obj['Size'])) for obj in
+                         list_req.main().get('Contents', []))
+        except AWSError as err:
+            self.log.info('failed to list uploaded parts (%s); checking '
+                          'each part instead', err.code)
+            return self.__find_missing_parts_with_head(parts, bucket)
+        return [part for part in parts
+                if sizes.get(part.key) != part.end - part.start + 1]
+
+    def __find_missing_parts_with_head(self, parts, bucket):
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('user_threads') or DEFAULT_USER_THREADS)
+        try:
+            results = [(part, pool.apply_async(self.__part_exists,
+                                               (part, bucket)))
+                       for part in parts]
+            pool.close()
+            missing_parts = [part for part, result in results
+                             if not result.get()]
+            pool.join()
+            return missing_parts
+        except:
+            pool.terminate()
+            raise
+
+    def __part_exists(self, part, bucket):
+        head_req = HeadObject.from_other(
+            self, service=self.args['s3_service'], auth=self.args['s3_auth'],
+            path='/'.join((bucket, part.key)))
+        try:
+            head_req.main()
+        except AWSError as err:
+            if err.status_code == 404:
+                return False
+            raise
+        return True
+
+    def __upload_parts(self, parts, bucket):
+        # All of the parts are read through one file descriptor, so
+        # uploading many of them at once does not mean opening the file
+        # many times.
+        source_fd = os.open(self.args['source'], os.O_RDONLY)
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('user_threads') or DEFAULT_USER_THREADS)
+        try:
+            results = [pool.apply_async(self.__upload_part,
+                                        (part, bucket, source_fd))
+                       for part in parts]
+            pool.close()
+            pbar = self.get_progressbar(
+                label=os.path.basename(self.args['source']),
+                maxval=sum(part.end - part.start + 1 for part in parts))
+            pbar.start()
+            while not all(result.ready() for result in results):
+                pbar.update(self.__get_bytes_uploaded())
+                time.sleep(0.05)
+            for result in results:
+                # This raises the first failed part's exception
+                result.get()
+            pbar.finish()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            os.close(source_fd)
+
+    def __get_bytes_uploaded(self):
+        with self._lock:
+            return self.__part_bytes_uploaded + sum(
+                part_slice.tell()
+                for part_slice in self.__active_parts.values())
+
+    def __upload_part(self, part, bucket, source_fd):
+        part_s3path = '/'.join((bucket, part.key))
         self.log.info('Uploading part %s (bytes %i-%i)', part_s3path,
                       part.start, part.end)
-        part_pbar_label = pbar_label_template.format(
-            fname=os.path.basename(part.key), index=(part.index + 1))
-        with open(self.args['source']) as source:
-            source.seek(part.start)
+        part_size = part.end - part.start + 1
+        part_slice = _FileSlice(source_fd, part.start, part_size)
+        with self._lock:
+            self.__active_parts[part.index] = part_slice
+        try:
             put_req = PutObject.from_other(
                 self, service=self.args['s3_service'],
-                auth=self.args['s3_auth'], source=source, dest=part_s3path,
-                size=(part.end - part.start + 1),
-                show_progress=self.args.get('show_progress', False),
-                progressbar_label=part_pbar_label)
-            return put_req.main()
+                auth=self.args['s3_auth'], source=part_slice,
+                dest=part_s3path, size=part_size, show_progress=False)
+            put_req.main()
+        finally:
+            with self._lock:
+                del self.__active_parts[part.index]
+        with self._lock:
+            self.__part_bytes_uploaded += part_size
+
+
+class _FileSlice(object):
+    """
+    A read-only file-like view of part of a file that many threads can
+    read from at the same time through a single file descriptor
+    """
+
+    # Python 2 has no os.pread, so reads that seek first have to take
+    # turns.
+    __seek_lock = threading.Lock()
+
+    def __init__(self, fileno, offset, size):
+        self.fileno = fileno
+        self.offset = offset
+        self.size = size
+        self.__pos = 0
+
+    def close(self):
+        # The file descriptor belongs to whoever created this
+        pass
+
+    def read(self, size=-1):
+        remaining = self.size - self.__pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        if hasattr(os, 'pread'):
+            chunk = os.pread(self.fileno, size, self.offset + self.__pos)
+        else:
+            with self.__seek_lock:
+                os.lseek(self.fileno, self.offset + self.__pos, os.SEEK_SET)
+                chunk = os.read(self.fileno, size)
+        self.__pos += len(chunk)
+        return chunk
+
+    def seek(self, pos):
+        self.__pos = pos
+
+    def tell(self):
+        return self.__pos
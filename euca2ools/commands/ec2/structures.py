@@ -84,7 +84,7 @@ class ImportManifest(object):
         # Our version
         xml.importer = None
         xml.importer.name = 'euca2ools'
-        xml.importer.version = euca2ools.__version__
+        xml.importer.version = euca2ools.get_version()
         xml.importer.release = 0
 
         # Import and image part info
@@ -31,12 +31,12 @@ import requestbuilder.auth.aws
 import requestbuilder.service
 import requestbuilder.request
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class ELB(requestbuilder.service.BaseService):
+class ELB(SharedSessionServiceMixin, requestbuilder.service.BaseService):
     NAME = 'elasticloadbalancing'
     DESCRIPTION = 'Load balancing service'
     API_VERSION = '2012-06-01'
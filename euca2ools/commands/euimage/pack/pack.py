@@ -24,13 +24,17 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import contextlib
+import grp
 import hashlib
 import os
+import pwd
 import shutil
 import signal
 import subprocess
 import tarfile
-import tempfile
+import time
+
+import six
 
 import euca2ools
 from euca2ools.bundle.util import open_pipe_fileobjs
@@ -81,46 +85,78 @@ class ImagePack(object):
         pack.filename = os.path.join(destdir, '{0}.euimage'.format(
             pack.image_md.get_nvra()))
         with open(image_md_filename) as image_md_file:
-            digest = hashlib.sha256(image_md_file.read())
-            pack.pack_md.image_md_sha256sum = digest.hexdigest()
-        # Since we have to know the size of the compressed image ahead
-        # of time to write tarinfo headers we have to spool the whole
-        # thing to disk.  :-\
-        with tempfile.NamedTemporaryFile() as compressed_image:
-            # Feed stuff to a subprocess to checksum and compress in one pass
-            digest = hashlib.sha256()
-            bytes_read = 0
-            with open(image_filename, 'rb') as original_image:
-                xz_proc = subprocess.Popen(('xz', '-c'), stdin=subprocess.PIPE,
-                                           stdout=compressed_image)
-                if progressbar:
-                    progressbar.start()
-                while True:
-                    chunk = original_image.read(euca2ools.BUFSIZE)
-                    if not chunk:
-                        break
-                    digest.update(chunk)
-                    xz_proc.stdin.write(chunk)
-                    bytes_read += len(chunk)
-                    if progressbar:
-                        progressbar.update(bytes_read)
-                xz_proc.stdin.close()
-                xz_proc.wait()
-            if progressbar:
-                progressbar.finish()
-            pack.pack_md.image_sha256sum = digest.hexdigest()
-            pack.pack_md.image_size = bytes_read
-
-            # Write metadata and pack everything up
-            with contextlib.closing(tarfile.open(pack.filename, 'w',
-                                                 dereference=True)) as tarball:
-                with tempfile.NamedTemporaryFile() as pack_md_file:
-                    pack.pack_md.dump_to_fileobj(pack_md_file)
-                    tarball.add(pack_md_file.name, arcname=PACK_MD_ARCNAME)
-                tarball.add(image_md_filename, arcname=IMAGE_MD_ARCNAME)
-                tarball.add(compressed_image.name, arcname=IMAGE_ARCNAME)
+            image_md = image_md_file.read()
+        pack.pack_md.image_md_sha256sum = hashlib.sha256(image_md).hexdigest()
+        try:
+            with open(pack.filename, 'wb') as pack_file:
+                _write_tar_member(pack_file, IMAGE_MD_ARCNAME, image_md)
+                pack.__write_image_member(pack_file, image_filename,
+                                          progressbar)
+                # The pack's metadata contains the image's checksum, so
+                # it has to come after the image.
+                pack_md_file = six.BytesIO()
+                pack.pack_md.dump_to_fileobj(pack_md_file)
+                _write_tar_member(pack_file, PACK_MD_ARCNAME,
+                                  pack_md_file.getvalue())
+                _write_tar_end(pack_file)
+        except:
+            if os.path.exists(pack.filename):
+                os.remove(pack.filename)
+            raise
         return pack
 
+    def __write_image_member(self, pack_file, image_filename, progressbar):
+        """
+        Compress an image straight into a pack file as a tar member.
+        Since the compressed size is not known until xz finishes, this
+        writes the member's header with a size of zero first and then
+        goes back to fix it afterward, so the image never has to be
+        spooled to disk on its own.
+        """
+        tarinfo = _build_tarinfo(IMAGE_ARCNAME)
+        header_offset = pack_file.tell()
+        pack_file.write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+        data_offset = pack_file.tell()
+        pack_file.flush()
+        # Feed stuff to a subprocess to checksum and compress in one pass
+        digest = hashlib.sha256()
+        bytes_read = 0
+        with open(image_filename, 'rb') as original_image:
+            xz_proc = subprocess.Popen(('xz', '-c'), stdin=subprocess.PIPE,
+                                       stdout=pack_file)
+            if progressbar:
+                progressbar.start()
+            while True:
+                chunk = original_image.read(euca2ools.BUFSIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                xz_proc.stdin.write(chunk)
+                bytes_read += len(chunk)
+                if progressbar:
+                    progressbar.update(bytes_read)
+            xz_proc.stdin.close()
+            if xz_proc.wait() != 0:
+                raise subprocess.CalledProcessError(xz_proc.returncode, 'xz')
+        if progressbar:
+            progressbar.finish()
+        self.pack_md.image_sha256sum = digest.hexdigest()
+        self.pack_md.image_size = bytes_read
+
+        # xz wrote to the file descriptor behind pack_file's back, so
+        # seek to find out where it stopped.
+        pack_file.seek(0, os.SEEK_END)
+        tarinfo.size = pack_file.tell() - data_offset
+        _write_tar_padding(pack_file, tarinfo.size)
+        member_end = pack_file.tell()
+        header = tarinfo.tobuf(tarfile.GNU_FORMAT)
+        if len(header) != data_offset - header_offset:
+            raise RuntimeError('tar header for {0} changed size while '
+                               'packing'.format(IMAGE_ARCNAME))
+        pack_file.seek(header_offset)
+        pack_file.write(header)
+        pack_file.seek(member_end)
+
     def close(self):
         if self.__tarball:
             self.__tarball.close()
@@ -148,6 +184,44 @@ class ImagePack(object):
             return _PackedImageWrapper(tarball)
 
 
+def _build_tarinfo(name, size=0):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = size
+    tarinfo.mtime = time.time()
+    tarinfo.mode = 0o644
+    tarinfo.uid = os.getuid()
+    tarinfo.gid = os.getgid()
+    try:
+        tarinfo.uname = pwd.getpwuid(tarinfo.uid).pw_name
+    except KeyError:
+        pass
+    try:
+        tarinfo.gname = grp.getgrgid(tarinfo.gid).gr_name
+    except KeyError:
+        pass
+    return tarinfo
+
+
+def _write_tar_member(pack_file, name, data):
+    pack_file.write(_build_tarinfo(name, len(data)).tobuf(tarfile.GNU_FORMAT))
+    pack_file.write(data)
+    _write_tar_padding(pack_file, len(data))
+
+
+def _write_tar_padding(pack_file, size):
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        pack_file.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def _write_tar_end(pack_file):
+    # Two empty blocks, then pad to a whole record like tarfile does
+    pack_file.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    remainder = pack_file.tell() % tarfile.RECORDSIZE
+    if remainder:
+        pack_file.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+
 class _PackedImageWrapper(object):
     """
     A file-like object that transparently unpacks and decompresses the
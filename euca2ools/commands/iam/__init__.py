@@ -32,12 +32,12 @@ import requestbuilder.auth.aws
 import requestbuilder.request
 import requestbuilder.service
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class IAM(requestbuilder.service.BaseService):
+class IAM(SharedSessionServiceMixin, requestbuilder.service.BaseService):
     NAME = 'iam'
     DESCRIPTION = 'Identity and access management service'
     API_VERSION = '2010-05-08'
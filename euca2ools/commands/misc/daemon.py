@@ -0,0 +1,320 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import json
+import logging
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from requestbuilder import Arg
+from requestbuilder.command import BaseCommand
+import six
+
+from euca2ools.commands import Euca2ools
+import euca2ools.daemon
+
+
+# Matches the "euca2ools.commands.ec2.foo.Foo.run()" line in a script
+_SCRIPT_RUN_RE = re.compile(r'^\s*(euca2ools\.[\w.]+)\.(\w+)\.run\(\)',
+                            re.MULTILINE)
+
+
+class Daemon(BaseCommand):
+    DESCRIPTION = ('Run euca2ools commands on behalf of euca-client.\n\n'
+                   'Every command that this serves is imported only once, '
+                   'when it starts, and each command that a client asks it '
+                   'to run then starts in a copy of this process instead of '
+                   'a new Python interpreter.  A command runs with the '
+                   "client's arguments, environment, working directory, and "
+                   'standard input, and its output and exit status are sent '
+                   'back to the client.')
+    SUITE = Euca2ools
+    ARGS = [Arg('--socket', metavar='PATH',
+                help='''UNIX socket to listen on (default:
+                $EUCA_DAEMON_SOCKET if set, otherwise ~/.euca/daemon.sock)'''),
+            Arg('--bin-dir', metavar='DIR', help='''directory containing the
+                commands to serve (default: the directory this program is
+                in)''')]
+
+    def main(self):
+        bin_dir = self.args.get('bin_dir') or os.path.dirname(
+            os.path.abspath(sys.argv[0]))
+        commands = self.__load_commands(bin_dir)
+        # Look this up once here rather than once for every command
+        euca2ools.get_version()
+        socket_path = (self.args.get('socket') or
+                       euca2ools.daemon.get_socket_path())
+        listener = self.__listen(socket_path)
+        self.log.info('serving %i commands on %s', len(commands),
+                      socket_path)
+        signal.signal(signal.SIGCHLD, _reap_children)
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        try:
+            while True:
+                try:
+                    conn = listener.accept()[0]
+                except socket.error as err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    raise
+                pid = os.fork()
+                if pid == 0:
+                    # pylint: disable=protected-access
+                    try:
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        listener.close()
+                        _serve_connection(conn, commands)
+                    finally:
+                        os._exit(0)
+                    # pylint: enable=protected-access
+                conn.close()
+        finally:
+            listener.close()
+            os.unlink(socket_path)
+
+    def __load_commands(self, bin_dir):
+        """
+        Find the class that each script in bin_dir runs and import it,
+        returning a dict that maps script names to classes.
+        """
+        commands = {}
+        for script in sorted(os.listdir(bin_dir)):
+            path = os.path.join(bin_dir, script)
+            if not os.path.isfile(path):
+                continue
+            with open(path) as script_file:
+                match = _SCRIPT_RUN_RE.search(script_file.read())
+            if not match:
+                continue
+            module_name, class_name = match.groups()
+            try:
+                __import__(module_name)
+                cmdclass = getattr(sys.modules[module_name], class_name)
+            except Exception as err:
+                self.log.warn('skipping %s: unable to load %s.%s: %s',
+                              script, module_name, class_name, err)
+                continue
+            if issubclass(cmdclass, Daemon):
+                continue
+            commands[script] = cmdclass
+        if not commands:
+            raise ValueError('no euca2ools commands found in {0}'
+                             .format(bin_dir))
+        self.log.debug('loaded %i commands from %s', len(commands), bin_dir)
+        return commands
+
+    def __listen(self, socket_path):
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                # Left over from a daemon that did not shut down cleanly
+                self.log.info('removing stale socket %s', socket_path)
+                os.unlink(socket_path)
+            else:
+                raise ValueError('another euca-daemon is already listening '
+                                 'on {0}'.format(socket_path))
+            finally:
+                probe.close()
+        socket_dir = os.path.dirname(socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Commands run with the daemon's credentials, so only its owner
+        # may connect.
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(socket.SOMAXCONN)
+        return listener
+
+
+def _reap_children(_signum, _frame):
+    while True:
+        try:
+            pid = os.waitpid(-1, os.WNOHANG)[0]
+        except OSError:
+            return
+        if pid == 0:
+            return
+
+
+def _exit_on_signal(signum, _frame):
+    sys.exit(128 + signum)
+
+
+def _serve_connection(conn, commands):
+    """
+    Run the command a client requests in this process and send its
+    output and exit status back to the client.  This is always called in
+    a process forked just for that purpose, since it takes over the
+    process's standard streams, environment, and working directory.
+    """
+    conn_lock = threading.Lock()
+
+    def send(frame_type, payload):
+        with conn_lock:
+            euca2ools.daemon.send_frame(conn, frame_type, payload)
+
+    frame_type, payload = euca2ools.daemon.recv_frame(conn)
+    if frame_type != euca2ools.daemon.FRAME_REQUEST:
+        return
+    request = json.loads(payload.decode('utf-8'))
+    argv = [_native_str(arg) for arg in request['argv']]
+    cmdclass = commands.get(os.path.basename(argv[0]))
+    if cmdclass is None:
+        send(euca2ools.daemon.FRAME_STDERR,
+             'euca-daemon: {0}: command not found\n'.format(argv[0]))
+        send(euca2ools.daemon.FRAME_EXIT, b'127')
+        return
+    try:
+        os.chdir(request['cwd'])
+    except OSError as err:
+        send(euca2ools.daemon.FRAME_STDERR,
+             'euca-daemon: {0}: {1}\n'.format(request['cwd'], err.strerror))
+        send(euca2ools.daemon.FRAME_EXIT, b'1')
+        return
+    os.environ.clear()
+    for key, val in six.iteritems(request['env']):
+        os.environ[_native_str(key)] = _native_str(val)
+    sys.argv = argv
+    # Each of these processes would otherwise start from the same state
+    random.seed()
+    # Commands set their loggers' levels themselves, but the daemon's own
+    # --debug may have already set some of them.
+    for logger in six.itervalues(logging.Logger.manager.loggerDict):
+        if isinstance(logger, logging.Logger):
+            logger.setLevel(logging.NOTSET)
+
+    # Replace stdin, stdout, and stderr with pipes that threads connect
+    # to the client.  Commands and any programs they run use the usual
+    # file descriptors without knowing the difference.
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    os.dup2(stdin_r, 0)
+    os.dup2(stdout_w, 1)
+    os.dup2(stderr_w, 2)
+    for fileno in (stdin_r, stdout_w, stderr_w):
+        os.close(fileno)
+    threads = [threading.Thread(target=_forward_input,
+                                args=(conn, stdin_w)),
+               threading.Thread(target=_forward_output,
+                                args=(stdout_r, send,
+                                      euca2ools.daemon.FRAME_STDOUT)),
+               threading.Thread(target=_forward_output,
+                                args=(stderr_r, send,
+                                      euca2ools.daemon.FRAME_STDERR))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    exit_code = _run_command(cmdclass)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.close(1)
+    os.close(2)
+    for thread in threads[1:]:
+        thread.join()
+    send(euca2ools.daemon.FRAME_EXIT, str(exit_code).encode('ascii'))
+
+
+def _run_command(cmdclass):
+    try:
+        cmdclass.run()
+    except SystemExit as err:
+        if err.code is None:
+            return 0
+        if isinstance(err.code, six.integer_types):
+            return err.code
+        print >> sys.stderr, err.code
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        # run() only lets these through when debugging is on
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def _forward_input(conn, stdin_w):
+    # Even once the command's stdin is closed this keeps reading from the
+    # connection, since that is how we notice the client going away.
+    while True:
+        try:
+            frame_type, payload = euca2ools.daemon.recv_frame(conn)
+        except (EOFError, socket.error):
+            frame_type = None
+        if frame_type is None:
+            # The client went away, so nobody wants the command's output
+            # any more.
+            # pylint: disable=protected-access
+            os._exit(1)
+            # pylint: enable=protected-access
+        if stdin_w is None:
+            # Nothing else should come after the end of stdin
+            continue
+        if not payload:
+            os.close(stdin_w)
+            stdin_w = None
+            continue
+        try:
+            os.write(stdin_w, payload)
+        except OSError:
+            # The command closed its stdin without reading all of it
+            os.close(stdin_w)
+            stdin_w = None
+
+
+def _forward_output(fileno, send, frame_type):
+    while True:
+        data = os.read(fileno, euca2ools.BUFSIZE)
+        if not data:
+            break
+        try:
+            send(frame_type, data)
+        except socket.error:
+            # pylint: disable=protected-access
+            os._exit(1)
+            # pylint: enable=protected-access
+    os.close(fileno)
+
+
+def _native_str(value):
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
@@ -32,12 +32,13 @@ from requestbuilder.mixins import TabifyingMixin
 from requestbuilder.request import AWSQueryRequest
 import requestbuilder.service
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class CloudWatch(requestbuilder.service.BaseService):
+class CloudWatch(SharedSessionServiceMixin,
+                 requestbuilder.service.BaseService):
     NAME = 'monitoring'
     DESCRIPTION = 'Instance monitoring service'
     API_VERSION = '2010-08-01'
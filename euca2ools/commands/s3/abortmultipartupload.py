@@ -0,0 +1,49 @@
+# Copyright 2013-2014 Eucalyptus Systems, Inc.
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+
+from euca2ools.commands.s3 import S3Request
+
+
+class AbortMultipartUpload(S3Request):
+    DESCRIPTION = ('Abort a multipart upload and discard the parts uploaded '
+                   'for it so far')
+    ARGS = [Arg('path', metavar='BUCKET/KEY', route_to=None,
+                help='bucket and key name of the upload (required)'),
+            Arg('--upload-id', required=True, route_to=None,
+                help='ID of the upload to abort (required)')]
+    METHOD = 'DELETE'
+
+    def configure(self):
+        S3Request.configure(self)
+        if '/' not in self.args['path']:
+            raise ArgumentError("path '{0}' must include a key name"
+                                .format(self.args['path']))
+
+    def preprocess(self):
+        self.path = self.args['path']
+        self.params['uploadId'] = self.args['upload_id']
@@ -0,0 +1,82 @@
+# Copyright 2013-2014 Eucalyptus Systems, Inc.
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import xml.etree.ElementTree as ET
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+from requestbuilder.xmlparse import parse_aws_xml
+
+from euca2ools.commands.s3 import S3Request
+
+
+def _part_number_and_etag(part_str):
+    part_number, _, etag = part_str.partition(':')
+    if not part_number or not etag:
+        raise ValueError("part '{0}' must have format NUMBER:ETAG"
+                         .format(part_str))
+    return (int(part_number), etag.strip('"'))
+
+
+class CompleteMultipartUpload(S3Request):
+    DESCRIPTION = 'Assemble the uploaded parts of a multipart upload'
+    ARGS = [Arg('path', metavar='BUCKET/KEY', route_to=None,
+                help='bucket and key name of the upload (required)'),
+            Arg('--upload-id', required=True, route_to=None,
+                help='ID of the upload to complete (required)'),
+            Arg('--part', dest='parts', metavar='NUMBER:ETAG',
+                action='append', required=True, route_to=None,
+                type=_part_number_and_etag, help='''number and ETag of a
+                part to include in the object (required)''')]
+    METHOD = 'POST'
+
+    def configure(self):
+        S3Request.configure(self)
+        if '/' not in self.args['path']:
+            raise ArgumentError("path '{0}' must include a key name"
+                                .format(self.args['path']))
+
+    def preprocess(self):
+        self.path = self.args['path']
+        self.params['uploadId'] = self.args['upload_id']
+        cmu = ET.Element('CompleteMultipartUpload')
+        for part_number, etag in sorted(self.args['parts']):
+            xml_part = ET.SubElement(cmu, 'Part')
+            ET.SubElement(xml_part, 'PartNumber').text = str(part_number)
+            ET.SubElement(xml_part, 'ETag').text = '"{0}"'.format(etag)
+        self.body = ET.tostring(cmu)
+
+    def parse_response(self, response):
+        # S3 can report a failure with an error document in a 200 response
+        # after it has started sending whitespace to keep the connection
+        # alive, so a successful status code alone does not mean success.
+        response_dict = self.log_and_parse_response(response, parse_aws_xml)
+        if 'Error' in response_dict:
+            error = response_dict['Error'] or {}
+            raise RuntimeError('failed to complete multipart upload: '
+                               '{0}: {1}'.format(error.get('Code'),
+                                                 error.get('Message')))
+        return response_dict['CompleteMultipartUploadResult']
+
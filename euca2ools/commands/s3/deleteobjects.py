@@ -0,0 +1,207 @@
+# Copyright (c) 2013-2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import hashlib
+import multiprocessing.pool
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+from requestbuilder.xmlparse import parse_aws_xml
+import six
+
+from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.deleteobject import DeleteObject
+from euca2ools.commands.s3.listbucket import ListBucket
+from euca2ools.exceptions import AWSError
+
+
+DEFAULT_DELETE_THREADS = 8
+MAX_KEYS_PER_REQUEST = 1000  # S3's limit
+
+
+class DeleteObjects(S3Request):
+    DESCRIPTION = ('Delete many objects from a bucket at once\n\nUp to {0} '
+                   'objects are deleted with each request.  If the server '
+                   'does not support deleting more than one object per '
+                   'request the objects are deleted one at a time on '
+                   'several threads instead.'.format(MAX_KEYS_PER_REQUEST))
+    ARGS = [Arg('bucket', metavar='BUCKET', route_to=None,
+                help='bucket to delete objects from (required)'),
+            Arg('keys', metavar='KEY', nargs='*', route_to=None,
+                help='key name of an object to delete'),
+            Arg('--prefix', route_to=None,
+                help='delete every object whose key starts with PREFIX'),
+            Arg('-f', '--keys-file', metavar='FILE', route_to=None,
+                help='''delete the objects whose key names are listed in
+                FILE, one per line.  If FILE is "-" the key names are read
+                from stdin.'''),
+            Arg('--threads', metavar='N', type=int, route_to=None,
+                help='''number of objects to delete at once when the
+                server does not support deleting many objects with one
+                request (default: {0})'''.format(DEFAULT_DELETE_THREADS))]
+    METHOD = 'POST'
+
+    def __init__(self, **kwargs):
+        S3Request.__init__(self, **kwargs)
+        self.__multi_delete_supported = True
+
+    def configure(self):
+        S3Request.configure(self)
+        if '/' in self.args['bucket']:
+            raise ArgumentError('bucket name must not contain "/"; use '
+                                '--prefix to delete objects under a path')
+        if (not self.args.get('keys') and self.args.get('prefix') is None and
+                not self.args.get('keys_file')):
+            raise ArgumentError('at least one key name, --prefix, or '
+                                '--keys-file is required')
+        if (self.args.get('threads') is not None and
+                self.args['threads'] < 1):
+            raise ArgumentError('argument --threads must be at least 1')
+
+    def preprocess(self):
+        self.path = self.args['bucket']
+        self.params['delete'] = ''
+
+    def main(self):
+        self.preprocess()
+        results = {'deleted': 0, 'failed': []}
+        batch = []
+        for key in self.__iter_keys():
+            batch.append(key)
+            if len(batch) >= MAX_KEYS_PER_REQUEST:
+                self.__delete_batch(batch, results)
+                batch = []
+        if batch:
+            self.__delete_batch(batch, results)
+        results['failed'].sort()
+        return results
+
+    def parse_response(self, response):
+        response_dict = self.log_and_parse_response(
+            response, parse_aws_xml, list_item_tags=('Deleted', 'Error'))
+        if 'Error' in response_dict:
+            # Like CompleteMultipartUpload, this can fail in a 200 response
+            error = response_dict['Error'][0] or {}
+            raise RuntimeError('failed to delete objects: {0}: {1}'
+                               .format(error.get('Code'),
+                                       error.get('Message')))
+        return response_dict['DeleteResult'] or {}
+
+    def print_result(self, result):
+        for key, err in result['failed']:
+            print >> sys.stderr, 'failed: {0}: {1}'.format(key, err)
+        if result['failed']:
+            raise RuntimeError('failed to delete {0} of {1} objects'
+                               .format(len(result['failed']),
+                                       len(result['failed']) +
+                                       result['deleted']))
+
+    def __iter_keys(self):
+        for key in self.args.get('keys') or []:
+            yield key
+        if self.args.get('keys_file'):
+            if self.args['keys_file'] == '-':
+                keys_file = sys.stdin
+            else:
+                keys_file = open(self.args['keys_file'])
+            try:
+                for line in keys_file:
+                    key = line.rstrip('\r\n')
+                    if key:
+                        yield key
+            finally:
+                if keys_file is not sys.stdin:
+                    keys_file.close()
+        if self.args.get('prefix') is not None:
+            req = ListBucket.from_other(
+                self, paths=['/'.join((self.args['bucket'],
+                                       self.args['prefix']))])
+            for obj in req.main()['Contents']:
+                yield obj['Key']
+
+    def __delete_batch(self, keys, results):
+        if not self.__multi_delete_supported:
+            self.__delete_concurrently(keys, results)
+            return
+        delete = ET.Element('Delete')
+        # Only report the objects that could not be deleted
+        ET.SubElement(delete, 'Quiet').text = 'true'
+        for key in keys:
+            xml_object = ET.SubElement(delete, 'Object')
+            ET.SubElement(xml_object, 'Key').text = key
+        self.body = ET.tostring(delete)
+        # S3 requires Content-MD5 for this request
+        self.headers['Content-MD5'] = base64.b64encode(
+            hashlib.md5(self.body).digest())
+        self.log.info('deleting %i objects from %s', len(keys),
+                      self.args['bucket'])
+        try:
+            response = self.send()
+        except AWSError as err:
+            if err.status_code not in (405, 501):
+                raise
+            self.log.info('server does not support deleting multiple '
+                          'objects per request (%s); deleting them one at a '
+                          'time instead', err.code or err.status_code)
+            self.__multi_delete_supported = False
+            self.__delete_concurrently(keys, results)
+            return
+        errors = response.get('Error', [])
+        for error in errors:
+            results['failed'].append((error.get('Key'), '{0}: {1}'.format(
+                error.get('Code'), error.get('Message'))))
+        results['deleted'] += len(keys) - len(errors)
+
+    def __delete_concurrently(self, keys, results):
+        results_lock = threading.Lock()
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('threads') or DEFAULT_DELETE_THREADS)
+        try:
+            for key in keys:
+                pool.apply_async(self.__delete_object_safely,
+                                 (key, results, results_lock))
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+
+    def __delete_object_safely(self, key, results, results_lock):
+        # This runs in a thread pool, where nobody would see an exception
+        try:
+            req = DeleteObject.from_other(
+                self, path='/'.join((self.args['bucket'], key)))
+            req.main()
+        except Exception as err:
+            self.log.error('failed to delete %s', key, exc_info=True)
+            with results_lock:
+                results['failed'].append((key, six.text_type(err)))
+        else:
+            with results_lock:
+                results['deleted'] += 1
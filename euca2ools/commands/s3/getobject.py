@@ -23,7 +23,9 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import hashlib
+import multiprocessing.pool
 import os.path
 import sys
 
@@ -32,8 +34,13 @@ from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.s3 import S3Request
 import euca2ools.bundle.pipes
+from euca2ools.exceptions import AWSError
+
+
+DEFAULT_RANGE_SIZE = 8 * 2 ** 20  # 8 MiB
 
 
 class GetObject(S3Request, FileTransferProgressBarMixin):
@@ -45,7 +52,14 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
                 directory the object will be written to a file inside of that
                 directory.  If this is is "-" the object will be written to
                 stdout.  Otherwise it will be written to a file with the name
-                given.  (default:  current directory)''')]
+                given.  (default:  current directory)'''),
+            Arg('--parallel', metavar='N', type=int, route_to=None,
+                help='''download N pieces of the object at once over
+                separate connections (default: 1)'''),
+            Arg('--range-size', metavar='BYTES', type=filesize,
+                route_to=None, help='''size of each piece to download
+                when using --parallel (default: {0} MiB)'''.format(
+                    DEFAULT_RANGE_SIZE // 2 ** 20))]
 
     def configure(self):
         S3Request.configure(self)
@@ -55,6 +69,11 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
             raise ArgumentError('source must contain a bucket name')
         if not key:
             raise ArgumentError('source must contain a key name')
+        if self.args.get('parallel') is not None and self.args['parallel'] < 1:
+            raise ArgumentError('argument --parallel must be at least 1')
+        if (self.args.get('range_size') is not None and
+                self.args['range_size'] < 1):
+            raise ArgumentError('argument --range-size must be at least 1')
 
         if isinstance(self.args.get('dest'), six.string_types):
             # If it is not a string we assume it is a file-like object
@@ -79,15 +98,25 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
         bytes_written = 0
         md5_digest = hashlib.md5()
         sha_digest = hashlib.sha1()
-        response = self.send()
-        content_length = response.headers.get('Content-Length')
+        parallel = self.args.get('parallel') or 1
+        range_size = self.args.get('range_size') or DEFAULT_RANGE_SIZE
+        response = self.__send_first_request(parallel, range_size)
+        if response.status_code == 206:
+            # Content-Range looks like "bytes 0-1023/4096"
+            content_length = response.headers['Content-Range'].rpartition(
+                '/')[2]
+            chunks = self.__iter_ranges(response, int(content_length),
+                                        parallel, range_size)
+        else:
+            content_length = response.headers.get('Content-Length')
+            chunks = response.iter_content(chunk_size=euca2ools.BUFSIZE)
         if content_length:
             pbar = self.get_progressbar(label=self.args['source'],
                                         maxval=int(content_length))
         else:
             pbar = self.get_progressbar(label=self.args['source'])
         pbar.start()
-        for chunk in response.iter_content(chunk_size=euca2ools.BUFSIZE):
+        for chunk in chunks:
             self.args['dest'].write(chunk)
             bytes_written += len(chunk)
             md5_digest.update(chunk)
@@ -120,3 +149,74 @@ class GetObject(S3Request, FileTransferProgressBarMixin):
         return {self.args['source']: {'md5': md5_digest.hexdigest(),
                                       'sha1': sha_digest.hexdigest(),
                                       'size': bytes_written}}
+
+    def __send_first_request(self, parallel, range_size):
+        if parallel <= 1:
+            return self.send()
+        # Ask for just the first range.  The response tells us how large
+        # the object is, and servers that do not support ranges simply
+        # send the whole thing.
+        self.headers['Range'] = 'bytes=0-{0}'.format(range_size - 1)
+        try:
+            return self.send()
+        except AWSError as err:
+            if err.status_code != 416:
+                raise
+            # The object is empty, so there is no first byte to ask for
+            self.log.debug('range not satisfiable; downloading the whole '
+                           'object')
+            del self.headers['Range']
+            return self.send()
+        finally:
+            self.headers.pop('Range', None)
+
+    def __iter_ranges(self, first_response, size, parallel, range_size):
+        """
+        Yield an object's contents in order, starting with the response
+        to a request for its first range and fetching the remaining
+        ranges concurrently.  At most twice as many ranges as there are
+        threads are held in memory at once.
+        """
+        etag = first_response.headers.get('ETag')
+        ranges = collections.deque(
+            (start, min(start + range_size, size) - 1)
+            for start in six.moves.range(range_size, size, range_size))
+        pool = multiprocessing.pool.ThreadPool(parallel)
+        pending = collections.deque()
+        try:
+            while ranges and len(pending) < parallel * 2:
+                start, end = ranges.popleft()
+                pending.append(pool.apply_async(self.__fetch_range,
+                                                (start, end, etag)))
+            for chunk in first_response.iter_content(
+                    chunk_size=euca2ools.BUFSIZE):
+                yield chunk
+            while pending:
+                chunk = pending.popleft().get()
+                if ranges:
+                    start, end = ranges.popleft()
+                    pending.append(pool.apply_async(self.__fetch_range,
+                                                    (start, end, etag)))
+                yield chunk
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    def __fetch_range(self, start, end, etag):
+        req = GetObject.from_other(self, source=self.args['source'],
+                                   dest=None)
+        req.preprocess()
+        req.headers['Range'] = 'bytes={0}-{1}'.format(start, end)
+        if etag:
+            # Fail rather than mix pieces of different versions of the
+            # object if it changes while we are downloading it
+            req.headers['If-Match'] = etag
+        response = req.send()
+        chunk = response.content
+        if response.status_code != 206 or len(chunk) != end - start + 1:
+            raise RuntimeError('server returned the wrong data for bytes '
+                               '{0}-{1} of {2} (status: {3}, size: {4})'
+                               .format(start, end, self.args['source'],
+                                       response.status_code, len(chunk)))
+        return chunk
@@ -0,0 +1,68 @@
+# Copyright 2013-2014 Eucalyptus Systems, Inc.
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+from requestbuilder.xmlparse import parse_aws_xml
+
+from euca2ools.commands.s3 import S3Request
+
+
+class InitiateMultipartUpload(S3Request):
+    DESCRIPTION = 'Start a multipart upload'
+    ARGS = [Arg('dest', metavar='BUCKET/KEY', route_to=None,
+                help='bucket and key name of the object to create (required)'),
+            Arg('--acl', route_to=None, choices=(
+                'private', 'public-read', 'public-read-write',
+                'authenticated-read', 'bucket-owner-read',
+                'bucket-owner-full-control', 'aws-exec-read')),
+            Arg('--mime-type', route_to=None,
+                help='MIME type for the object being uploaded')]
+    METHOD = 'POST'
+
+    def configure(self):
+        S3Request.configure(self)
+        bucket, _, key = self.args['dest'].partition('/')
+        if not bucket:
+            raise ArgumentError('destination bucket name must be non-empty')
+        if not key:
+            raise ArgumentError('destination key name must be non-empty')
+
+    def preprocess(self):
+        self.path = self.args['dest']
+        self.params['uploads'] = ''
+        if self.args.get('acl'):
+            self.headers['x-amz-acl'] = self.args['acl']
+        if self.args.get('mime_type'):
+            self.headers['Content-Type'] = self.args['mime_type']
+
+    def parse_response(self, response):
+        response_dict = self.log_and_parse_response(response, parse_aws_xml)
+        return response_dict['InitiateMultipartUploadResult']
+
+    # pylint: disable=no-self-use
+    def print_result(self, result):
+        print result.get('UploadId')
+    # pylint: enable=no-self-use
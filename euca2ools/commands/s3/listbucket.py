@@ -24,22 +24,58 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import collections
+import itertools
+import multiprocessing.pool
+import sys
+import threading
 
+import lxml.etree
 from requestbuilder import Arg
 from requestbuilder.exceptions import ArgumentError
 from requestbuilder.mixins import TabifyingMixin
 from requestbuilder.response import PaginatedResponse
-from requestbuilder.xmlparse import parse_aws_xml
+import six
 
+from euca2ools.commands.argtypes import delimited_list
 from euca2ools.commands.s3 import S3Request, validate_generic_bucket_name
 
 
+# A bucket may have thousands of top-level prefixes, but listing each part
+# takes at least one request and can read up to a page past its end, so
+# use no more than this many parts per thread.
+MAX_PARTS_PER_THREAD = 2
+
+# How many pages of keys listing each part of a bucket in parallel may
+# fetch ahead of those that have been consumed
+MAX_PAGES_PER_PART = 2
+
+
 class ListBucket(S3Request, TabifyingMixin):
     DESCRIPTION = 'List keys in one or more buckets'
     ARGS = [Arg('paths', metavar='BUCKET[/KEY]', nargs='+', route_to=None),
+            Arg('--delimiter', metavar='CHAR', route_to=None,
+                help='''list keys that contain CHAR after the prefix as a
+                single entry that ends with CHAR, much like a directory'''),
+            Arg('--start-after', metavar='KEY', route_to=None,
+                help='list only keys that sort after KEY'),
+            Arg('--max-items', metavar='N', type=int, route_to=None,
+                help='stop after listing N keys'),
+            Arg('--parallel', metavar='N', type=int, route_to=None,
+                help='''list N parts of each bucket at once.  Unless
+                --split-points is also given, each bucket is divided into
+                parts at its top-level prefixes, such as "photos/" and
+                "videos/".'''),
+            Arg('--split-points', metavar='KEY,...', route_to=None,
+                type=delimited_list(','), help='''keys at which to divide
+                each bucket into parts that --parallel lists at once'''),
             Arg('--max-keys-per-request', dest='max-keys', type=int,
                 default=argparse.SUPPRESS, help=argparse.SUPPRESS)]
 
+    def __init__(self, **kwargs):
+        S3Request.__init__(self, **kwargs)
+        self.__items_left = None
+
     # noinspection PyExceptionInherit
     def configure(self):
         S3Request.configure(self)
@@ -54,15 +90,52 @@ class ListBucket(S3Request, TabifyingMixin):
             except ValueError as err:
                 raise ArgumentError(
                     'bucket "{0}": {1}'.format(bucket, err.message))
+        if (self.args.get('max_items') is not None and
+                self.args['max_items'] < 1):
+            raise ArgumentError('argument --max-items must be at least 1')
+        if self.args.get('parallel') is not None:
+            if self.args['parallel'] < 1:
+                raise ArgumentError('argument --parallel must be at least 1')
+            if self.args.get('delimiter'):
+                raise ArgumentError('argument --parallel may not be used '
+                                    'with --delimiter')
 
     def main(self):
         self.method = 'GET'
-        pages = [(path, {}) for path in self.args['paths']]
+        if (self.args.get('parallel') or 1) > 1:
+            contents = self.__iter_partitioned_listing()
+            if self.args.get('max_items'):
+                contents = itertools.islice(contents, self.args['max_items'])
+            return {'Contents': contents}
+        self.__items_left = self.args.get('max_items')
+        if self.args.get('start_after'):
+            pages = [(path, {'marker': self.args['start_after']})
+                     for path in self.args['paths']]
+        else:
+            pages = [(path, {}) for path in self.args['paths']]
+        if self.args.get('delimiter'):
+            return PaginatedResponse(self, pages,
+                                     ('Contents', 'CommonPrefixes'))
         return PaginatedResponse(self, pages, ('Contents',))
 
     def get_next_page(self, response):
+        if self.__items_left is not None:
+            self.__items_left -= _truncate_listing(response,
+                                                   self.__items_left)
+            if self.__items_left <= 0:
+                return None
         if response.get('IsTruncated') == 'true':
-            return self.path, {'marker': response['Contents'][-1]['Key']}
+            # Listings that use a delimiter include NextMarker because
+            # they may end with a common prefix instead of a key.
+            marker = response.get('NextMarker') or max(
+                [obj['Key'] for obj in response.get('Contents', [])[-1:]] +
+                [prefix['Prefix'] for prefix
+                 in response.get('CommonPrefixes', [])[-1:]])
+            if self.params.get('prefix'):
+                path = '/'.join((self.path, self.params['prefix']))
+            else:
+                path = self.path
+            return path, {'marker': marker}
 
     def prepare_for_page(self, page):
         bucket, _, prefix = page[0].partition('/')
@@ -76,15 +149,218 @@ class ListBucket(S3Request, TabifyingMixin):
             self.params['marker'] = markers['marker']
         elif 'marker' in self.params:
             del self.params['marker']
+        if self.args.get('delimiter'):
+            self.params['delimiter'] = self.args['delimiter']
+        if self.__items_left is not None:
+            self.params['max-keys'] = min(self.__items_left,
+                                          self.args.get('max-keys') or 1000)
 
     def parse_response(self, response):
-        response_dict = self.log_and_parse_response(
-            response, parse_aws_xml,
-            list_item_tags=('Contents', 'CommonPrefixes'))
-        return response_dict['ListBucketResult']
+        return self.log_and_parse_response(response,
+                                           _parse_list_bucket_result)
 
     # pylint: disable=no-self-use
     def print_result(self, result):
-        for obj in result.get('Contents', []):
-            print obj.get('Key')
+        if not isinstance(result, PaginatedResponse):
+            # A partitioned listing's keys are already in order
+            for obj in result.get('Contents', []):
+                print obj.get('Key')
+            return
+        # Keys and common prefixes come back in separate lists, so print
+        # each page's worth of them in order before fetching the next.
+        for contents, prefixes in _iter_pages(result):
+            names = [obj.get('Key') for obj in contents]
+            names.extend(prefix.get('Prefix') for prefix in prefixes)
+            for name in sorted(names):
+                print name
     # pylint: enable=no-self-use
+
+    def __iter_partitioned_listing(self):
+        parallel = self.args['parallel']
+        for path in self.args['paths']:
+            split_points = self.__get_split_points(path, parallel)
+            start_after = self.args.get('start_after')
+            if start_after:
+                split_points = [point for point in split_points
+                                if point > start_after]
+            # Each part contains the keys after its first bound up to and
+            # including its second.
+            parts = collections.deque(zip([start_after] + split_points,
+                                          split_points + [None]))
+            self.log.info('listing %s in %i parts', path, len(parts))
+            pool = multiprocessing.pool.ThreadPool(parallel)
+            stopped = threading.Event()
+            listings = collections.deque()
+            try:
+                # Every part that is being listed has a thread of its own,
+                # so the part whose keys come next never waits for a
+                # thread that is blocked on another part's full queue.
+                while parts and len(listings) < parallel:
+                    listings.append(self.__start_listing_partition(
+                        pool, path, parts.popleft(), stopped))
+                while listings:
+                    page_queue = listings[0]
+                    page = page_queue.get()
+                    if page is None:
+                        # That part is done
+                        listings.popleft()
+                        if parts:
+                            listings.append(self.__start_listing_partition(
+                                pool, path, parts.popleft(), stopped))
+                        continue
+                    contents, exc_info = page
+                    if exc_info is not None:
+                        six.reraise(*exc_info)
+                    for obj in contents:
+                        yield obj
+                pool.close()
+                pool.join()
+            finally:
+                stopped.set()
+                pool.terminate()
+
+    def __get_split_points(self, path, parallel):
+        if self.args.get('split_points'):
+            return sorted(set(self.args['split_points']))
+        req = ListBucket.from_other(self, paths=[path], delimiter='/')
+        split_points = []
+        for _, prefixes in _iter_pages(req.main()):
+            if not prefixes and not split_points:
+                # Going through the rest of a bucket that is not organized
+                # into prefixes would take as long as listing all of it.
+                break
+            split_points.extend(prefix['Prefix'] for prefix in prefixes)
+        if not split_points:
+            self.log.info('%s has no prefixes to divide it at; listing it '
+                          'in one part', path)
+        max_parts = parallel * MAX_PARTS_PER_THREAD
+        if len(split_points) >= max_parts:
+            split_points = [split_points[i * len(split_points) // max_parts]
+                            for i in range(1, max_parts)]
+        return split_points
+
+    def __start_listing_partition(self, pool, path, part, stopped):
+        page_queue = six.moves.queue.Queue(maxsize=MAX_PAGES_PER_PART)
+        pool.apply_async(self.__list_partition,
+                         (path, part[0], part[1], page_queue, stopped))
+        return page_queue
+
+    def __list_partition(self, path, start, end, page_queue, stopped):
+        """
+        List the keys after start up to and including end, passing each
+        page of them to page_queue as a (contents, None) tuple, followed
+        by None.  If something goes wrong, pass (None, exc_info) instead
+        of the next page.  Stop early if stopped gets set.
+        """
+        try:
+            kwargs = {'paths': [path], 'start_after': start}
+            if self.args.get('max-keys'):
+                kwargs['max-keys'] = self.args['max-keys']
+            req = ListBucket.from_other(self, **kwargs)
+            for contents, _ in _iter_pages(req.main()):
+                if end is not None and contents and \
+                        contents[-1]['Key'] > end:
+                    contents = [obj for obj in contents if obj['Key'] <= end]
+                    _put_unless_stopped(page_queue, (contents, None),
+                                        stopped)
+                    break
+                if not _put_unless_stopped(page_queue, (contents, None),
+                                           stopped):
+                    return
+        except Exception:
+            _put_unless_stopped(page_queue, (None, sys.exc_info()), stopped)
+        _put_unless_stopped(page_queue, None, stopped)
+
+
+def _put_unless_stopped(queue, item, stopped):
+    """
+    Put an item in a queue, waiting for room in it unless stopped gets
+    set first.  Return whether the item made it into the queue.
+    """
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except six.moves.queue.Full:
+            pass
+    return False
+
+
+def _iter_pages(response):
+    """
+    Iterate over a ListBucket PaginatedResponse one page at a time,
+    yielding each page's keys and common prefixes.  Unlike iterating over
+    response['Contents'] this does not stop at a page with no keys, which
+    a listing that uses a delimiter may return.
+    """
+    while True:
+        contents = list(response.iter_cache.get('Contents', []))
+        prefixes = list(response.iter_cache.get('CommonPrefixes', []))
+        for items in response.iter_cache.values():
+            del items[:]
+        yield contents, prefixes
+        try:
+            response.fetch_next_page()
+        except StopIteration:
+            return
+
+
+def _parse_list_bucket_result(xml_stream):
+    """
+    Parse a ListBucketResult document into a dict like the one
+    requestbuilder's parse_aws_xml would return for it, but without
+    building dicts for anything other than keys and common prefixes,
+    which is several times faster for large listings.
+    """
+    result = {}
+    try:
+        for _, elem in lxml.etree.iterparse(
+                xml_stream, tag=('{*}Contents', '{*}CommonPrefixes',
+                                 '{*}ListBucketResult')):
+            tag = elem.tag.rpartition('}')[2]
+            if tag == 'ListBucketResult':
+                # Everything left in the document is a simple value
+                for child in elem:
+                    result[child.tag.rpartition('}')[2]] = child.text
+            else:
+                result.setdefault(tag, []).append(_element_to_dict(elem))
+                # Free up the memory the item uses
+                elem.getparent().remove(elem)
+    except lxml.etree.XMLSyntaxError:
+        raise ValueError('XML parse error')
+    return result
+
+
+def _element_to_dict(elem):
+    elem_dict = {}
+    for child in elem:
+        tag = child.tag.rpartition('}')[2]
+        if len(child):
+            elem_dict[tag] = _element_to_dict(child)
+        elif child.text is not None:
+            elem_dict[tag] = child.text
+        else:
+            # Match parse_aws_xml, which uses {} for empty elements
+            elem_dict[tag] = {}
+    return elem_dict
+
+
+def _truncate_listing(response, max_items):
+    """
+    Trim a page of listing results so it contains at most max_items keys
+    and common prefixes, and return the number that remain.
+    """
+    names = sorted(
+        [obj['Key'] for obj in response.get('Contents', [])] +
+        [prefix['Prefix'] for prefix in response.get('CommonPrefixes', [])])
+    if len(names) > max_items:
+        last_name = names[max_items - 1]
+        if 'Contents' in response:
+            response['Contents'] = [obj for obj in response['Contents']
+                                    if obj['Key'] <= last_name]
+        if 'CommonPrefixes' in response:
+            response['CommonPrefixes'] = [
+                prefix for prefix in response['CommonPrefixes']
+                if prefix['Prefix'] <= last_name]
+        return max_items
+    return len(names)
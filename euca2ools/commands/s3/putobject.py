@@ -24,7 +24,9 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import copy
 import hashlib
+import multiprocessing.pool
 import sys
 import threading
 import time
@@ -34,10 +36,26 @@ import requestbuilder.exceptions
 from requestbuilder.mixins import FileTransferProgressBarMixin
 import six
 
+from euca2ools.commands.argtypes import filesize
 from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.abortmultipartupload import AbortMultipartUpload
+from euca2ools.commands.s3.completemultipartupload import \
+    CompleteMultipartUpload
+from euca2ools.commands.s3.initiatemultipartupload import \
+    InitiateMultipartUpload
+from euca2ools.commands.s3.uploadpart import UploadPart
+from euca2ools.exceptions import AWSError
 import euca2ools.util
 
 
+DEFAULT_MULTIPART_THRESHOLD = 100 * 2 ** 20  # 100 MiB
+DEFAULT_MULTIPART_CHUNK_SIZE = 16 * 2 ** 20  # 16 MiB
+DEFAULT_MULTIPART_THREADS = 4
+DEFAULT_MULTIPART_PART_RETRIES = 3
+MIN_MULTIPART_CHUNK_SIZE = 5 * 2 ** 20  # 5 MiB
+MAX_MULTIPART_PARTS = 10000
+
+
 class PutObject(S3Request, FileTransferProgressBarMixin):
     DESCRIPTION = ('Upload an object to the server\n\nNote that uploading a '
                    'large file to a region other than the one the bucket is '
@@ -58,6 +76,18 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
             Arg('--retry', dest='retries', action='store_const', const=5,
                 default=0, route_to=None,
                 help='retry interrupted uploads up to 5 times'),
+            Arg('--multipart-threshold', metavar='BYTES', type=filesize,
+                route_to=None, help='''upload files larger than this in
+                several parts at once (default: {0} MiB)'''.format(
+                    DEFAULT_MULTIPART_THRESHOLD // 2 ** 20)),
+            Arg('--multipart-chunk-size', metavar='BYTES', type=filesize,
+                route_to=None, help='''size of each part of a multipart
+                upload (default: {0} MiB)'''.format(
+                    DEFAULT_MULTIPART_CHUNK_SIZE // 2 ** 20)),
+            Arg('--multipart-threads', metavar='N', type=int, route_to=None,
+                help='''number of parts of a multipart upload to upload
+                concurrently (default: {0})'''.format(
+                    DEFAULT_MULTIPART_THREADS)),
             Arg('--progressbar-label', help=argparse.SUPPRESS)]
     METHOD = 'PUT'
 
@@ -65,6 +95,8 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
         S3Request.__init__(self, **kwargs)
         self.last_upload_error = None
         self._lock = threading.Lock()
+        self.__active_parts = {}
+        self.__part_bytes_uploaded = 0
 
     # noinspection PyExceptionInherit
     def configure(self):
@@ -90,6 +122,16 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
         if not key:
             raise requestbuilder.exceptions.ArgumentError(
                 'destination key name must be non-empty')
+        if (self.args.get('multipart_chunk_size') is not None and
+                self.args['multipart_chunk_size'] <
+                MIN_MULTIPART_CHUNK_SIZE):
+            raise requestbuilder.exceptions.ArgumentError(
+                'argument --multipart-chunk-size must be at least {0}'
+                .format(MIN_MULTIPART_CHUNK_SIZE))
+        if (self.args.get('multipart_threads') is not None and
+                self.args['multipart_threads'] < 1):
+            raise requestbuilder.exceptions.ArgumentError(
+                'argument --multipart-threads must be at least 1')
 
     def preprocess(self):
         self.path = self.args['dest']
@@ -103,14 +145,20 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
         self.preprocess()
         source = self.args['source']
 
-        # For requests >=2.11.0 it requires headers to be either str or bytes
-        self.headers['Content-Length'] = bytes(source.size)
-
         # We do the upload in another thread so the main thread can show a
         # progress bar.
-        upload_thread = threading.Thread(
-            target=self.try_send, args=(source,),
-            kwargs={'retries_left': self.args.get('retries') or 0})
+        if self.__should_use_multipart(source):
+            upload_thread = threading.Thread(target=self.try_send_multipart,
+                                             args=(source,))
+            get_bytes_uploaded = self.__get_multipart_bytes_uploaded
+        else:
+            # For requests >=2.11.0 it requires headers to be either str or
+            # bytes
+            self.headers['Content-Length'] = bytes(source.size)
+            upload_thread = threading.Thread(
+                target=self.try_send, args=(source,),
+                kwargs={'retries_left': self.args.get('retries') or 0})
+            get_bytes_uploaded = source.tell
         # The upload thread is daemonic so ^C will kill the program more
         # cleanly.
         upload_thread.daemon = True
@@ -119,7 +167,7 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
         pbar = self.get_progressbar(label=pbar_label, maxval=source.size)
         pbar.start()
         while upload_thread.is_alive():
-            pbar.update(source.tell())
+            pbar.update(get_bytes_uploaded())
             time.sleep(0.05)
         pbar.finish()
         upload_thread.join()
@@ -162,6 +210,141 @@ class PutObject(S3Request, FileTransferProgressBarMixin):
                 self.last_upload_error = err
             return
 
+    def try_send_multipart(self, source):
+        try:
+            upload_id = self.__initiate_multipart_upload()
+        except AWSError as err:
+            # Not every S3 implementation supports multipart uploads, so
+            # settle for doing things the old way.
+            self.log.warn('failed to start a multipart upload (%s); '
+                          'uploading in one piece instead', err)
+            with self._lock:
+                self.__part_bytes_uploaded = None
+            self.headers['Content-Length'] = bytes(source.size)
+            return self.try_send(
+                source, retries_left=self.args.get('retries') or 0)
+        except Exception as err:
+            with self._lock:
+                self.log.error('upload failed', exc_info=True)
+                self.last_upload_error = err
+            return
+        try:
+            etags = self.__upload_parts(source, upload_id)
+            req = CompleteMultipartUpload.from_other(
+                self, path=self.args['dest'], upload_id=upload_id,
+                parts=sorted(etags.items()))
+            req.main()
+        except Exception as err:
+            with self._lock:
+                self.log.error('upload failed', exc_info=True)
+                self.last_upload_error = err
+            try:
+                req = AbortMultipartUpload.from_other(
+                    self, path=self.args['dest'], upload_id=upload_id)
+                req.main()
+            except Exception:
+                self.log.warn('failed to abort multipart upload %s',
+                              upload_id, exc_info=True)
+
+    def __should_use_multipart(self, source):
+        # Parts are read concurrently by opening the file once for each
+        # part, so streams and file objects are uploaded in one piece.
+        if source.filename is None:
+            return False
+        threshold = (self.args.get('multipart_threshold') or
+                     DEFAULT_MULTIPART_THRESHOLD)
+        return source.size > threshold
+
+    def __get_multipart_chunk_size(self, size):
+        chunk_size = (self.args.get('multipart_chunk_size') or
+                      DEFAULT_MULTIPART_CHUNK_SIZE)
+        # S3 allows only so many parts per upload
+        return max(chunk_size, -(-size // MAX_MULTIPART_PARTS))
+
+    def __get_multipart_bytes_uploaded(self):
+        with self._lock:
+            if self.__part_bytes_uploaded is None:
+                # We fell back to a single-part upload
+                return self.args['source'].tell()
+            return self.__part_bytes_uploaded + sum(
+                part.tell() for part in self.__active_parts.values())
+
+    def __initiate_multipart_upload(self):
+        req = InitiateMultipartUpload.from_other(
+            self, dest=self.args['dest'], acl=self.args.get('acl'),
+            mime_type=self.args.get('mime_type'))
+        upload_id = req.main()['UploadId']
+        self.log.info('started multipart upload %s', upload_id)
+        return upload_id
+
+    def __upload_parts(self, source, upload_id):
+        chunk_size = self.__get_multipart_chunk_size(source.size)
+        # requestbuilder retries 500 and 503 responses by sending the same
+        # body again, which does not work with a part that was already read
+        # to the end.  Send parts through a copy of the service that leaves
+        # retrying to __upload_part, which reads the part again each time.
+        part_service = copy.copy(self.service)
+        part_service.max_retries = 0
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('multipart_threads') or DEFAULT_MULTIPART_THREADS)
+        try:
+            results = []
+            for part_no, offset in enumerate(
+                    six.moves.range(0, source.size, chunk_size), 1):
+                size = min(chunk_size, source.size - offset)
+                results.append((part_no, pool.apply_async(
+                    self.__upload_part,
+                    (source.filename, offset, size, part_no, upload_id,
+                     part_service))))
+            pool.close()
+            etags = {}
+            for part_no, result in results:
+                # This raises the first failed part's exception
+                etags[part_no] = result.get()
+            pool.join()
+            return etags
+        except:
+            pool.terminate()
+            raise
+
+    def __upload_part(self, filename, offset, size, part_no, upload_id,
+                      service):
+        retries = (self.args.get('retries') or
+                   DEFAULT_MULTIPART_PART_RETRIES)
+        for attempt_no in six.moves.range(retries + 1):
+            if attempt_no > 0:
+                time.sleep(2 ** (attempt_no - 1))
+            with open(filename) as fileobj:
+                fileobj.seek(offset)
+                part = _FileObjectExtent(fileobj, size)
+                with self._lock:
+                    self.__active_parts[part_no] = part
+                try:
+                    req = UploadPart.from_other(
+                        self, service=service, source=part,
+                        dest=self.args['dest'], upload_id=upload_id,
+                        part_number=part_no)
+                    etag = req.main()
+                except (requestbuilder.exceptions.ClientError,
+                        requestbuilder.exceptions.ServerError) as err:
+                    if (isinstance(err, requestbuilder.exceptions.ServerError)
+                            and (err.status_code or 500) < 500):
+                        # Retrying won't help with a request the server
+                        # rejected outright
+                        raise
+                    if attempt_no >= retries:
+                        raise
+                    self.log.info('retrying part %i (%i retry attempt(s) '
+                                  'remaining)', part_no, retries - attempt_no,
+                                  exc_info=True)
+                    continue
+                finally:
+                    with self._lock:
+                        del self.__active_parts[part_no]
+            with self._lock:
+                self.__part_bytes_uploaded += size
+            return etag
+
 
 class _FileObjectExtent(object):
     # By rights this class should be iterable, but if we do that then requests
@@ -0,0 +1,322 @@
+# Copyright (c) 2013-2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import calendar
+import hashlib
+import multiprocessing.pool
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from requestbuilder import Arg
+from requestbuilder.exceptions import ArgumentError
+import six
+
+import euca2ools
+from euca2ools.commands.s3 import S3Request
+from euca2ools.commands.s3.deleteobject import DeleteObject
+from euca2ools.commands.s3.getobject import GetObject
+from euca2ools.commands.s3.listbucket import ListBucket
+from euca2ools.commands.s3.putobject import PutObject
+
+
+DEFAULT_SYNC_THREADS = 8
+
+
+class Sync(S3Request):
+    DESCRIPTION = ('Synchronize a local directory with a bucket\n\nFiles '
+                   'that are missing from the destination or whose size, '
+                   'modification time, or MD5 checksum differ from the '
+                   'source are copied.  Everything else is left alone.')
+    ARGS = [Arg('directory', metavar='DIR',
+                help='local directory to synchronize (required)'),
+            Arg('s3path', metavar='BUCKET[/PREFIX]',
+                help='''bucket to synchronize, with an optional path
+                prefix (required)'''),
+            Arg('--download', action='store_true', help='''copy from the
+                bucket to the local directory instead of the other way
+                around'''),
+            Arg('--delete', action='store_true', help='''also delete
+                destination files that do not exist in the source'''),
+            Arg('--dry-run', action='store_true', help='''show what would
+                be copied or deleted without actually doing it'''),
+            Arg('--acl', choices=(
+                'private', 'public-read', 'public-read-write',
+                'authenticated-read', 'bucket-owner-read',
+                'bucket-owner-full-control', 'aws-exec-read'),
+                help='canned ACL policy to apply to uploaded objects'),
+            Arg('--threads', metavar='N', type=int,
+                default=DEFAULT_SYNC_THREADS, help='''number of files to
+                copy concurrently (default: {0})'''.format(
+                    DEFAULT_SYNC_THREADS)),
+            Arg('--retry', dest='retries', action='store_const', const=5,
+                default=0, help='retry interrupted uploads up to 5 times')]
+
+    def configure(self):
+        S3Request.configure(self)
+        bucket = self.args['s3path'].partition('/')[0]
+        if not bucket:
+            raise ArgumentError('bucket name must be non-empty')
+        if self.args['download']:
+            if (os.path.exists(self.args['directory']) and
+                    not os.path.isdir(self.args['directory'])):
+                raise ArgumentError("'{0}' is not a directory"
+                                    .format(self.args['directory']))
+        elif not os.path.isdir(self.args['directory']):
+            raise ArgumentError("directory '{0}' does not exist"
+                                .format(self.args['directory']))
+        if (self.args.get('threads') is not None and
+                self.args['threads'] < 1):
+            raise ArgumentError('argument --threads must be at least 1')
+
+    def main(self):
+        start_time = time.time()
+        local_files = self.__list_local_files()
+        remote_objects = self.__list_remote_objects()
+        if self.args.get('download'):
+            sources, dests = remote_objects, local_files
+        else:
+            sources, dests = local_files, remote_objects
+        results = {'copied': [], 'deleted': [], 'unchanged': [],
+                   'failed': []}
+        results_lock = threading.Lock()
+        pool = multiprocessing.pool.ThreadPool(
+            self.args.get('threads') or DEFAULT_SYNC_THREADS)
+        try:
+            for name in sorted(sources):
+                pool.apply_async(self.__run_safely,
+                                 (self.__copy_if_changed, name, sources[name],
+                                  dests.get(name), results, results_lock))
+            if self.args.get('delete'):
+                for name in sorted(set(dests) - set(sources)):
+                    pool.apply_async(self.__run_safely,
+                                     (self.__delete, name, None, dests[name],
+                                      results, results_lock))
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        for val in results.values():
+            val.sort()
+        results['elapsed'] = time.time() - start_time
+        return results
+
+    def print_result(self, result):
+        if self.args.get('dry_run'):
+            prefix = '(dry run) '
+        else:
+            prefix = ''
+        if self.args.get('download'):
+            verb = 'download'
+        else:
+            verb = 'upload'
+        for name, _ in result['copied']:
+            print '{0}{1}: {2}'.format(prefix, verb, name)
+        for name in result['deleted']:
+            print '{0}delete: {1}'.format(prefix, name)
+        for name, err in result['failed']:
+            print >> sys.stderr, 'failed: {0}: {1}'.format(name, err)
+        elapsed = max(result['elapsed'], 0.001)
+        bytes_copied = sum(size for _, size in result['copied'])
+        print ('{0} copied ({1} bytes), {2} deleted, {3} unchanged in {4:.1f} '
+               'seconds ({5:.1f} MiB/s, {6:.1f} files/s)'.format(
+                   len(result['copied']), bytes_copied,
+                   len(result['deleted']), len(result['unchanged']), elapsed,
+                   bytes_copied / elapsed / 2 ** 20,
+                   (len(result['copied']) + len(result['deleted'])) /
+                   elapsed))
+        if result['failed']:
+            raise RuntimeError('failed to synchronize {0} of {1} files'
+                               .format(len(result['failed']),
+                                       len(result['failed']) +
+                                       len(result['copied']) +
+                                       len(result['deleted']) +
+                                       len(result['unchanged'])))
+
+    def __get_bucket_and_prefix(self):
+        bucket, _, prefix = self.args['s3path'].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return bucket, prefix
+
+    def __get_local_path(self, name):
+        return os.path.join(self.args['directory'], *name.split('/'))
+
+    def __list_local_files(self):
+        files = {}
+        if not os.path.isdir(self.args['directory']):
+            return files
+        for dirpath, _, filenames in os.walk(self.args['directory']):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not os.path.isfile(path):
+                    # Broken symlinks, sockets, and the like
+                    continue
+                name = os.path.relpath(path, self.args['directory'])
+                stat = os.stat(path)
+                files[name.replace(os.path.sep, '/')] = {
+                    'size': stat.st_size, 'mtime': int(stat.st_mtime),
+                    'etag': None}
+        self.log.info('found %i local files', len(files))
+        return files
+
+    def __list_remote_objects(self):
+        bucket, prefix = self.__get_bucket_and_prefix()
+        req = ListBucket.from_other(self, paths=[bucket + '/' + prefix])
+        objects = {}
+        for obj in req.main().get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if not name or name.endswith('/'):
+                # Directory placeholders have nothing to copy
+                continue
+            if any(part in ('', '.', '..') for part in name.split('/')):
+                self.log.warn("skipping object '%s' because its name cannot "
+                              "be used as a local path", obj['Key'])
+                continue
+            objects[name] = {'size': int(obj['Size']),
+                             'mtime': _parse_s3_timestamp(
+                                 obj.get('LastModified')),
+                             'etag': obj.get('ETag', '').strip('"').lower()}
+        self.log.info('found %i objects under %s/%s', len(objects), bucket,
+                      prefix)
+        return objects
+
+    def __run_safely(self, func, name, source, dest, results, results_lock):
+        # This runs in a thread pool, where nobody would see an exception
+        try:
+            category, result = func(name, source, dest)
+        except Exception as err:
+            self.log.error('failed to synchronize %s', name, exc_info=True)
+            with results_lock:
+                results['failed'].append((name, six.text_type(err)))
+        else:
+            with results_lock:
+                results[category].append(result)
+
+    def __copy_if_changed(self, name, source, dest):
+        if dest is not None and not self.__has_changed(name, source, dest):
+            return 'unchanged', name
+        if not self.args.get('dry_run'):
+            if self.args.get('download'):
+                self.__download(name, source)
+            else:
+                self.__upload(name)
+        return 'copied', (name, source['size'])
+
+    def __has_changed(self, name, source, dest):
+        if source['size'] != dest['size']:
+            return True
+        if self.args.get('download'):
+            local, remote = dest, source
+        else:
+            local, remote = source, dest
+        if local['mtime'] == remote['mtime']:
+            # Downloads give files their objects' modification times
+            return False
+        if _is_md5(remote['etag']):
+            return self.__get_local_md5(name) != remote['etag']
+        # Multipart uploads' ETags are not MD5 checksums, so all we can do
+        # is check which copy is newer.
+        if source['mtime'] is None or dest['mtime'] is None:
+            return True
+        return source['mtime'] > dest['mtime']
+
+    def __get_local_md5(self, name):
+        digest = hashlib.md5()
+        with open(self.__get_local_path(name), 'rb') as local_file:
+            chunk = local_file.read(euca2ools.BUFSIZE)
+            while chunk:
+                digest.update(chunk)
+                chunk = local_file.read(euca2ools.BUFSIZE)
+        return digest.hexdigest()
+
+    def __upload(self, name):
+        bucket, prefix = self.__get_bucket_and_prefix()
+        self.log.info('uploading %s', name)
+        req = PutObject.from_other(
+            self, source=self.__get_local_path(name),
+            dest='{0}/{1}{2}'.format(bucket, prefix, name),
+            acl=self.args.get('acl'), retries=self.args.get('retries') or 0)
+        req.main()
+
+    def __download(self, name, source):
+        bucket, prefix = self.__get_bucket_and_prefix()
+        path = self.__get_local_path(name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another thread may have created it first
+                if not os.path.isdir(dirname):
+                    raise
+        self.log.info('downloading %s', name)
+        # Download to a temporary file so an interrupted sync never leaves
+        # a partial file that looks up to date behind.
+        temp_file = tempfile.NamedTemporaryFile(
+            dir=dirname, prefix='.{0}.'.format(os.path.basename(path)),
+            delete=False)
+        try:
+            req = GetObject.from_other(
+                self, source='{0}/{1}{2}'.format(bucket, prefix, name),
+                dest=temp_file)
+            req.main()
+            temp_file.close()
+            if source['mtime'] is not None:
+                os.utime(temp_file.name, (source['mtime'], source['mtime']))
+            os.rename(temp_file.name, path)
+        except:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+
+    def __delete(self, name, _, dest):
+        if not self.args.get('dry_run'):
+            self.log.info('deleting %s', name)
+            if self.args.get('download'):
+                os.remove(self.__get_local_path(name))
+            else:
+                bucket, prefix = self.__get_bucket_and_prefix()
+                req = DeleteObject.from_other(
+                    self, path='{0}/{1}{2}'.format(bucket, prefix, name))
+                req.main()
+        return 'deleted', name
+
+
+def _is_md5(etag):
+    return (etag is not None and len(etag) == 32 and
+            all(char in '0123456789abcdef' for char in etag))
+
+
+def _parse_s3_timestamp(timestamp):
+    # S3 timestamps look like 2013-09-18T20:51:23.000Z
+    try:
+        return calendar.timegm(time.strptime(timestamp[:19],
+                                             '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
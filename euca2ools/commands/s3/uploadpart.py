@@ -0,0 +1,77 @@
+# Copyright 2013-2014 Eucalyptus Systems, Inc.
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from requestbuilder import Arg
+import requestbuilder.exceptions
+
+from euca2ools.commands.s3 import S3Request
+
+
+class UploadPart(S3Request):
+    DESCRIPTION = 'Upload one part of a multipart upload'
+    ARGS = [Arg('source', route_to=None,
+                help='file-like object to upload the part from (required)'),
+            Arg('dest', metavar='BUCKET/KEY', route_to=None,
+                help='bucket and key name of the upload (required)'),
+            Arg('--upload-id', required=True, route_to=None,
+                help='ID of the upload the part belongs to (required)'),
+            Arg('--part-number', type=int, required=True, route_to=None,
+                help='number of the part, starting from 1 (required)')]
+    METHOD = 'PUT'
+
+    def configure(self):
+        S3Request.configure(self)
+        # The source must keep track of the MD5 digest of what it reads,
+        # as euca2ools.commands.s3.putobject._FileObjectExtent does.
+        if not hasattr(self.args['source'], 'read_hexdigest'):
+            raise requestbuilder.exceptions.ArgumentError(
+                'source must be a file extent that computes its MD5 digest')
+
+    def preprocess(self):
+        self.path = self.args['dest']
+        self.params['partNumber'] = str(self.args['part_number'])
+        self.params['uploadId'] = self.args['upload_id']
+        # For requests >=2.11.0 it requires headers to be either str or bytes
+        self.headers['Content-Length'] = bytes(self.args['source'].size)
+        self.body = self.args['source']
+
+    def main(self):
+        """
+        Upload the part and return its ETag, which is the same as the
+        MD5 digest of its contents.
+        """
+        self.preprocess()
+        source = self.args['source']
+        response = self.send()
+        our_md5 = source.read_hexdigest
+        their_md5 = response.headers.get('ETag', '').lower().strip('"')
+        if their_md5 != our_md5:
+            self.log.error('corrupt upload of part %i (our MD5: %s, their '
+                           'MD5: %s)', self.args['part_number'], our_md5,
+                           their_md5)
+            raise requestbuilder.exceptions.ClientError(
+                'upload of part {0} was corrupted during transit'
+                .format(self.args['part_number']))
+        return their_md5
@@ -28,12 +28,12 @@ import requestbuilder.auth.aws
 import requestbuilder.service
 import requestbuilder.request
 
-from euca2ools.commands import Euca2ools
+from euca2ools.commands import Euca2ools, SharedSessionServiceMixin
 from euca2ools.exceptions import AWSError
 from euca2ools.util import strip_response_metadata, add_fake_region_name
 
 
-class STS(requestbuilder.service.BaseService):
+class STS(SharedSessionServiceMixin, requestbuilder.service.BaseService):
     NAME = 'sts'
     DESCRIPTION = 'Token service'
     API_VERSION = '2011-06-15'
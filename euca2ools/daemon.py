@@ -0,0 +1,194 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+The wire protocol and client side of euca-daemon, which runs euca2ools
+commands on behalf of euca-client in a process that has already
+imported everything they need.
+
+Clients exchange frames with the daemon over a UNIX socket.  Each frame
+is a one-byte type and a four-byte length followed by that many bytes of
+payload.  The client sends one FRAME_REQUEST frame containing a JSON
+object with the command's argv, environment, and working directory,
+then copies its standard input in FRAME_STDIN frames, ending with an
+empty one.  The daemon answers with FRAME_STDOUT and FRAME_STDERR frames
+as the command produces output and finishes with a FRAME_EXIT frame
+containing the command's exit status.
+
+This module deliberately imports nothing beyond the standard library so
+that starting a client remains cheap.
+"""
+
+import errno
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+
+FRAME_REQUEST = b'A'
+FRAME_STDIN = b'I'
+FRAME_STDOUT = b'O'
+FRAME_STDERR = b'E'
+FRAME_EXIT = b'X'
+
+_FRAME_HEADER = struct.Struct('!cI')
+_BUFSIZE = 16 * 1024
+
+
+def get_socket_path():
+    """
+    Return the path of the socket the daemon listens on, which is
+    $EUCA_DAEMON_SOCKET if it is set and ~/.euca/daemon.sock otherwise.
+    """
+    if os.getenv('EUCA_DAEMON_SOCKET'):
+        return os.getenv('EUCA_DAEMON_SOCKET')
+    return os.path.expanduser(os.path.join('~', '.euca', 'daemon.sock'))
+
+
+def send_frame(sock, frame_type, payload=b''):
+    sock.sendall(_FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """
+    Read one frame from a socket and return its type and payload.  If
+    the other end closed the connection between frames return
+    (None, None).
+    """
+    header = _recv_exactly(sock, _FRAME_HEADER.size)
+    if not header:
+        return None, None
+    frame_type, length = _FRAME_HEADER.unpack(header)
+    payload = _recv_exactly(sock, length)
+    if len(payload) != length:
+        raise EOFError('connection closed in the middle of a frame')
+    return frame_type, payload
+
+
+def _recv_exactly(sock, length):
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        try:
+            chunk = sock.recv(min(remaining, _BUFSIZE))
+        except socket.error as err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            if chunks:
+                raise EOFError('connection closed in the middle of a frame')
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _write_fully(fileno, data):
+    while data:
+        written = os.write(fileno, data)
+        data = data[written:]
+
+
+def _send_stdin(sock, lock):
+    try:
+        while True:
+            data = os.read(sys.stdin.fileno(), _BUFSIZE)
+            with lock:
+                send_frame(sock, FRAME_STDIN, data)
+            if not data:
+                return
+    except (OSError, socket.error):
+        # The command finished before it consumed all of its input.
+        pass
+
+
+def run_client(argv=None):
+    """
+    Run a command in the daemon and exit with its exit status.
+
+    A client can name the command to run in its first argument, as in
+    "euca-client euca-describe-instances -v".  A link to the client that
+    has the command's name, such as a link named euca-describe-instances,
+    also works.  When the daemon is not running commands named in the
+    first argument are run directly instead.
+    """
+    if argv is None:
+        argv = sys.argv
+    name_is_argument = os.path.basename(argv[0]) == 'euca-client'
+    if name_is_argument:
+        if len(argv) < 2 or argv[1] in ('-h', '--help'):
+            print >> sys.stderr, ('usage: euca-client COMMAND [ARG ...]\n\n'
+                                  'Run a euca2ools command with euca-daemon')
+            sys.exit(2)
+        argv = argv[1:]
+    socket_path = get_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as err:
+        sock.close()
+        if name_is_argument:
+            try:
+                os.execvp(argv[0], argv)
+            except OSError as exec_err:
+                print >> sys.stderr, 'euca-client: {0}: {1}'.format(
+                    argv[0], exec_err.strerror)
+                sys.exit(127)
+        print >> sys.stderr, ('euca-client: unable to connect to '
+                              'euca-daemon at {0}: {1}'.format(
+                                  socket_path, err.strerror or err))
+        sys.exit(1)
+
+    request = {'argv': argv, 'env': dict(os.environ), 'cwd': os.getcwd()}
+    lock = threading.Lock()
+    send_frame(sock, FRAME_REQUEST, json.dumps(request).encode('utf-8'))
+    stdin_thread = threading.Thread(target=_send_stdin, args=(sock, lock))
+    stdin_thread.daemon = True
+    stdin_thread.start()
+    try:
+        while True:
+            frame_type, payload = recv_frame(sock)
+            if frame_type == FRAME_STDOUT:
+                _write_fully(sys.stdout.fileno(), payload)
+            elif frame_type == FRAME_STDERR:
+                _write_fully(sys.stderr.fileno(), payload)
+            elif frame_type == FRAME_EXIT:
+                # The stdin thread may still be waiting for input the
+                # command never read, so do not wait for it to finish.
+                os._exit(int(payload))
+            else:
+                print >> sys.stderr, ('euca-client: connection to '
+                                      'euca-daemon closed unexpectedly')
+                os._exit(1)
+    except KeyboardInterrupt:
+        # Closing the connection makes the daemon stop the command.
+        os._exit(130)
+    except (EOFError, socket.error) as err:
+        print >> sys.stderr, 'euca-client: {0}'.format(err)
+        os._exit(1)
@@ -0,0 +1,505 @@
+# Copyright (c) 2016 Hewlett Packard Enterprise Development LP
+#
+# Redistribution and use of this software in source and binary forms,
+# with or without modification, are permitted provided that the following
+# conditions are met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Inspection of disk image files.  Only headers, footers, and allocation
+tables are read, so even very large images can be inspected quickly.
+"""
+
+import errno
+import os
+import re
+import struct
+import sys
+
+import euca2ools
+import euca2ools.util
+
+
+# lseek whence values that find the data and holes in sparse files.
+# Python 2's os module lacks them, so fall back to Linux's values there.
+if sys.platform.startswith('linux'):
+    _SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+    _SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+else:
+    _SEEK_DATA = getattr(os, 'SEEK_DATA', None)
+    _SEEK_HOLE = getattr(os, 'SEEK_HOLE', None)
+
+SECTOR_SIZE = 512
+
+# see https://www.vmware.com/support/developer/vddk/vmdk_50_technote.pdf
+_VMDK_MAGIC = b'KDMV'
+_VMDK_DESCRIPTOR_MAGIC = b'# Disk DescriptorFile'
+_VMDK_DESCRIPTOR_MAX_SIZE = 2 ** 20
+_VMDK_GD_AT_END = 0xffffffffffffffff
+_VMDK_SPARSE_HEADER = struct.Struct('<4sIIQQQQIQQQ?4sH')
+_VMDK_EXTENT_RE = re.compile(
+    r'^\s*(?:RW|RDONLY|NOACCESS)\s+(\d+)\s+(\w+)'
+    r'(?:\s+"([^"]*)"(?:\s+(\d+))?)?')
+_VMDK_CREATE_TYPE_RE = re.compile(r'^\s*createType\s*=\s*"?([^"\s]*)"?')
+
+# see "Virtual Hard Disk Image Format Specification"
+_VHD_COOKIE = b'conectix'
+_VHD_DYNAMIC_COOKIE = b'cxsparse'
+_VHD_FOOTER = struct.Struct('>8sIIQI4sIIQQIII16sB')
+_VHD_DYNAMIC_HEADER = struct.Struct('>8sQQIIII16sII512s')
+_VHD_DISK_TYPES = {2: 'fixed', 3: 'dynamic', 4: 'differencing'}
+_VHD_UNUSED_BLOCK = 0xffffffff
+
+# see docs/interop/qcow2.txt in the QEMU source tree
+_QCOW2_MAGIC = b'QFI\xfb'
+_QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+_QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+_QCOW2_COMPRESSED = 1 << 62
+_QCOW2_ZERO = 1
+
+
+def open_disk_image(filename, image_format=None):
+    """
+    Return a DiskImage object describing a disk image file.  If no
+    format is given, it is detected from the file's contents.
+    """
+    if image_format is None:
+        image_format = detect_format(filename)
+    image_format = image_format.lower()
+    if image_format not in _IMAGE_CLASSES:
+        raise ValueError('unsupported disk image format: {0}'
+                         .format(image_format))
+    return _IMAGE_CLASSES[image_format](filename)
+
+
+def detect_format(filename):
+    """
+    Return the name of a disk image file's format:  "vmdk", "vhd",
+    "qcow2", or "raw" if it does not look like any of the others.
+    """
+    file_size = euca2ools.util.get_filesize(filename)
+    with open(filename, 'rb') as image:
+        head = image.read(SECTOR_SIZE)
+        if head.startswith(_QCOW2_MAGIC):
+            return 'qcow2'
+        if (head.startswith(_VMDK_MAGIC) or
+                head.startswith(_VMDK_DESCRIPTOR_MAGIC)):
+            return 'vmdk'
+        if head.startswith(_VHD_COOKIE):
+            # Dynamic disks have a copy of their footer at the start
+            return 'vhd'
+        if file_size >= SECTOR_SIZE:
+            image.seek(file_size - SECTOR_SIZE)
+            if image.read(len(_VHD_COOKIE)) == _VHD_COOKIE:
+                return 'vhd'
+    return 'raw'
+
+
+def find_data_extents(fileno, offset, size):
+    """
+    Generate (offset, length) tuples for the parts of a region of an
+    open file that are not holes.  If the OS or file system cannot tell
+    where a sparse file's holes are, the whole region is treated as
+    data.  This moves the file descriptor's offset.
+    """
+    end = offset + size
+    pos = offset
+    if _SEEK_DATA is None:
+        if size > 0:
+            yield (offset, size)
+        return
+    while pos < end:
+        try:
+            pos = os.lseek(fileno, pos, _SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # Nothing but a hole remains after pos
+                return
+            if err.errno != errno.EINVAL:
+                raise
+            # The file system does not support finding holes
+            yield (pos, end - pos)
+            return
+        if pos >= end:
+            return
+        data_end = min(os.lseek(fileno, pos, _SEEK_HOLE), end)
+        yield (pos, data_end - pos)
+        pos = data_end
+
+
+def is_all_zeros(fileno, offset, size):
+    """
+    Return whether a region of an open file contains nothing but zeros.
+
+    Holes in sparse files are skipped without reading them.  Everything
+    else is read until a byte that is not zero turns up, so regions that
+    contain data usually need only one read to rule out.  This moves the
+    file descriptor's offset.
+    """
+    zeros = b'\0' * euca2ools.BUFSIZE
+    for data_start, data_size in find_data_extents(fileno, offset, size):
+        os.lseek(fileno, data_start, os.SEEK_SET)
+        pos = data_start
+        while pos < data_start + data_size:
+            chunk = os.read(fileno, min(euca2ools.BUFSIZE,
+                                        data_start + data_size - pos))
+            if not chunk:
+                # The file is shorter than the region, but everything in
+                # it is a zero.
+                return True
+            if chunk != zeros[:len(chunk)]:
+                return False
+            pos += len(chunk)
+    return True
+
+
+class DiskImage(object):
+    """
+    The metadata of a disk image file.  Offsets and sizes are those of
+    the virtual disk the image contains, in bytes, not those of the file
+    itself.
+    """
+
+    FORMAT = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.subformat = None
+        self.virtual_size = None
+        self.backing_file = None
+        self.__allocation_map = None
+        with open(filename, 'rb') as image:
+            self._read_metadata(image)
+
+    @property
+    def allocated_size(self):
+        return sum(length for _, length in self.get_allocation_map())
+
+    def get_allocation_map(self):
+        """
+        Return a sorted list of (offset, length) tuples for the parts of
+        the virtual disk that contain data.  Everything else reads as
+        zeros.  How finely this is tracked depends on the format; some
+        extents may contain zeros as well.
+        """
+        if self.__allocation_map is None:
+            allocation_map = []
+            with open(self.filename, 'rb') as image:
+                for offset, length in self._find_allocated_extents(image):
+                    length = min(length, self.virtual_size - offset)
+                    if length <= 0:
+                        continue
+                    if (allocation_map and
+                            sum(allocation_map[-1]) == offset):
+                        allocation_map[-1] = (allocation_map[-1][0],
+                                              allocation_map[-1][1] + length)
+                    else:
+                        allocation_map.append((offset, length))
+            self.__allocation_map = allocation_map
+        return self.__allocation_map
+
+    def _read_metadata(self, image):
+        raise NotImplementedError()
+
+    def _find_allocated_extents(self, image):
+        """
+        Generate (offset, length) tuples in order for each allocated
+        extent of the virtual disk.
+        """
+        raise NotImplementedError()
+
+    def _read_exactly(self, image, offset, size):
+        image.seek(offset)
+        data = image.read(size)
+        if len(data) != size:
+            raise ValueError('File {0} is truncated or corrupt ({1} bytes '
+                             'at offset {2} are missing)'
+                             .format(image.name, size, offset))
+        return data
+
+
+class RawImage(DiskImage):
+    FORMAT = 'raw'
+
+    def _read_metadata(self, image):
+        self.virtual_size = euca2ools.util.get_filesize(self.filename)
+
+    def _find_allocated_extents(self, image):
+        return find_data_extents(image.fileno(), 0, self.virtual_size)
+
+
+class VMDKImage(DiskImage):
+    """
+    A VMDK image, either a sparse extent file (monolithicSparse or
+    streamOptimized) or a descriptor file that refers to extent files
+    in the same directory (twoGbMaxExtentSparse, monolithicFlat, etc.).
+    """
+
+    FORMAT = 'vmdk'
+
+    def __init__(self, filename):
+        self.__extents = []
+        DiskImage.__init__(self, filename)
+
+    def _read_metadata(self, image):
+        head = image.read(SECTOR_SIZE)
+        if head.startswith(_VMDK_MAGIC):
+            header = self.__read_sparse_header(image)
+            capacity, descriptor_offset, descriptor_size = header[3], \
+                header[5], header[6]
+            descriptor = b''
+            if descriptor_offset and descriptor_size:
+                descriptor = self._read_exactly(
+                    image, descriptor_offset * SECTOR_SIZE,
+                    min(descriptor_size * SECTOR_SIZE,
+                        _VMDK_DESCRIPTOR_MAX_SIZE))
+            self.subformat = self.__parse_descriptor(descriptor)[0]
+            self.__extents = [(capacity, 'SPARSE', self.filename, 0)]
+        elif head.startswith(_VMDK_DESCRIPTOR_MAGIC):
+            image.seek(0)
+            descriptor = image.read(_VMDK_DESCRIPTOR_MAX_SIZE)
+            self.subformat, self.__extents = \
+                self.__parse_descriptor(descriptor)
+            if not self.__extents:
+                raise ValueError('File {0} is a VMDK descriptor with no '
+                                 'extents'.format(self.filename))
+        else:
+            raise ValueError('File {0} is not a VMDK image'
+                             .format(self.filename))
+        self.virtual_size = SECTOR_SIZE * sum(extent[0] for extent
+                                              in self.__extents)
+
+    def _find_allocated_extents(self, image):
+        extent_start = 0
+        for sectors, extent_type, extent_file, file_offset in self.__extents:
+            extent_size = sectors * SECTOR_SIZE
+            if extent_type == 'ZERO':
+                pass
+            elif extent_type in ('FLAT', 'VMFS'):
+                with open(extent_file, 'rb') as extent:
+                    file_start = file_offset * SECTOR_SIZE
+                    for offset, length in find_data_extents(
+                            extent.fileno(), file_start, extent_size):
+                        yield (extent_start + offset - file_start, length)
+            elif extent_type == 'SPARSE':
+                with open(extent_file, 'rb') as extent:
+                    for offset, length in self.__find_allocated_grains(
+                            extent):
+                        if offset >= extent_size:
+                            break
+                        yield (extent_start + offset,
+                               min(length, extent_size - offset))
+            else:
+                # We don't know how to look inside this kind of extent
+                yield (extent_start, extent_size)
+            extent_start += extent_size
+
+    def __read_sparse_header(self, image):
+        header = _VMDK_SPARSE_HEADER.unpack(self._read_exactly(
+            image, 0, _VMDK_SPARSE_HEADER.size))
+        if header[9] == _VMDK_GD_AT_END:
+            # Stream-optimized images are written front to back, so
+            # where the grain directory ended up is only recorded in
+            # the footer, which is 1024 bytes from the end.
+            file_size = euca2ools.util.get_filesize(image.name)
+            header = _VMDK_SPARSE_HEADER.unpack(self._read_exactly(
+                image, file_size - 2 * SECTOR_SIZE,
+                _VMDK_SPARSE_HEADER.size))
+            if header[0] != _VMDK_MAGIC:
+                raise ValueError('File {0} is missing its VMDK footer'
+                                 .format(image.name))
+        if header[4] == 0 or header[7] == 0:
+            raise ValueError('File {0} has an invalid VMDK grain size'
+                             .format(image.name))
+        return header
+
+    def __parse_descriptor(self, descriptor):
+        create_type = None
+        extents = []
+        descriptor_dir = os.path.dirname(self.filename)
+        for line in descriptor.split(b'\0', 1)[0].decode(
+                'utf-8', 'replace').splitlines():
+            match = _VMDK_CREATE_TYPE_RE.match(line)
+            if match:
+                create_type = match.group(1)
+                continue
+            match = _VMDK_EXTENT_RE.match(line)
+            if match:
+                sectors, extent_type, extent_file, file_offset = \
+                    match.groups()
+                if extent_file:
+                    extent_file = os.path.join(descriptor_dir, extent_file)
+                extents.append((int(sectors), extent_type.upper(),
+                                extent_file, int(file_offset or 0)))
+        return create_type, extents
+
+    def __find_allocated_grains(self, extent):
+        header = self.__read_sparse_header(extent)
+        capacity, grain_size, gtes_per_gt, gd_offset = \
+            header[3], header[4], header[7], header[9]
+        grain_size *= SECTOR_SIZE
+        gt_coverage = gtes_per_gt * grain_size
+        gd_entries = -(-capacity * SECTOR_SIZE // gt_coverage)
+        grain_dir = struct.unpack('<{0}I'.format(gd_entries),
+                                  self._read_exactly(
+                                      extent, gd_offset * SECTOR_SIZE,
+                                      4 * gd_entries))
+        empty_gt = b'\0' * (4 * gtes_per_gt)
+        for gd_index, gt_sector in enumerate(grain_dir):
+            if gt_sector == 0:
+                continue
+            grain_table = self._read_exactly(extent, gt_sector * SECTOR_SIZE,
+                                             4 * gtes_per_gt)
+            if grain_table == empty_gt:
+                continue
+            grain_table = struct.unpack('<{0}I'.format(gtes_per_gt),
+                                        grain_table)
+            for gt_index, grain_sector in enumerate(grain_table):
+                # 0 means unallocated; 1 means allocated but zeroed
+                if grain_sector > 1:
+                    yield (gd_index * gt_coverage + gt_index * grain_size,
+                           grain_size)
+
+
+class VHDImage(DiskImage):
+    """
+    A fixed, dynamic, or differencing VHD image.  Dynamic and
+    differencing images' allocation maps are tracked in whole blocks
+    (usually 2 MiB) and only cover data stored in the image itself, not
+    that in any parent image.
+    """
+
+    FORMAT = 'vhd'
+
+    def __init__(self, filename):
+        self.block_size = None
+        self.__table_offset = None
+        self.__max_table_entries = None
+        DiskImage.__init__(self, filename)
+
+    def _read_metadata(self, image):
+        file_size = euca2ools.util.get_filesize(self.filename)
+        footer = b''
+        if file_size >= SECTOR_SIZE:
+            image.seek(file_size - SECTOR_SIZE)
+            footer = image.read(SECTOR_SIZE)
+        if not footer.startswith(_VHD_COOKIE):
+            # Dynamic disks have a copy of their footer at the start
+            image.seek(0)
+            footer = image.read(SECTOR_SIZE)
+            if not footer.startswith(_VHD_COOKIE):
+                raise ValueError('File {0} is not a VHD image'
+                                 .format(self.filename))
+        footer = _VHD_FOOTER.unpack_from(footer)
+        data_offset, self.virtual_size, disk_type = \
+            footer[3], footer[9], footer[11]
+        self.subformat = _VHD_DISK_TYPES.get(disk_type)
+        if self.subformat is None:
+            raise ValueError('File {0} has unsupported VHD disk type {1}'
+                             .format(self.filename, disk_type))
+        if self.subformat == 'fixed':
+            return
+        header = _VHD_DYNAMIC_HEADER.unpack(self._read_exactly(
+            image, data_offset, _VHD_DYNAMIC_HEADER.size))
+        if header[0] != _VHD_DYNAMIC_COOKIE:
+            raise ValueError('File {0} is missing its VHD dynamic disk header'
+                             .format(self.filename))
+        self.__table_offset, self.__max_table_entries, self.block_size = \
+            header[2], header[4], header[5]
+        if self.subformat == 'differencing':
+            self.backing_file = header[10].decode(
+                'utf-16-be', 'replace').rstrip(u'\0') or None
+
+    def _find_allocated_extents(self, image):
+        if self.subformat == 'fixed':
+            return find_data_extents(image.fileno(), 0, self.virtual_size)
+        return self.__find_allocated_blocks(image)
+
+    def __find_allocated_blocks(self, image):
+        block_table = struct.unpack(
+            '>{0}I'.format(self.__max_table_entries),
+            self._read_exactly(image, self.__table_offset,
+                               4 * self.__max_table_entries))
+        for index, block_sector in enumerate(block_table):
+            if block_sector != _VHD_UNUSED_BLOCK:
+                yield (index * self.block_size, self.block_size)
+
+
+class QCOW2Image(DiskImage):
+    """
+    A qcow2 image.  Its allocation map only covers data stored in the
+    image itself, not that in any backing file.
+    """
+
+    FORMAT = 'qcow2'
+
+    def __init__(self, filename):
+        self.cluster_size = None
+        self.__l1_size = None
+        self.__l1_table_offset = None
+        DiskImage.__init__(self, filename)
+
+    def _read_metadata(self, image):
+        header = _QCOW2_HEADER.unpack(self._read_exactly(
+            image, 0, _QCOW2_HEADER.size))
+        if header[0] != _QCOW2_MAGIC:
+            raise ValueError('File {0} is not a qcow2 image'
+                             .format(self.filename))
+        version = header[1]
+        if version not in (2, 3):
+            raise ValueError('File {0} uses unsupported qcow version {1}'
+                             .format(self.filename, version))
+        self.subformat = 'v{0}'.format(version)
+        backing_file_offset, backing_file_size = header[2], header[3]
+        self.cluster_size = 1 << header[4]
+        self.virtual_size = header[5]
+        self.__l1_size, self.__l1_table_offset = header[7], header[8]
+        if backing_file_offset and backing_file_size:
+            self.backing_file = self._read_exactly(
+                image, backing_file_offset, backing_file_size).decode(
+                    'utf-8', 'replace')
+
+    def _find_allocated_extents(self, image):
+        l2_entries = self.cluster_size // 8
+        l2_coverage = l2_entries * self.cluster_size
+        l1_table = struct.unpack(
+            '>{0}Q'.format(self.__l1_size),
+            self._read_exactly(image, self.__l1_table_offset,
+                               8 * self.__l1_size))
+        empty_l2 = b'\0' * self.cluster_size
+        for l1_index, l1_entry in enumerate(l1_table):
+            l2_offset = l1_entry & _QCOW2_OFFSET_MASK
+            if not l2_offset:
+                continue
+            l2_table = self._read_exactly(image, l2_offset, self.cluster_size)
+            if l2_table == empty_l2:
+                continue
+            l2_table = struct.unpack('>{0}Q'.format(l2_entries), l2_table)
+            for l2_index, l2_entry in enumerate(l2_table):
+                if (l2_entry & _QCOW2_COMPRESSED or
+                        (l2_entry & _QCOW2_OFFSET_MASK and
+                         not l2_entry & _QCOW2_ZERO)):
+                    yield (l1_index * l2_coverage +
+                           l2_index * self.cluster_size, self.cluster_size)
+
+
+_IMAGE_CLASSES = {'raw': RawImage, 'vmdk': VMDKImage, 'vhd': VHDImage,
+                  'qcow2': QCOW2Image}
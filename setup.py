@@ -33,7 +33,7 @@ import sys
 
 from setuptools import find_packages, setup
 
-from euca2ools import __version__
+from euca2ools import get_version
 
 
 REQUIREMENTS = ['lxml',
@@ -82,7 +82,7 @@ class build_py_with_git_version(build_py):
         build_py.build_module(self, module, module_file, package)
         print module, module_file, package
         if module == '__init__' and '.' not in package:
-            version_line = "__version__ = '{0}'\n".format(__version__)
+            version_line = "__version__ = '{0}'\n".format(get_version())
             old_init_name = self.get_module_outfile(self.build_lib, (package,),
                                                     module)
             new_init_name = old_init_name + '.new'
@@ -103,7 +103,7 @@ class sdist_with_git_version(sdist):
 
     def make_release_tree(self, base_dir, files):
         sdist.make_release_tree(self, base_dir, files)
-        version_line = "__version__ = '{0}'\n".format(__version__)
+        version_line = "__version__ = '{0}'\n".format(get_version())
         old_init_name = os.path.join(base_dir, 'euca2ools/__init__.py')
         new_init_name = old_init_name + '.new'
         with open(new_init_name, 'w') as new_init:
@@ -118,7 +118,7 @@ class sdist_with_git_version(sdist):
 
 
 setup(name="euca2ools",
-      version=__version__,
+      version=get_version(),
       description="Eucalyptus Command Line Tools",
       long_description="Eucalyptus Command Line Tools",
       author="Eucalyptus Systems, Inc.",